@@ -10,6 +10,8 @@ Introduce the detector response in the simulated images
 
 import argparse
 
+import numpy as np
+
 #import timeseries
 from . import timeseries
 
@@ -19,7 +21,8 @@ from . import timeseries
 
 def add_noise(filelist, noisefiles_path, photon=True, zodibackg=True, flatfield=True, darkcurrent=True, nonlinearity=True,
               superbias=True, readout=True, oneoverf=True, cosmicray = False, zodi_ref=None, flat_ref=None, dark_ref=None,
-              nlcoeff_ref=None, superbias_ref=None, outputfilename=None, full_well=72000):
+              nlcoeff_ref=None, superbias_ref=None, outputfilename=None, full_well=72000, memory_budget=None,
+              seed=None, ncpu=1):
 
     """
     A function to add detector noise to the simulations.
@@ -42,6 +45,13 @@ def add_noise(filelist, noisefiles_path, photon=True, zodibackg=True, flatfield=
     :param dark_ref: string, CRDS reference file containing the dark current map
     :param nlcoeff_ref: string, UdeM in-house reference file containing the coeff to delinearize the ramp
     :param superbias_ref: string, CRDS reference file containing the superbias
+    :param memory_budget: float, if set, the exposure is processed in blocks of integrations
+                          sized so that the processing, reference arrays included, uses
+                          about that many bytes (see TimeSeries.process_chunked)
+                          instead of being loaded in memory at once.
+    :param seed: int, seed of the random noise. Each file and each integration gets its own
+                 reproducible random stream derived from it. Random if None.
+    :param ncpu: int, number of processes over which the integrations are shared.
 
     :type filelist: list[str]
     :type photon: bool
@@ -64,9 +74,14 @@ def add_noise(filelist, noisefiles_path, photon=True, zodibackg=True, flatfield=
 
     normfactor = None
 
-    for filename in filelist_checked:
+    # One independent seed per file, all derived from the input seed.
+    file_seeds = np.random.SeedSequence(seed).generate_state(len(filelist_checked))
+
+    for filename, file_seed in zip(filelist_checked, file_seeds):
 
-        tso = timeseries.TimeSeries(filename, noisefiles_path=noisefiles_path)
+        tso = timeseries.TimeSeries(filename, noisefiles_path=noisefiles_path,
+                                    chunked=memory_budget is not None,
+                                    seed=int(file_seed), ncpu=ncpu)
 
         #if normalize:
         #
@@ -78,22 +93,25 @@ def add_noise(filelist, noisefiles_path, photon=True, zodibackg=True, flatfield=
 
         # TODO: change frame time in write_dmsready_fits
 
+        # The noise chain, in the order it is applied
+        noise_chain = []
+
         if zodibackg:
             print('Add zodiacal background')
-            tso.add_zodiacal_background(zodifile=zodi_ref)
+            noise_chain.append(('add_zodiacal_background', {'zodifile': zodi_ref}))
 
         if photon:
             print('Add Poisson noise')
-            tso.add_poisson_noise()
+            noise_chain.append(('add_poisson_noise', {}))
 
         if flatfield:
             print('Add flat field response')
-            tso.apply_flatfield(flatfile=flat_ref)
+            noise_chain.append(('apply_flatfield', {'flatfile': flat_ref}))
 
         if darkcurrent:
             #TODO: have better dark ref files. ref files for darks are very noisy with 1/f noise and rms of order 50% of the dark at read 50.
             print('Add dark current')
-            tso.add_dark(darkfile=dark_ref)
+            noise_chain.append(('add_dark', {'darkfile': dark_ref}))
 
         if cosmicray:
             #TODO: add cosmic ray capability
@@ -101,25 +119,32 @@ def add_noise(filelist, noisefiles_path, photon=True, zodibackg=True, flatfield=
 
         if nonlinearity:
             print('Add non linearity (delinearize)')
-            tso.add_non_linearity(coef_file=nlcoeff_ref)
+            noise_chain.append(('add_non_linearity', {'coef_file': nlcoeff_ref}))
 
         if superbias:
             print('Add superbias')
-            tso.add_superbias(biasfile=superbias_ref)
+            noise_chain.append(('add_superbias', {'biasfile': superbias_ref}))
 
         if readout:
             print('Add readout noise')
-            tso.add_readout_noise()
+            noise_chain.append(('add_readout_noise', {}))
 
         if oneoverf:
             print('Add 1/f noise')
-            tso.add_1overf_noise()
+            noise_chain.append(('add_1overf_noise', {}))
 
         #if detector:
         #    # We discourage the use of this until tested.
         #    tso.add_detector_noise()
 
-        tso.write_to_fits(outputfilename)
+        # The TimeSeries releases its pool of processes and shared memory on exit
+        with tso:
+            if memory_budget is None:
+                for method_name, kwargs in noise_chain:
+                    getattr(tso, method_name)(**kwargs)
+                tso.write_to_fits(outputfilename)
+            else:
+                tso.process_chunked(noise_chain, filename=outputfilename, memory_budget=memory_budget)
 
     return
 
@@ -10,6 +10,8 @@ TimeSeries objects for simulations of SOSS observations
 from copy import deepcopy
 from pkg_resources import resource_filename
 import os
+import multiprocessing as mp
+from multiprocessing import shared_memory
 
 # General science imports.
 import numpy as np
@@ -33,6 +35,223 @@ from time import sleep
 
 # TODO header section which files and values were used.
 
+# Number of block-sized arrays that the noise steps hold in memory at once
+# (the block itself, deep copies, noise realizations), and of integration-sized
+# arrays held by a per-integration noise function. Used to size the
+# integration blocks of TimeSeries.process_chunked.
+CHUNK_COPIES = 4
+
+# Index of each random noise component in the seed sequence spawn keys
+NOISE_COMPONENTS = {'zodibackg': 0, 'poisson': 1, 'dark': 2, 'readout': 3, 'oneoverf': 4}
+
+
+def integration_rng(entropy, component, integ):
+    """Random generator of one noise component for one integration.
+
+    The stream is derived from the exposure entropy and the (component,
+    integration) pair only, so each integration can be generated in any
+    order, in any process, and reproduced bit for bit in isolation.
+
+    :param entropy: int, entropy of the exposure seed sequence (TimeSeries.seed_entropy)
+    :param component: str, one of NOISE_COMPONENTS
+    :param integ: int, index of the integration in the exposure
+    :return: numpy.random.Generator
+    """
+
+    seq = np.random.SeedSequence(entropy, spawn_key=(NOISE_COMPONENTS[component], int(integ)))
+
+    return np.random.Generator(np.random.Philox(seq))
+
+
+def poisson_ramp(ramp, rng):
+    """Poisson realization of an up-the-ramp integration (ngroups, ncols, nrows)."""
+
+    # Convert up the ramp samples, to flux between reads.
+    ramp = np.copy(ramp)
+    ramp[1:] = np.diff(ramp, axis=0)
+
+    # Add the poisson noise.
+    ramp = np.where(ramp < 0, 0, ramp)  # Sanity check.
+    ramp = rng.poisson(ramp)
+
+    # Convert back to up the ramp samples.
+    return np.cumsum(ramp, axis=0)
+
+
+def add_zodiacal_ramp(ramp, rng, subzodi):
+    """Add Poisson realization of the zodiacal background (ngroups, ncols, nrows) electrons per group."""
+
+    # Add poisson noise, and convert to up the ramp samples.
+    zodiramp = np.cumsum(rng.poisson(subzodi), axis=0)
+
+    return ramp + zodiramp
+
+
+def add_dark_ramp(ramp, rng, darkframe):
+    """Add Poisson realization of the dark frame, copied to all groups, to an integration."""
+
+    dark = np.tile(darkframe[np.newaxis, :, :], (np.shape(ramp)[0], 1, 1))
+
+    return ramp + poisson_ramp(dark, rng)
+
+
+def add_readout_ramp(ramp, rng, rms):
+    """Add white readout noise of single-read rms to an integration."""
+
+    return ramp + rng.standard_normal(np.shape(ramp)) * rms / np.sqrt(2)
+
+
+class PinkNoiseGenerator:
+    """Correlated 1/f noise (pink noise) generator. Extracted from HxRGNoise.
+
+    The pinkening filter only depends on (subarray, ngroups, alpha) and is
+    computed once and shared by all generators with the same parameters.
+    Integrations are generated in batches with one multi-row real FFT and
+    added in place to the ramps.
+    """
+
+    # Pinkening filters, per (subarray, ngroups, alpha)
+    _filters = {}
+
+    def __init__(self, subarray, ngroups, c_pink=9.6, alpha=-1, batch=4):
+        """
+        :param subarray: str, one of SUBSTRIP96, SUBSTRIP256 or FULL
+        :param ngroups: int, number of groups per integration
+        :param c_pink: float, amplitude of the pink noise [electrons]
+        :param alpha: float, power law index of the noise spectrum
+        :param batch: int, number of integrations generated per FFT
+        """
+
+        # Select the appropriate subarray.
+        if subarray == 'SUBSTRIP96':
+            cols, rows, cols_over, rows_over, amps = 96, 2048, 12, 2, 1
+        elif subarray == 'SUBSTRIP256':
+            cols, rows, cols_over, rows_over, amps = 256, 2048, 12, 2, 1
+        elif subarray == 'FULL':
+            cols, rows, cols_over, rows_over, amps = 2048, 2048, 12, 1, 4
+        else:
+            raise ValueError('SUBARRAY must be one of SUBSTRIP96, SUBSTRIP256 or FULL')
+
+        self.ngroups = ngroups
+        self.c_pink = c_pink
+        self.batch = batch
+        self.rows, self.rows_over = rows, rows_over
+        self.amps, self.ampcols, self.cols_over = amps, cols // amps, cols_over
+
+        # naxis1 is in the detector orientation
+        self.nstep = (self.ampcols + cols_over) * (rows + rows_over) * ngroups
+        # Pad nsteps to a power of 2, which is much faster (JML)
+        self.nstep2 = int(2 ** np.ceil(np.log2(self.nstep)))
+
+        key = (subarray, ngroups, alpha)
+        if key not in self._filters:
+            # Define frequency arrays
+            f2 = np.fft.rfftfreq(self.nstep2)  # ... for 2*nstep elements
+
+            # Define pinkening filters. F2 and p_filter2 are used to generate 1/f noise.
+            p_filter2 = np.sqrt(f2[1:] ** alpha)
+            self._filters[key] = np.concatenate([[0.], p_filter2])
+        self.p_filter2 = self._filters[key]
+
+        # Seed noise buffer, allocated on first use.
+        self._noise = None
+
+    @property
+    def work_nbytes(self):
+        """Memory (in bytes) used by generate for a full batch: the seed noise,
+        its FFT, the filtered noise and the float32 output."""
+
+        nfft = self.nstep2 // 2 + 1
+        return self.batch * (2 * self.nstep2 * np.dtype(np.float64).itemsize
+                             + nfft * np.dtype(np.complex128).itemsize
+                             + self.ngroups * self.ampcols * self.amps * self.rows * np.dtype(np.float32).itemsize)
+
+    def generate(self, rngs, out=None):
+        """Generate the pink noise of len(rngs) integrations, one random stream each.
+
+        :param rngs: list of numpy.random.Generator, one per integration
+        :param out: array (len(rngs), ngroups, cols, rows) to fill, float32 if None
+        :return: out, the noise in DMS coordinates [electrons]
+        """
+
+        nint = len(rngs)
+        if out is None:
+            out = np.empty((nint, self.ngroups, self.ampcols * self.amps, self.rows), dtype=np.float32)
+        if (self._noise is None) or (len(self._noise) < nint):
+            self._noise = np.empty((nint, self.nstep2))
+        mynoise = self._noise[:nint]
+
+        # Generate seed noise
+        for k, rng in enumerate(rngs):
+            rng.standard_normal(out=mynoise[k])
+
+        # Save the mean and standard deviation of each seed. These are restored
+        # later. We do not subtract the mean here. This happens when we multiply
+        # the FFT by the pinkening filter which has no power at f=0.
+        the_mean = np.mean(mynoise, axis=1, keepdims=True)
+        the_std = np.std(mynoise, axis=1, keepdims=True)
+
+        # Apply the pinkening filter, to all integrations at once.
+        thefft = np.fft.rfft(mynoise, axis=1)
+        thefft *= self.p_filter2
+        result = np.fft.irfft(thefft, n=self.nstep2, axis=1)[:, :self.nstep]  # Keep 1st half of nstep
+        del thefft
+
+        # Restore the mean and standard deviation
+        result *= self.c_pink * the_std / np.std(result, axis=1, keepdims=True)
+        result -= np.mean(result, axis=1, keepdims=True)
+        result += self.c_pink * the_mean
+
+        # Reshape the time series into the subarray (detector coordinate system, not DMS yet)
+        tt = np.reshape(result, (nint, self.ngroups, self.rows + self.rows_over, self.ampcols + self.cols_over))
+        # Remove rows/cols overheads
+        tt = tt[:, :, :self.rows, :self.ampcols]
+        # Apply coordinate transform: detector --> DMS
+        tt = np.swapaxes(tt, 2, 3)
+        # Replicate this amp to the next amps, respecting the readout direction
+        # -->|<--|-->|<--
+        for amp in range(self.amps):
+            block = slice(amp * self.ampcols, (amp + 1) * self.ampcols)
+            out[:, :, block, :] = tt if amp % 2 == 0 else tt[:, :, ::-1, :]
+
+        return out
+
+    def add_to(self, data, entropy, integ_offset=0):
+        """Add pink noise to all integrations of data (nintegs, ngroups, cols, rows), in place.
+
+        :param data: array, the ramps [electrons]
+        :param entropy: int, entropy of the exposure seed sequence (see integration_rng)
+        :param integ_offset: int, index in the exposure of the first integration of data
+        """
+
+        nintegs = np.shape(data)[0]
+        buffer = np.empty((min(self.batch, nintegs),) + np.shape(data)[1:], dtype=np.float32)
+        for i0 in range(0, nintegs, self.batch):
+            i1 = min(i0 + self.batch, nintegs)
+            rngs = [integration_rng(entropy, 'oneoverf', integ_offset + i) for i in range(i0, i1)]
+            data[i0:i1] += self.generate(rngs, out=buffer[:i1 - i0])
+
+
+def add_1overf_ramp(ramp, rng, subarray, c_pink, alpha):
+    """Add correlated 1/f noise (pink noise) to an integration, in place."""
+
+    generator = PinkNoiseGenerator(subarray, np.shape(ramp)[0], c_pink=c_pink, alpha=alpha, batch=1)
+    ramp += generator.generate([rng])[0]
+
+    return ramp
+
+
+def _integration_noise_worker(shm_name, shape, integs, func, component, entropy, integ_offset, kwargs):
+    """Apply a per-integration noise function to some integrations of a ramp in shared memory."""
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    data = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    for i in integs:
+        data[i] = func(data[i], integration_rng(entropy, component, integ_offset + i), **kwargs)
+    # Release the view before closing the shared memory
+    del data
+    shm.close()
+
 
 def download_ref_files(noisefiles_path, fitsname,
                        crds_http='https://jwst-crds.stsci.edu/unchecked_get/references/jwst/'):
@@ -59,16 +278,32 @@ def download_ref_files(noisefiles_path, fitsname,
 
 class TimeSeries(object):
 
-    def __init__(self, ima_path, noisefiles_path, gain=1.6221, dark_value=0.0414, full_well=72000, ):
-        """Make a TimeSeries object from a series of synthetic images."""
+    def __init__(self, ima_path, noisefiles_path, gain=1.6221, dark_value=0.0414, full_well=72000,
+                 chunked=False, seed=None, ncpu=1):
+        """Make a TimeSeries object from a series of synthetic images.
+
+        With chunked=True the ramp is memory-mapped instead of loaded and
+        self.data is only filled block by block by process_chunked.
+
+        Random noise is drawn from an independent stream per integration and
+        noise component (see integration_rng), derived from seed. The same seed
+        reproduces any integration exactly, whatever ncpu or the block size.
+        With ncpu > 1 the integrations are processed by a pool of processes,
+        created once, and self.data is kept in shared memory so that the noise
+        steps work on it in place. Call close() (or use the TimeSeries as a
+        context manager) to release them.
+        """
 
         self.ima_path = ima_path
 
-        hdu_ideal = fits.open(ima_path)  # read in fits file
+        hdu_ideal = fits.open(ima_path, memmap=chunked)  # read in fits file
         header = hdu_ideal[1].header
 
         self.hdu_ideal = hdu_ideal
-        self.data = np.array(hdu_ideal[1].data, dtype=np.float64)  # image to be altered
+        if chunked:
+            self.data = None
+        else:
+            self.data = np.array(hdu_ideal[1].data, dtype=np.float64)  # image to be altered
 
         self.nrows = header['NAXIS1']
         self.ncols = header['NAXIS2']
@@ -79,6 +314,19 @@ class TimeSeries(object):
 
         self.modif_str = '_mod'  # string encoding the modifications
 
+        # Random streams of the noise components and parallel processing
+        self.seed_entropy = np.random.SeedSequence(seed).entropy
+        print('TimeSeries noise seed entropy: {:}'.format(self.seed_entropy))
+        self.ncpu = ncpu
+        self.integ_offset = 0  # index of the first integration of self.data in the exposure
+
+        # Reference arrays kept by process_chunked for all blocks, per (step, file)
+        self._references = None
+
+        # Pool of processes and shared memory backing self.data, when ncpu > 1
+        self._pool = None
+        self._shm = None
+
         # TODO: Handle paths properly.
         # Here, I hardcoded the path but really we should read it from the config file
         # /genesis/jwst/jwst-mtl-user/jwst-mtl_configpath.txt 
@@ -103,49 +351,132 @@ class TimeSeries(object):
         """Add Poisson noise to the simulation."""
 
         # Can be done without loops, but this reduces memory requirements.
-        for i in range(self.nintegs):
+        self._apply_per_integration('poisson', poisson_ramp)
 
-            ramp = deepcopy(self.data[i])
+        self.modif_str = self.modif_str + '_poisson_noise'
 
-            # Convert up the ramp samples, to flux between reads.
-            ramp[1:] = np.diff(ramp, axis=0)
+    def _apply_per_integration(self, component, func, **kwargs):
+        """Replace each integration self.data[i] by func(self.data[i], rng, **kwargs),
+        where rng is the random stream of that integration and noise component.
+        With ncpu > 1 the integrations are shared with a pool of processes."""
 
-            # Add the poisson noise.
-            ramp = np.where(ramp < 0, 0, ramp)  # Sanity check.
-            ramp = rdm.poisson(ramp)
+        if (self.ncpu <= 1) | (self.nintegs <= 1):
+            for i in range(self.nintegs):
+                rng = integration_rng(self.seed_entropy, component, self.integ_offset + i)
+                self.data[i] = func(self.data[i], rng, **kwargs)
+            return
 
-            # Convert back to up the ramp samples.
-            ramp = np.cumsum(ramp, axis=0)
+        self._share_data()
+        if self._pool is None:
+            self._pool = mp.Pool(processes=self.ncpu)
 
-            self.data[i] = deepcopy(ramp)
+        shape = np.shape(self.data)
+        chunks = np.array_split(np.arange(self.nintegs), min(self.ncpu, self.nintegs))
+        results = [self._pool.apply_async(_integration_noise_worker,
+                                          args=(self._shm.name, shape, chunk, func, component,
+                                                self.seed_entropy, self.integ_offset, kwargs))
+                   for chunk in chunks]
+        for result in results:
+            result.get()
 
-        self.modif_str = self.modif_str + '_poisson_noise'
+    def _shared_buffer(self, shape):
+        """Return a float64 array of the given shape at the start of the shared memory,
+        which is (re)allocated only if it is too small."""
 
-    def add_non_linearity(self, coef_file=None):
-        """Add non-linearity on top of the linear integration-long ramp."""
+        nbytes = int(np.prod(shape)) * np.dtype(np.float64).itemsize
+        if (self._shm is None) or (self._shm.size < nbytes):
+            self._release_shared()
+            self._shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+
+        return np.ndarray(shape, dtype=np.float64, buffer=self._shm.buf)
+
+    def _share_data(self):
+        """Move self.data to the shared memory, unless it is already there."""
+
+        if (self._shm is not None) and (self.data.ctypes.data == self._shm_address()):
+            return
+
+        data = self.data
+        self.data = None
+        self.data = self._shared_buffer(np.shape(data))
+        self.data[:] = data
+
+    def _shm_address(self):
+        """Address of the start of the shared memory."""
+
+        view = np.frombuffer(self._shm.buf, dtype=np.uint8)
+        address = view.ctypes.data
+        del view  # the shared memory can not be closed while a view exists
+
+        return address
+
+    def _release_shared(self):
+        """Free the shared memory. self.data must not be a view of it anymore."""
+
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def close(self):
+        """Stop the pool of processes and free the shared memory (self.data is kept as a copy)."""
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._shm is not None:
+            if self.data is not None:
+                self.data = np.array(self.data)
+            self._release_shared()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _reference(self, key, load):
+        """Return load(), the reference array(s) of a noise step. During process_chunked
+        they are read once, under key, and reused by all blocks of integrations."""
+
+        if self._references is None:
+            return load()
+        if key not in self._references:
+            self._references[key] = load()
+
+        return self._references[key]
+
+    def _nonlinearity_reference(self, coef_file=None):
+        """Coefficients (ncoeffs, ncols, nrows) of the non-linearity function on the subarray."""
 
         if coef_file is None:
             coef_file = 'jwst_niriss_linearity_0011_bounds_0_60000_npoints_100_deg_5.fits'
 
-        print('\tUsing {:} as the non-linearity coefficients reference file'.format(coef_file))
+        def load():
+            print('\tUsing {:} as the non-linearity coefficients reference file'.format(coef_file))
+
+            # Select the appropriate subarray.
+            if self.subarray == 'SUBSTRIP96':
+                slc = slice(1802, 1898)
+            elif self.subarray == 'SUBSTRIP256':
+                slc = slice(1792, 2048)
+            elif self.subarray == 'FULL':
+                slc = slice(0, 2048)
+            else:
+                raise ValueError('SUBARRAY must be one of SUBSTRIP96, SUBSTRIP256 or FULL')
 
-        # Read the coefficients of the non-linearity function.
-        with fits.open(self.noisefiles_dir+coef_file) as hdu:
-            non_linearity = hdu[0].data
+            # Read the coefficients of the non-linearity function.
+            with fits.open(self.noisefiles_dir+coef_file) as hdu:
+                return np.array(hdu[0].data[:, slc, :])
 
-        ncoeffs = non_linearity.shape[0]
+        return self._reference(('nonlinearity', coef_file), load)
 
-        # Select the appropriate subarray.
-        if self.subarray == 'SUBSTRIP96':
-            slc = slice(1802, 1898)
-        elif self.subarray == 'SUBSTRIP256':
-            slc = slice(1792, 2048)
-        elif self.subarray == 'FULL':
-            slc = slice(0, 2048)
-        else:
-            raise ValueError('SUBARRAY must be one of SUBSTRIP96, SUBSTRIP256 or FULL')
+    def add_non_linearity(self, coef_file=None):
+        """Add non-linearity on top of the linear integration-long ramp."""
 
-        non_linearity = non_linearity[:, slc, :]
+        non_linearity = self._nonlinearity_reference(coef_file)
+        ncoeffs = non_linearity.shape[0]
 
         # Add non-linearity to each ramp
         for i in range(self.nintegs):
@@ -205,12 +536,7 @@ class TimeSeries(object):
         # exactly a factor sqrt(2) higher readout noise in the final rateints images
         # TODO: use rms = 13.8903 / sqrt(2)
 
-        mynoise = np.random.standard_normal(np.size(self.data)) * rms / np.sqrt(2)
-        #print(np.std(mynoise))
-        mynoise = np.reshape(mynoise, (self.nintegs, self.ngroups, self.ncols, self.nrows))
-        #print(np.shape(mynoise))
-
-        self.data += np.copy(mynoise)
+        self._apply_per_integration('readout', add_readout_ramp, rms=rms)
 
         self.modif_str = self.modif_str + '_readnoise'
 
@@ -221,139 +547,59 @@ class TimeSeries(object):
         # c_pink = 9.6  # [electrons]
         # alpha = -1  # Hard code for 1/f noise until proven otherwise
 
-        # Select the appropriate subarray.
-        if self.subarray == 'SUBSTRIP96':
-            cols = 96
-            rows = 2048
-            cols_over = 12
-            rows_over = 2
-            amps = 1
-        elif self.subarray == 'SUBSTRIP256':
-            cols = 256
-            rows = 2048
-            cols_over = 12
-            rows_over = 2
-            amps = 1
-        elif self.subarray == 'FULL':
-            cols = 2048
-            rows = 2048
-            cols_over = 12
-            rows_over = 1
-            amps = 4
+        # Generate 1/f noise in small batches of integrations (so not to run out of memory)
+        if self.ncpu > 1:
+            self._apply_per_integration('oneoverf', add_1overf_ramp, subarray=self.subarray,
+                                        c_pink=c_pink, alpha=alpha)
         else:
-            raise ValueError('SUBARRAY must be one of SUBSTRIP96, SUBSTRIP256 or FULL')
-
-        # Generate 1/f noise on a per integration basis (so not to run out of memory)
-        tt = []
-        for nint in range(self.nintegs):
-
-            # naxis1 is in the detector orientation
-            #nstep = (cols // amps + cols_over) * (rows + rows_over) * self.ngroups * self.nintegs
-            nstep = (cols // amps + cols_over) * (rows + rows_over) * self.ngroups
-            # Pad nsteps to a power of 2, which is much faster (JML)
-            nstep2 = int(2 ** np.ceil(np.log2(nstep)))
-
-            # Define frequency arrays
-            f2 = np.fft.rfftfreq(nstep2)  # ... for 2*nstep elements
-
-            # Define pinkening filters. F2 and p_filter2 are used to generate 1/f noise.
-            p_filter2 = np.sqrt(f2 ** alpha)
-            p_filter2[0] = 0.
-            # Generate seed noise
-            mynoise = np.random.standard_normal(nstep2)
-
-            # Save the mean and standard deviation of the first
-            # half. These are restored later. We do not subtract the mean
-            # here. This happens when we multiply the FFT by the pinkening
-            # filter which has no power at f=0.
-            the_mean = np.mean(mynoise[:(2*nstep2) // 2])
-            the_std = np.std(mynoise[:(2*nstep2) // 2])
-
-            # Apply the pinkening filter.
-            thefft = np.fft.rfft(mynoise)
-            thefft = np.multiply(thefft, p_filter2)
-            result = np.fft.irfft(thefft)
-            result = result[:(2*nstep) // 2]  # Keep 1st half of nstep
+            generator = PinkNoiseGenerator(self.subarray, self.ngroups, c_pink=c_pink, alpha=alpha)
+            generator.add_to(self.data, self.seed_entropy, integ_offset=self.integ_offset)
 
-            # Restore the mean and standard deviation
-            result *= the_std / np.std(result)
-            result = result - np.mean(result) + the_mean
+        self.modif_str = self.modif_str + '_1overf'
 
-            tt_1_integ = c_pink * result  # tt_1_integ is a temp. variable
+    def _flatfield_reference(self, flatfile=None):
+        """Flat field (ncols, nrows) of the subarray."""
 
-            # tt is the full exposure temp. variable
-            tt.append(np.copy(tt_1_integ))
+        #TODO: Find the correct flatsss in CRDS
+        if flatfile is None:
+            if self.subarray == 'SUBSTRIP256': flatfile = 'jwst_niriss_flat_0190.fits'
+            elif self.subarray == 'SUBSTRIP96': flatfile = 'jwst_niriss_flat_0190.fits'
+            elif self.subarray == 'FULL': flatfile = 'jwst_niriss_flat_0190.fits'
+            else:
+                raise ValueError('SUBARRAY must be one of SUBSTRIP96, SUBSTRIP256 or FULL')
 
-        # CONvert list to np.array
-        tt = np.array(tt)
+        def load():
+            # Check that the ref file is on local disk and download if required
+            print('\tUsing {:} as the flat field reference file'.format(flatfile))
+            download_ref_files(self.noisefiles_dir, os.path.basename(flatfile))
 
-        # Reshape the time series into the subarray (detector coordinate system, not DMS yet)
-        if (self.subarray == 'SUBSTRIP96') | (self.subarray == 'SUBSTRIP256'):
-            # 3D, with rows and cols overheads
-            tt = np.reshape(tt, (self.nintegs, self.ngroups, rows + rows_over, cols + cols_over))
-            # Remove rows/cols overheads
-            tt = tt[:, :, :rows, :cols]
-            # Apply coordinate transform: detector --> DMS
-            tt = np.swapaxes(tt, 2, 3)
+            # Read the flat-field from file (in science coordinates).
+            with fits.open(self.noisefiles_dir+os.path.basename(flatfile)) as hdu:
+                flatfield = hdu[1].data
 
-        elif self.subarray == 'FULL':
-            # 3D, with rows and cols overheads
-            tt = np.reshape(tt, (self.nintegs, self.ngroups, rows + rows_over, cols // amps + cols_over))
-            # Remove rows/cols overheads to produce ninteg x ngroup x 2048 x 512 matrix
-            tt = tt[:, :, :rows, :cols // amps]
-            # Replicate this amp to the next 3 amps, respecting the readout direction
-            # -->|<--|-->|<--
-            temp = np.zeros((self.nintegs, self.ngroups, rows, cols))
-            fivehundredtwelve = cols // amps
-            temp[:, :, :, :fivehundredtwelve] = np.copy(tt)
-            temp[:, :, :, fivehundredtwelve:2*fivehundredtwelve] = np.copy(tt[:, :, :, ::-1])
-            temp[:, :, :, 2*fivehundredtwelve:3*fivehundredtwelve] = np.copy(tt)
-            temp[:, :, :, 3*fivehundredtwelve:4*fivehundredtwelve] = np.copy(tt[:, :, :, ::-1])
-            tt = np.copy(temp)
-            del temp
-            # Apply coordinate transform: detector --> DMS
-            tt = np.swapaxes(tt, 2, 3)
-        else:
-            raise ValueError('SUBARRAY must be one of SUBSTRIP96, SUBSTRIP256 or FULL')
+                # As of Nov 1 2021, the flat ref files 0190 is a 2048x2048 file, so need to
+                # pick the subarray here
+                # TODO: Update this once the CRDS have a separate reference file for the different subarrays
+                if self.subarray == 'SUBSTRIP256': flatfield = flatfield[2048-256:2048,:]
+                elif self.subarray == 'SUBSTRIP96': flatfield = flatfield[2048-106:2048-10,:]
 
-        self.data += deepcopy(tt)
+                return np.array(flatfield)
 
-        self.modif_str = self.modif_str + '_1overf'
+        return self._reference(('flatfield', flatfile), load)
 
     def apply_flatfield(self, flatfile=None):
         """Apply the flat field correction to the simulation."""
 
-        #TODO: Find the correct flatsss in CRDS
-        if flatfile is None:
-            if self.subarray == 'SUBSTRIP256': flatfile = 'jwst_niriss_flat_0190.fits'
-            elif self.subarray == 'SUBSTRIP96': flatfile = 'jwst_niriss_flat_0190.fits'
-            elif self.subarray == 'FULL': flatfile = 'jwst_niriss_flat_0190.fits'
-            else:
-                raise ValueError('SUBARRAY must be one of SUBSTRIP96, SUBSTRIP256 or FULL')
-        # Check that the ref file is on local disk and download if required
-        print('\tUsing {:} as the flat field reference file'.format(flatfile))
-        download_ref_files(self.noisefiles_dir, os.path.basename(flatfile))
-        # Complete full path
-        flatfile = self.noisefiles_dir+os.path.basename(flatfile)
-
-        # Read the flat-field from file (in science coordinates).
-        with fits.open(flatfile) as hdu:
-            flatfield = hdu[1].data
-
-        # As of Nov 1 2021, the flat ref files 0190 is a 2048x2048 file, so need to
-        # pick the subarray here
-        # TODO: Update this once the CRDS have a separate reference file for the different subarrays
-        if self.subarray == 'SUBSTRIP256': flatfield = flatfield[2048-256:2048,:]
-        elif self.subarray == 'SUBSTRIP96': flatfield = flatfield[2048-106:2048-10,:]
+        flatfield = self._flatfield_reference(flatfile)
 
         # Apply the flatfield to the simulation.
-        self.data = self.data * flatfield
+        self.data *= flatfield
 
         # Append that step to the filename.
         self.modif_str = self.modif_str + '_flat'
 
-    def add_superbias(self, biasfile=None):
-        """Add the bias level to the simulation."""
+    def _superbias_reference(self, biasfile=None):
+        """Super bias (ncols, nrows) of the subarray [electrons]."""
 
         if biasfile is None:
             if self.subarray == 'SUBSTRIP256': biasfile = 'jwst_niriss_superbias_0120.fits'
@@ -362,15 +608,23 @@ class TimeSeries(object):
             else:
                 raise ValueError('SUBARRAY must be one of SUBSTRIP96, SUBSTRIP256 or FULL')
 
-        # Check that the ref file is on local disk and download if required
-        print('\tUsing {:} as the super bias reference file'.format(biasfile))
-        download_ref_files(self.noisefiles_dir, os.path.basename(biasfile))
-        # Complete full path
-        biasfile = self.noisefiles_dir+os.path.basename(biasfile)
+        def load():
+            # Check that the ref file is on local disk and download if required
+            print('\tUsing {:} as the super bias reference file'.format(biasfile))
+            download_ref_files(self.noisefiles_dir, os.path.basename(biasfile))
+
+            # Read the flat-field from file (in science coordinates).
+            with fits.open(self.noisefiles_dir+os.path.basename(biasfile)) as hdu:
+                superbias = hdu[1].data #ADU
+
+                return superbias*self.gain  # [electrons]
+
+        return self._reference(('superbias', biasfile), load)
+
+    def add_superbias(self, biasfile=None):
+        """Add the bias level to the simulation."""
 
-        # Read the flat-field from file (in science coordinates).
-        with fits.open(biasfile) as hdu:
-            superbias = hdu[1].data #ADU
+        superbias = self._superbias_reference(biasfile)
 
         # TODO: superbias reference file should have its reference pixels not set to zero
         if False:
@@ -388,10 +642,8 @@ class TimeSeries(object):
                 superbias[2044:2048, :] =+ 10000
                 superbias[0:4, :] =+ 10000
 
-        superbias = superbias*self.gain  # [electrons]
-
         # Add the bias level to the simulation.
-        self.data = self.data + superbias
+        self.data += superbias
 
         # Append that step to the filename.
         self.modif_str = self.modif_str + '_bias'
@@ -411,92 +663,71 @@ class TimeSeries(object):
             dark = rdm.poisson(self.dark_value*self.tgroup, size=self.data.shape).astype('float32')  # [electrons]
             darkramp = np.cumsum(dark, axis=1)
 
+        darkframe = self._dark_reference(darkfile)
+
+        # Copy the dark frame to all groups of all integrations,
+        # then add Poisson noise to it, one integration at a time.
+        self._apply_per_integration('dark', add_dark_ramp, darkframe=darkframe)
+
+        # Append that step to the filename.
+        self.modif_str = self.modif_str + '_dark'
+
+    def _dark_reference(self, darkfile=None):
+        """Frame ngroups (ncols, nrows) of the dark ramp of the subarray [electrons]."""
+
         if darkfile is None:
             if self.subarray == 'SUBSTRIP256': darkfile = 'jwst_niriss_dark_0147.fits'
             elif self.subarray == 'SUBSTRIP96': darkfile = 'jwst_niriss_dark_0150.fits'
             elif self.subarray == 'FULL': darkfile = 'jwst_niriss_dark_0145.fits'
             else:
                 raise ValueError('SUBARRAY must be one of SUBSTRIP96, SUBSTRIP256 or FULL')
-        # Check that the ref file is on local disk and download if required
-        print('\tUsing {:} as the dark reference file'.format(darkfile))
-        download_ref_files(self.noisefiles_dir, os.path.basename(darkfile))
-        # Complete full path
-        darkfile = self.noisefiles_dir+os.path.basename(darkfile)
-
-        # Read the flat-field from file (in science coordinates).
-        with fits.open(darkfile) as hdu:
-            darkramp = hdu[1].data #ADU
-
-        # Convert dark current to electrons
-        darkramp = darkramp * self.gain  # [electrons]
-
-        # Initialize the dark exposure
-        dark_exposure = np.zeros((self.nintegs, self.ngroups, self.ncols, self.nrows))
-        # Take one 3D ramp of the dark and copy it to all integrations
-        dark_exposure[:][:, :, :] = darkramp[self.ngroups, :, :]
-
-        # Add Poisson noise to the dark exposure
-        # Can be done without loops, but this reduces memory requirements.
-        for i in range(self.nintegs):
+        def load():
+            # Check that the ref file is on local disk and download if required
+            print('\tUsing {:} as the dark reference file'.format(darkfile))
+            download_ref_files(self.noisefiles_dir, os.path.basename(darkfile))
 
-            ramp = deepcopy(dark_exposure[i])
+            # Read the flat-field from file (in science coordinates).
+            with fits.open(self.noisefiles_dir+os.path.basename(darkfile)) as hdu:
+                # Only one frame of the dark is used, convert it to electrons
+                return hdu[1].data[self.ngroups, :, :] * self.gain  # [electrons]
 
-            # Convert up the ramp samples, to flux between reads.
-            ramp[1:] = np.diff(ramp, axis=0)
+        return self._reference(('dark', darkfile), load)
 
-            # Add the poisson noise.
-            ramp = np.where(ramp < 0, 0, ramp)  # Sanity check.
-            ramp = rdm.poisson(ramp)
+    def _zodiacal_reference(self, zodifile=None):
+        """Zodiacal background (ngroups, ncols, nrows) of the subarray, per group [electrons]."""
 
-            # Convert back to up the ramp samples.
-            ramp = np.cumsum(ramp, axis=0)
+        if zodifile is None:
+            zodifile = self.noisefiles_dir+'background_detectorfield_normalized.fits'
 
-            dark_exposure[i] = deepcopy(ramp)
+        def load():
+            # Select the appropriate subarray.
+            if self.subarray == 'SUBSTRIP96':
+                slc = slice(1802, 1898)
+            elif self.subarray == 'SUBSTRIP256':
+                slc = slice(1792, 2048)
+            elif self.subarray == 'FULL':
+                slc = slice(0, 2048)
+            else:
+                raise ValueError('SUBARRAY must be one of SUBSTRIP96, SUBSTRIP256 or FULL')
 
-        # Add the dark+noise to the simulation.
-        self.data = self.data + dark_exposure
+            # Read the background file.
+            with fits.open(self.noisefiles_dir+os.path.basename(zodifile)) as hdu:
+                subzodi = hdu[0].data[slc, :]  # [electrons/s]
 
-        # Free memory
-        del dark_exposure
+                # Scale to the exposure time, and match shape to integrations.
+                subzodi = subzodi*self.tgroup  # [electrons]
+                return np.tile(subzodi[np.newaxis, :, :], (self.ngroups, 1, 1))
 
-        # Append that step to the filename.
-        self.modif_str = self.modif_str + '_dark'
+        return self._reference(('zodiacal', zodifile), load)
 
     def add_zodiacal_background(self, zodifile=None):
         """Add the zodiacal background signal to the simulation."""
 
-        if zodifile is None:
-            zodifile = self.noisefiles_dir+'background_detectorfield_normalized.fits'
-
-        # Read the background file.
-        with fits.open(self.noisefiles_dir+os.path.basename(zodifile)) as hdu:
-            zodiimage = hdu[0].data  # [electrons/s]
-
-        # Select the appropriate subarray.
-        if self.subarray == 'SUBSTRIP96':
-            slc = slice(1802, 1898)
-        elif self.subarray == 'SUBSTRIP256':
-            slc = slice(1792, 2048)
-        elif self.subarray == 'FULL':
-            slc = slice(0, 2048)
-        else:
-            raise ValueError('SUBARRAY must be one of SUBSTRIP96, SUBSTRIP256 or FULL')
-
-        subzodi = zodiimage[slc, :]
-
-        # Scale to the exposure time, and match shape to integrations.
-        subzodi = subzodi*self.tgroup  # [electrons]
-        subzodi = np.tile(subzodi[np.newaxis, :, :], (self.ngroups, 1, 1))
+        subzodi = self._zodiacal_reference(zodifile)
 
         #TODO: Check that the poisson noise for zodi background is done right, see dark for reference
-        for i in range(self.nintegs):
-
-            # Add poisson noise, and convert to up the ramp samples.
-            zodiramp = rdm.poisson(subzodi)
-            zodiramp = np.cumsum(zodiramp, axis=0)
-
-            # Add the background ramps to the simulation.
-            self.data[i] = self.data[i] + zodiramp
+        # Add poisson noise, convert to up the ramp samples and add to each integration.
+        self._apply_per_integration('zodibackg', add_zodiacal_ramp, subzodi=subzodi)
 
         self.modif_str = self.modif_str + '_zodibackg'
 
@@ -511,7 +742,19 @@ class TimeSeries(object):
         # qqchose comme ca
         #self.data = crsim(self.data, bla bla)
         # pas ca: addCRs2Exposure.run(f, 'SUNMIN', OutputDir)
+        pass
+
 
+    def _output_filename(self, filename=None):
+        """Forge the output file name from the input name and the applied steps if none is given."""
+
+        if filename is None:
+            print('Forging output noisy file...')
+            dir_and_filename, suffix = os.path.splitext(self.ima_path)
+            #filename = self.output_path +os.path.basename(self.ima_path) + self.modif_str + '.fits'
+            filename = dir_and_filename + self.modif_str + '.fits'
+
+        return filename
 
     def write_to_fits(self, filename=None):
         """Write to a .fits file the new header and data.
@@ -522,15 +765,150 @@ class TimeSeries(object):
         #hdu_new[1].data = (self.data/self.gain).astype('int16')  # Convert to ADU in 16 bit integers.
         hdu_new[1].data = (self.data / self.gain).astype('float32')  # Convert to ADU in 16 bit integers.
 
-        if filename is None:
-            print('Forging output noisy file...')
-            dir_and_filename, suffix = os.path.splitext(self.ima_path)
-            #filename = self.output_path +os.path.basename(self.ima_path) + self.modif_str + '.fits'
-            filename = dir_and_filename + self.modif_str + '.fits'
+        filename = self._output_filename(filename)
 
         print('Writing to file: ' + filename)
         hdu_new.writeto(filename, overwrite=True)
 
+    # Noise steps that read reference files, and the method returning their reference array
+    REFERENCE_STEPS = {'add_zodiacal_background': '_zodiacal_reference',
+                       'apply_flatfield': '_flatfield_reference',
+                       'add_dark': '_dark_reference',
+                       'add_non_linearity': '_nonlinearity_reference',
+                       'add_superbias': '_superbias_reference'}
+
+    def _chunk_size(self, noise_chain, memory_budget):
+        """Number of integrations per block of process_chunked that fits in memory_budget.
+
+        Counts the block-sized working copies made by the noise steps (CHUNK_COPIES),
+        the per-integration temporaries of each process, the reference arrays (see REFERENCE_STEPS),
+        which must already be loaded, and the work buffers of the 1/f noise.
+
+        :param noise_chain: list of (method name, keyword arguments) pairs, see process_chunked
+        :param memory_budget: float, memory (in bytes) allowed
+        :return: int, number of integrations per block
+        """
+
+        integ_bytes = self.ngroups * self.ncols * self.nrows * np.dtype(np.float64).itemsize
+
+        # Memory used whatever the block size
+        fixed_bytes = sum(np.asarray(ref).nbytes for ref in self._references.values())
+        fixed_bytes += CHUNK_COPIES * max(self.ncpu, 1) * integ_bytes
+        if 'add_1overf_noise' in [method_name for method_name, kwargs in noise_chain]:
+            generator = PinkNoiseGenerator(self.subarray, self.ngroups, batch=1 if self.ncpu > 1 else 4)
+            fixed_bytes += max(self.ncpu, 1) * generator.work_nbytes
+
+        # Memory used per integration of the block
+        nblock = int((memory_budget - fixed_bytes) // (CHUNK_COPIES * integ_bytes))
+        if nblock < 1:
+            print('Warning: memory_budget={:.3g} bytes is too small, processing one integration at a time '
+                  '(about {:.3g} bytes).'.format(memory_budget, fixed_bytes + CHUNK_COPIES * integ_bytes))
+
+        return int(np.clip(nblock, 1, self.nintegs))
+
+    def process_chunked(self, noise_chain, filename=None, memory_budget=4e9):
+        """Apply a chain of noise steps to blocks of integrations and write each
+        block straight into the output file, so that the full ramp is never in memory.
+        Requires a TimeSeries created with chunked=True.
+
+        The reference files of the noise steps are read once, before the first
+        block, and kept for all blocks.
+
+        :param noise_chain: list of (method name, keyword arguments) pairs applied
+            in that order to each block, e.g. [('add_poisson_noise', {}),
+            ('apply_flatfield', {'flatfile': 'jwst_niriss_flat_0190.fits'})]
+        :param filename: output file name. Forged from the input name if None (see write_to_fits).
+        :param memory_budget: memory (in bytes) allowed for the processing, including
+            the reference arrays (see _chunk_size).
+
+        :type noise_chain: list[tuple(str, dict)]
+        :type filename: str
+        :type memory_budget: float
+        """
+
+        nintegs = self.nintegs
+        modif_str = self.modif_str
+
+        # Read the reference files once for all blocks
+        self._references = {}
+        for method_name, kwargs in noise_chain:
+            if method_name in self.REFERENCE_STEPS:
+                getattr(self, self.REFERENCE_STEPS[method_name])(**kwargs)
+
+        # Number of integrations per block
+        nblock = self._chunk_size(noise_chain, memory_budget)
+        print('Processing {:} integrations in blocks of {:}'.format(nintegs, nblock))
+
+        # One buffer for all blocks, in shared memory if the integrations are
+        # shared with a pool of processes
+        block_shape = (nblock, self.ngroups, self.ncols, self.nrows)
+        if self.ncpu > 1:
+            block = self._shared_buffer(block_shape)
+        else:
+            block = np.empty(block_shape, dtype=np.float64)
+
+        output = None
+        try:
+            for i0 in range(0, nintegs, nblock):
+                i1 = min(i0 + nblock, nintegs)
+
+                # Read only this block from the memory-mapped input
+                self.data = block[:i1 - i0]
+                self.data[:] = self.hdu_ideal[1].data[i0:i1]
+                self.nintegs = i1 - i0
+                self.integ_offset = i0
+                self.modif_str = modif_str
+
+                for method_name, kwargs in noise_chain:
+                    getattr(self, method_name)(**kwargs)
+
+                # The output name depends on the applied steps, open it after the first block
+                if output is None:
+                    filename = self._output_filename(filename)
+                    print('Writing to file: ' + filename)
+                    output = self._open_chunked_output(filename, nintegs)
+
+                output.write(np.asarray(self.data / self.gain, dtype='>f4'))  # Convert to ADU
+
+            output.close()
+            self._append_extensions(filename)
+        except BaseException:
+            if output is not None:
+                output.close()
+            raise
+        finally:
+            self.nintegs = nintegs
+            self.integ_offset = 0
+            self.data = None
+            del block
+            self._references = None
+
+    def _open_chunked_output(self, filename, nintegs):
+        """Write the primary header and the header of a float32 SCI extension of the
+        full ramp size, and return a stream to which blocks of integrations are appended."""
+
+        self.hdu_ideal[0].writeto(filename, overwrite=True)
+
+        header = self.hdu_ideal[1].header.copy()
+        for key in ('BZERO', 'BSCALE'):
+            header.remove(key, ignore_missing=True)
+        header['BITPIX'] = -32
+        header['NAXIS4'] = nintegs
+
+        # Appended as an extension since the file exists
+        return fits.StreamingHDU(filename, header)
+
+    def _append_extensions(self, filename):
+        """Copy the extensions of the input that follow the SCI extension to the
+        output of process_chunked, as write_to_fits does."""
+
+        if len(self.hdu_ideal) <= 2:
+            return
+
+        with fits.open(filename, mode='append') as hdulist:
+            for hdu in self.hdu_ideal[2:]:
+                hdulist.append(hdu.copy())
+
     def plot_image(self, i_group=0, i_integ=0, log=False, reverse_y=True, save=False, filename=None):
         """Plot the detector image for a chosen frame."""
 
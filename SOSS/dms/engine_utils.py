@@ -2,11 +2,14 @@
 # -*- coding: utf-8 -*-
 
 # General imports.
+import os
+import hashlib
+from collections import OrderedDict
 import numpy as np
 from warnings import warn
 from scipy.integrate import AccuracyWarning
-from scipy.sparse import find, diags, identity, csr_matrix
-from scipy.sparse.linalg import spsolve
+from scipy.sparse import find, diags, identity, csr_matrix, save_npz, load_npz
+from scipy.sparse.linalg import splu
 from scipy.interpolate import interp1d, RectBivariateSpline
 
 # Plotting.
@@ -716,6 +719,10 @@ class WebbKernel:  # TODO could probably be cleaned-up somewhat, may need furthe
         :type fill_value: str
         """
 
+        # Content hash of the inputs, used to cache the convolution matrices.
+        self.checksum = array_checksum(wave_kernels, kernels, wave_map, n_os, n_pix,
+                                       bounds_error, fill_value)
+
         # Mask where wv_map is equal to 0
         wave_map = np.ma.array(wave_map, mask=(wave_map == 0))
 
@@ -1359,6 +1366,112 @@ def get_c_matrix(kernel, grid, bounds=None, i_bounds=None, norm=True,
     return kernel
 
 
+# In-process cache of the convolution matrices (least recently used first).
+C_MATRIX_CACHE = OrderedDict()
+C_MATRIX_CACHE_SIZE = 32
+
+# Directory of the on-disk cache of the convolution matrices. Not used if None.
+C_MATRIX_CACHE_DIR = os.environ.get('SOSS_C_MATRIX_CACHE')
+
+
+def array_checksum(*args):
+    """Return a content hash (sha1 hex digest) of arrays and other values.
+
+    :param args: Arrays (hashed with their shape and dtype) or values with a
+        stable repr (numbers, strings, tuples, None).
+
+    :returns: checksum - the hex digest.
+    :rtype: str
+    """
+
+    sha1 = hashlib.sha1()
+    for arg in args:
+
+        if isinstance(arg, np.ndarray):
+            arg = np.ascontiguousarray(arg)
+            sha1.update(repr((arg.shape, arg.dtype.str)).encode())
+            sha1.update(arg.tobytes())
+        else:
+            sha1.update(repr(arg).encode())
+
+    return sha1.hexdigest()
+
+
+def get_c_matrix_cached(kernel, grid, i_bounds=None, cache_dir=None, **kwargs):
+    """Same as get_c_matrix (sparse output), but cached in memory (LRU) and on
+    disk as a scipy sparse .npz file. The key is a hash of the kernel content
+    (arrays or the `checksum` attribute of a kernel object like WebbKernel),
+    the grid, the bounds and all the keyword arguments (n_os, thresh, ...).
+    Kernels without a content hash (arbitrary callables) are not cached.
+
+    :param kernel: Convolution kernel, see get_c_matrix.
+    :param grid: The grid on which the convolution will be applied.
+    :param i_bounds: Index bounds of the convolved grid, see get_c_matrix.
+    :param cache_dir: Directory of the on-disk cache. Default is
+        C_MATRIX_CACHE_DIR (set with the SOSS_C_MATRIX_CACHE environment
+        variable), no on-disk cache if None.
+    :param kwargs: Other arguments passed to get_c_matrix.
+
+    :type kernel: array[float] or callable
+    :type grid: array[float]
+    :type i_bounds: List[int]
+    :type cache_dir: str
+
+    :returns: c_matrix - the sparse convolution matrix (N_k_convolved, N_k).
+    :rtype: scipy.sparse.csr_matrix
+    """
+
+    if cache_dir is None:
+        cache_dir = C_MATRIX_CACHE_DIR
+
+    # Content hash of the kernel.
+    if isinstance(kernel, np.ndarray):
+        kernel_sum = array_checksum(kernel)
+    else:
+        kernel_sum = getattr(kernel, 'checksum', None)
+
+    # Only the sparse matrix of a kernel with a content hash is cached.
+    if kernel_sum is None or not kwargs.get('sparse', True):
+        return get_c_matrix(kernel, grid, i_bounds=i_bounds, **kwargs)
+
+    if i_bounds is not None:
+        i_bounds = [int(i_bnd) for i_bnd in i_bounds]
+
+    # Keyword arguments as separate items so that arrays are fully hashed.
+    items = [item for key_val in sorted(kwargs.items()) for item in key_val]
+    key = array_checksum(kernel_sum, np.asarray(grid, dtype=float), i_bounds, *items)
+
+    # In-process cache.
+    if key in C_MATRIX_CACHE:
+        C_MATRIX_CACHE.move_to_end(key)
+        return C_MATRIX_CACHE[key].copy()
+
+    # On-disk cache, compute if not found.
+    filename = None
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, 'c_matrix_{}.npz'.format(key))
+
+    if filename is not None and os.path.isfile(filename):
+        c_matrix = load_npz(filename).tocsr()
+    else:
+        c_matrix = csr_matrix(get_c_matrix(kernel, grid, i_bounds=i_bounds, **kwargs))
+
+        if filename is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+            # Write to a temporary file first so that other processes never
+            # read a partial file.
+            tmpname = '{}.{}.npz'.format(filename[:-4], os.getpid())
+            save_npz(tmpname, c_matrix)
+            os.replace(tmpname, filename)
+
+    C_MATRIX_CACHE[key] = c_matrix
+    if len(C_MATRIX_CACHE) > C_MATRIX_CACHE_SIZE:
+        C_MATRIX_CACHE.popitem(last=False)
+
+    return c_matrix.copy()
+
+
 class NyquistKer:
     """
     Define a gaussian convolution kernel at the nyquist
@@ -1602,6 +1715,12 @@ class Tikhonov:
     the equation and aim to minimize the equation:
     ||A.x - b||^2 + ||gamma.x||^2
     Where gamma is the Tikhonov regularisation matrix.
+
+    A_T.A, gamma_T.gamma and A_T.b do not depend on the scale factor of
+    gamma, so they are computed once and reused for all the factors solved
+    with the same object. The fill-reducing ordering of the first
+    factorization is also reused, so the following factors only need a
+    numeric factorization.
     """
     default_mat = {'zeroth': finite_zeroth_d,
                    'first': finite_first_d,
@@ -1653,6 +1772,11 @@ class Tikhonov:
         self.verbose = verbose
         self.test = None
 
+        # Normal system (A_T.A, gamma_T.gamma, A_T.b) and ordering of the
+        # factorization. Computed when needed.
+        self._normal = None
+        self._order = None
+
         return
 
     def verbose_print(self, *args, **kwargs):
@@ -1680,25 +1804,60 @@ class Tikhonov:
         ------
         Solution of the system (1d array)
         """
-        # Get needed attributes
-        a_mat = self.a_mat
-        b_vec = self.b_vec
-        index = self.index
+        # Get the factor independent terms of the system
+        a_2, t_2, a_b = self._get_normal_system()
 
-        # Matrix gamma (with scale factor)
-        gamma = factor * self.t_mat
-
-        # Build system
-        gamma_2 = (gamma.T).dot(gamma)  # Gamma square
-        matrix = a_mat.T.dot(a_mat) + gamma_2
-        result = (a_mat.T).dot(b_vec.T)
+        # Build system, (factor * gamma)_T.(factor * gamma) = factor^2 * t_2
+        gamma_2 = factor ** 2 * t_2
+        matrix = (a_2 + gamma_2).tocsc()
+        result = a_b.copy()
 
         # Include solution estimate if given
         if estimate is not None:
-            result += gamma_2.dot(estimate[index].T)
+            result += gamma_2.dot(estimate[self.index].T)
 
         # Solve
-        return spsolve(matrix, result)
+        return self._solve_direct(matrix, result)
+
+    def _get_normal_system(self):
+        """Compute (once) A_T.A, t_mat_T.t_mat and A_T.b"""
+
+        if self._normal is None:
+            a_mat = csr_matrix(self.a_mat)
+            t_mat = csr_matrix(self.t_mat)
+            a_2 = (a_mat.T).dot(a_mat).tocsc()
+            t_2 = (t_mat.T).dot(t_mat).tocsc()
+            a_b = np.asarray((a_mat.T).dot(self.b_vec.T), dtype=float)
+            self._normal = (a_2, t_2, a_b)
+
+        return self._normal
+
+    def _solve_direct(self, matrix, result):
+        """
+        Solve with a sparse LU factorization. The system is symmetric
+        positive definite, so the column ordering found for the first
+        factor is applied symmetrically to the next ones and only the
+        numeric factorization is redone.
+        """
+
+        lu_kwargs = {'diag_pivot_thresh': 0.,
+                     'options': {'SymmetricMode': True}}
+
+        # First factor: compute the fill-reducing ordering
+        if self._order is None:
+            lu_fac = splu(matrix, permc_spec='MMD_AT_PLUS_A', **lu_kwargs)
+            self._order = np.argsort(lu_fac.perm_c)
+
+            return lu_fac.solve(result)
+
+        # Next factors: permute with the same ordering and keep it
+        order = self._order
+        lu_fac = splu(matrix[order, :][:, order].tocsc(),
+                      permc_spec='NATURAL', **lu_kwargs)
+        sln = np.empty_like(result)
+        sln[order] = lu_fac.solve(result[order])
+
+        return sln
 
     def test_factors(self, factors, estimate=None):
         """
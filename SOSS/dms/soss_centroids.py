@@ -138,8 +138,8 @@ def center_of_mass(column, ypos, halfwidth):
     ypix = np.arange(dimy)
 
     # Find the indices of the window.
-    miny = np.int(np.fmax(np.around(ypos - halfwidth), 0))
-    maxy = np.int(np.fmin(np.around(ypos + halfwidth + 1), dimy))
+    miny = int(np.fmax(np.around(ypos - halfwidth), 0))
+    maxy = int(np.fmin(np.around(ypos + halfwidth + 1), dimy))
 
     # Compute the center of mass on the window.
     with np.errstate(invalid='ignore'):
@@ -148,6 +148,125 @@ def center_of_mass(column, ypos, halfwidth):
     return ycom
 
 
+def center_of_mass_columns(image, ypos, halfwidth):
+    """Compute a windowed center-of-mass along all columns at once, same as
+    center_of_mass applied to each column. A NaN position uses the full column.
+
+    :param image: The image(s) on which to compute the windowed center of mass,
+        shape (dimy, dimx) or (nints, dimy, dimx).
+    :param ypos: The position along each column to center the window on,
+        shape (dimx,) or (nints, dimx).
+    :param halfwidth: The half-size of the window in pixels.
+
+    :type image: array[float]
+    :type ypos: array[float]
+    :type halfwidth: int
+
+    :returns: ycom - the center-of-mass of the pixels within the window of each column.
+    :rtype: array[float]
+    """
+
+    dimy = image.shape[-2]
+    ypix = np.arange(dimy)[:, np.newaxis]
+
+    # Find the window of each column (fmax and fmin ignore NaNs).
+    miny = np.fmax(np.around(ypos - halfwidth), 0)[..., np.newaxis, :]
+    maxy = np.fmin(np.around(ypos + halfwidth + 1), dimy)[..., np.newaxis, :]
+    window = (ypix >= miny) & (ypix < maxy)
+
+    # Compute the center of mass on the windows.
+    image_window = np.where(window, image, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ycom = np.nansum(image_window*ypix, axis=-2)/np.nansum(image_window, axis=-2)
+
+    return ycom
+
+
+def _com_trace(image_masked, yos, ynative):
+    """Three pass center-of-mass y-positions of the trace for one or more images
+    (see get_centroids_com), all columns and images at once.
+
+    :param image_masked: The image(s) with masked pixels set to NaN,
+        shape (dimy, dimx) or (nints, dimy, dimx).
+    :param yos: The oversampling factor along the y-direction.
+    :param ynative: The native size of the y-axis.
+
+    :type image_masked: array[float]
+    :type yos: int
+    :type ynative: int
+
+    :returns: ytrace - the y-position of the trace in each column.
+    :rtype: array[float]
+    """
+
+    dimy = image_masked.shape[-2]
+
+    with warnings.catch_warnings():
+        # All NaN columns give NaN positions.
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        # Compute and subtract the background level of each column.
+        col_bkg = np.nanpercentile(image_masked, 10, axis=-2)
+        image_masked_bkg = image_masked - col_bkg[..., np.newaxis, :]
+
+        # Find centroid - first pass, use all pixels in the column.
+        # Normalize each column
+        with np.errstate(invalid='ignore'):
+            image_norm = image_masked_bkg / np.nanmax(image_masked_bkg, axis=-2)[..., np.newaxis, :]
+
+        # CoM analysis to find initial positions using all rows.
+        ypix = np.arange(dimy)[:, np.newaxis]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ytrace = np.nansum(image_norm*ypix, axis=-2)/np.nansum(image_norm, axis=-2)
+
+        # Second pass - use a windowed CoM at the previous position.
+        halfwidth = 30 * yos
+        ycom = center_of_mass_columns(image_norm, ytrace, halfwidth)
+
+        # If the pixel at the centroid is below the local mean we are likely mid-way between orders and
+        # we should shift the window downward to get a reliable centroid for order 1.
+        valid = np.isfinite(ycom)
+        irow = np.where(valid, np.around(ycom), 0).astype(int)
+        miny = np.fmax(irow - halfwidth, 0)[..., np.newaxis, :]
+        maxy = np.fmin(irow + halfwidth + 1, dimy)[..., np.newaxis, :]
+        local_mean = np.nanmean(np.where((ypix >= miny) & (ypix < maxy), image_norm, np.nan), axis=-2)
+        pixel = np.take_along_axis(image_norm, irow[..., np.newaxis, :], axis=-2)[..., 0, :]
+        shift = valid & (pixel < local_mean)
+        ycom = np.where(shift, center_of_mass_columns(image_norm, ycom - halfwidth, halfwidth), ycom)
+
+        # If NaN was returned or the position is too close to the array edge, use NaN.
+        with np.errstate(invalid='ignore'):
+            bad = ~np.isfinite(ycom) | (ycom <= 5 * yos) | (ycom >= (ynative - 6) * yos)
+        ytrace = np.where(bad, np.nan, ycom)
+
+        # Third pass - fine tuning using a smaller window.
+        halfwidth = 16 * yos
+        ytrace = center_of_mass_columns(image_norm, ytrace, halfwidth)
+
+    return ytrace
+
+
+def _fit_trace(ytrace, dimx, xos, padding, poly_order):
+    """Fit the y-positions with a polynomial, see get_centroids_com."""
+
+    # Fit the y-positions with a polynomial and use the result as the true y-positions.
+    xtrace = np.arange(dimx)
+    mask = np.isfinite(ytrace)
+
+    # For padded arrays ignore padding for consistency with real data
+    if padding != 0:
+        mask = mask & (xtrace >= xos*padding) & (xtrace < (dimx - xos*padding))
+
+    # If no polynomial order was given return the raw measurements.
+    if poly_order is None:
+        param = []
+    else:
+        param = robust_polyfit(xtrace[mask], ytrace[mask], poly_order)
+        ytrace = np.polyval(param, xtrace)
+
+    return xtrace, ytrace, param
+
+
 def get_centroids_com(image, header=None, mask=None, poly_order=11, verbose=False):
     """Determine the x, y coordinates of the trace using a center-of-mass analysis.
     Works for either order if there is no contamination, or for order 1 on a detector
@@ -181,77 +300,74 @@ def get_centroids_com(image, header=None, mask=None, poly_order=11, verbose=Fals
     # Replace masked pixel values with NaNs.
     image_masked = np.where(mask | ~refpix_mask, np.nan, image)
 
-    # Compute and subtract the background level of each column.
-    col_bkg = np.nanpercentile(image_masked, 10, axis=0)
-    image_masked_bkg = image_masked - col_bkg
+    # Find the y-positions with a center-of-mass analysis of all columns.
+    ytrace = _com_trace(image_masked, yos, ynative)
 
-    # Find centroid - first pass, use all pixels in the column.
-    # Normalize each column
-    with np.errstate(invalid='ignore'):
-        image_norm = image_masked_bkg / np.nanmax(image_masked_bkg, axis=0)
+    # Fit the y-positions with a polynomial.
+    xtrace, ytrace, param = _fit_trace(ytrace, dimx, xos, padding, poly_order)
 
-    # Create 2D Array of pixel positions.
-    xpix = np.arange(dimx)
-    ypix = np.arange(dimy)
-    _, ygrid = np.meshgrid(xpix, ypix)
+    # If verbose visualize the result.
+    if verbose is True:
+        _plot_centroid(image_masked, xtrace, ytrace)
 
-    # CoM analysis to find initial positions using all rows.
-    with np.errstate(invalid='ignore'):
-        ytrace = np.nansum(image_norm*ygrid, axis=0)/np.nansum(image_norm, axis=0)
+    return xtrace, ytrace, param
 
-    # Second pass - use a windowed CoM at the previous position.
-    halfwidth = 30 * yos
-    for icol in range(dimx):
 
-        ycom = center_of_mass(image_norm[:, icol], ytrace[icol], halfwidth)
+def get_centroids_com_cube(cube, header=None, mask=None, poly_order=11, chunksize=16):
+    """Determine the x, y coordinates of the trace in each integration of a
+    time series using a center-of-mass analysis (see get_centroids_com). All
+    columns of chunksize integrations are processed together, so that the
+    temporary arrays are the size of a chunk instead of the cube. Only the
+    polynomial fits are done per integration.
 
-        # If NaN was returned we are done.
-        if not np.isfinite(ycom):
-            ytrace[icol] = np.nan
-            continue
+    :param cube: The images of the detector, shape (nints, dimy, dimx).
+    :param header: The header from one of the SOSS reference files.
+    :param mask: A boolean array of shape (dimy, dimx) or (nints, dimy, dimx).
+        Pixels corresponding to True values will be masked.
+    :param poly_order: Order of the polynomial to fit to the extracted trace positions.
+    :param chunksize: Number of integrations processed together.
 
-        # If the pixel at the centroid is below the local mean we are likely mid-way between orders and
-        # we should shift the window downward to get a reliable centroid for order 1.
-        irow = np.int(np.around(ycom))
-        miny = np.int(np.fmax(np.around(ycom) - halfwidth, 0))
-        maxy = np.int(np.fmin(np.around(ycom) + halfwidth + 1, dimy))
-        if image_norm[irow, icol] < np.nanmean(image_norm[miny:maxy, icol]):
-            ycom = center_of_mass(image_norm[:, icol], ycom - halfwidth, halfwidth)
+    :type cube: array[float]
+    :type header: astropy.io.fits.Header
+    :type mask: array[bool]
+    :type poly_order: int
+    :type chunksize: int
 
-        # If NaN was returned or the position is too close to the array edge, use NaN.
-        if not np.isfinite(ycom) or (ycom <= 5 * yos) or (ycom >= (ynative - 6) * yos):
-            ytrace[icol] = np.nan
-            continue
+    :returns: xtrace, ytraces, params - The x coordinates of the trace, the y
+        coordinates of the trace in each integration (nints, dimx) and the best-fit
+        polynomial parameters of each integration.
+    :rtype: Tuple(array[float], array[float], List[array[float]])
+    """
 
-        # Update the position if the above checks were succesfull.
-        ytrace[icol] = ycom
+    # If no mask was given use all pixels.
+    if mask is None:
+        mask = np.zeros(cube.shape[-2:], dtype='bool')
 
-    # Third pass - fine tuning using a smaller window.
-    halfwidth = 16 * yos
-    for icol in range(dimx):
+    # The same mask for all integrations, or one for each.
+    mask = np.broadcast_to(mask, np.shape(cube))
 
-        ytrace[icol] = center_of_mass(image_norm[:, icol], ytrace[icol], halfwidth)
+    # The dimensions are the same for all integrations.
+    result = get_image_dim(cube[0], header=header)
+    dimx, dimy, xos, yos, xnative, ynative, padding, refpix_mask = result
 
-    # Fit the y-positions with a polynomial and use the result as the true y-positions.
-    xtrace = np.arange(dimx)
-    mask = np.isfinite(ytrace)
+    nints = len(cube)
+    ytraces = np.zeros((nints, dimx))
+    for i0 in range(0, nints, chunksize):
+        i1 = min(i0 + chunksize, nints)
 
-    # For padded arrays ignore padding for consistency with real data
-    if padding != 0:
-        mask = mask & (xtrace >= xos*padding) & (xtrace < (dimx - xos*padding))
+        # Replace masked pixel values with NaNs.
+        cube_masked = np.where(mask[i0:i1] | ~refpix_mask, np.nan, cube[i0:i1])
 
-    # If no polynomial order was given return the raw measurements.
-    if poly_order is None:
-        param = []
-    else:
-        param = robust_polyfit(xtrace[mask], ytrace[mask], poly_order)
-        ytrace = np.polyval(param, xtrace)
+        # Find the y-positions with a center-of-mass analysis of all columns of the chunk.
+        ytraces[i0:i1] = _com_trace(cube_masked, yos, ynative)
 
-    # If verbose visualize the result.
-    if verbose is True:
-        _plot_centroid(image_masked, xtrace, ytrace)
+    # Fit the y-positions of each integration with a polynomial.
+    params = []
+    for i in range(len(ytraces)):
+        xtrace, ytraces[i], param = _fit_trace(ytraces[i], dimx, xos, padding, poly_order)
+        params.append(param)
 
-    return xtrace, ytrace, param
+    return np.arange(dimx), ytraces, params
 
 
 def edge_trigger(image, halfwidth=5, yos=1, verbose=False, outdir=None):
@@ -5,7 +5,7 @@
 # General imports.
 import numpy as np
 from scipy.sparse import issparse, csr_matrix, diags
-from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import spsolve, splu
 from scipy.interpolate import interp1d, Akima1DInterpolator
 from scipy.optimize import minimize_scalar
 
@@ -273,9 +273,9 @@ class _BaseOverlap:  # TODO Merge with TrpzOverlap?
         for i_order, kernel_n in enumerate(kernels):
 
             if not issparse(kernel_n):
-                kernel_n = engine_utils.get_c_matrix(kernel_n, self.wave_grid,
-                                                     i_bounds=self.i_bounds[i_order],
-                                                     **c_kwargs[i_order])
+                kernel_n = engine_utils.get_c_matrix_cached(kernel_n, self.wave_grid,
+                                                            i_bounds=self.i_bounds[i_order],
+                                                            **c_kwargs[i_order])
 
             kernels_new.append(kernel_n)
 
@@ -1317,6 +1317,165 @@ class _BaseOverlap:  # TODO Merge with TrpzOverlap?
 
         return self.extract(**kwargs)
 
+    def extract_batch(self, data, error=None, mask=None, tikhonov=False,
+                      factor=None, max_low_rank=100):
+        """
+        Extract underlying flux of multiple integrations at once.
+        The pixel mapping without the error (P.w.T.lambda.c_n, summed over
+        orders) is computed once for all integrations, so only the weights
+        (1/sig^2) change from an integration to another.
+        If the error is the same for all integrations, the system is
+        factorized once and solved for all integrations together.
+        Pixels masked only in a few integrations are then removed from the
+        shared factorization with a low-rank update (Woodbury identity).
+
+        Parameters
+        ----------
+        data : (N_int, N, M) array_like
+            A 3-D array of real values representing the detector images.
+        error : (N, M) or (N_int, N, M) array_like, optional
+            Estimate of the error on each pixel, the same for all
+            integrations or one for each integration.
+            Default is the object attribute `error`.
+        mask : (N, M) or (N_int, N, M) array_like boolean, optional
+            Additionnal mask for all integrations or for each integration.
+            Will be added to the object general mask.
+        tikhonov : bool, optional
+            Wheter to use tikhonov extraction. Default is False.
+        factor : float, optional
+            The tikhonov factor to use if tikhonov is True.
+        max_low_rank : int, optional
+            Maximum number of pixels masked in a single integration to use
+            a low-rank update instead of a new factorization. Default is 100.
+
+        Returns
+        -----
+        spectra (N_int, N_k): solution of the linear system of
+        each integration
+        """
+
+        if tikhonov and factor is None:
+            raise ValueError("Please specify tikhonov `factor`.")
+
+        data = np.asarray(data)
+        n_int = data.shape[0]
+
+        # Use the object error by default.
+        if error is None:
+            error = self.error
+        error = np.asarray(error)
+        same_error = (error.ndim == 2)
+
+        # Pixels masked in all integrations are added to the object mask.
+        if mask is None:
+            mask = np.zeros(self.data_shape, dtype=bool)
+        mask = np.broadcast_to(mask, data.shape)
+        batch_mask = self.general_mask | np.all(mask, axis=0)
+
+        # Re-use the pre-computed products (w.T.lambda.c_n) if the mask
+        # did not change.
+        quick = (self.w_t_wave_c is not None)
+        quick &= np.array_equal(batch_mask, self.mask)
+        if not quick:
+            self.update_mask(batch_mask)
+
+        # Build the pixel mapping without the error (sum over orders).
+        valid = ~self.mask
+        mapping = csr_matrix((valid.sum(), self.n_wavepoints))
+        for i_order in range(self.n_orders):
+            mapping += self._get_pixel_mapping(i_order, error=False, quick=quick)
+
+        # Weights (1/sig^2) and data of the valid pixels for each
+        # integration. Pixels masked in an integration get a zero weight.
+        bad = mask[:, valid]
+        data = np.where(bad, 0., data[:, valid])
+        weights = np.broadcast_to(error[..., valid]**-2., data.shape)
+        weights = np.where(bad, 0., weights)
+
+        # Right hand side of all integrations: (data/sig^2)_T * B
+        results = mapping.T.dot((weights * data).T).T
+
+        # Only solve for valid range `i_grid` (on the detector).
+        i_grid = self.get_i_grid(results[0])
+        mapping = mapping[:, i_grid]
+        results = results[:, i_grid]
+
+        if tikhonov:
+            t_mat = self.get_tikho_matrix()[i_grid, :][:, i_grid]
+        else:
+            t_mat = None
+
+        # Init spectra with NaNs.
+        spectra = np.full((n_int, self.n_wavepoints), np.nan)
+
+        # Integrations with their own factorization.
+        todo = np.ones(n_int, dtype=bool)
+
+        if same_error:
+
+            # Factorize the common system once.
+            weights_0 = error[valid]**-2.
+            matrix = mapping.T.dot(diags(weights_0).dot(mapping))
+            lu_fac, rhs_func = self._factorize(matrix, t_mat, factor)
+
+            # Solve all integrations without an additionnal mask together.
+            n_bad = bad.sum(axis=1)
+            same = (n_bad == 0)
+            if same.any():
+                sln = lu_fac.solve(rhs_func(results[same].T))
+                spectra[np.ix_(same, i_grid)] = sln.T
+            todo &= ~same
+
+            # Low-rank update for the few pixels masked in an integration.
+            if not tikhonov:
+                low_rank = todo & (n_bad <= max_low_rank)
+                for i_int in np.nonzero(low_rank)[0]:
+                    i_bad = np.nonzero(bad[i_int])[0]
+                    u_mat = mapping[i_bad].T.toarray()
+                    sln = self._solve_low_rank(lu_fac, u_mat, weights_0[i_bad],
+                                               results[i_int])
+                    spectra[i_int, i_grid] = sln
+                todo &= ~low_rank
+
+        # Remaining integrations: factorize their own system.
+        for i_int in np.nonzero(todo)[0]:
+            matrix = mapping.T.dot(diags(weights[i_int]).dot(mapping))
+            lu_fac, rhs_func = self._factorize(matrix, t_mat, factor)
+            spectra[i_int, i_grid] = lu_fac.solve(rhs_func(results[i_int]))
+
+        return spectra
+
+    @staticmethod
+    def _factorize(matrix, t_mat=None, factor=None):
+        """
+        LU factorization of the system to solve, with tikhonov
+        regularisation if `t_mat` is given (same system as
+        `engine_utils.tikho_solve`). Return the factorization and the
+        function to apply on the right hand side.
+        """
+
+        if t_mat is None:
+            return splu(matrix.tocsc()), np.asarray
+
+        gamma = factor * t_mat
+        system = matrix.T.dot(matrix) + (gamma.T).dot(gamma)
+
+        return splu(system.tocsc()), matrix.T.dot
+
+    @staticmethod
+    def _solve_low_rank(lu_fac, u_mat, w_bad, result):
+        """
+        Solve (A - U.W.U_T).x = result with the factorization of A
+        (Woodbury identity), where W = diag(w_bad).
+        Used to remove a few pixels (columns of U) from the system.
+        """
+
+        sln = lu_fac.solve(result)
+        z_mat = lu_fac.solve(u_mat)
+        small = np.diag(1. / w_bad) - (u_mat.T).dot(z_mat)
+
+        return sln + z_mat.dot(np.linalg.solve(small, (u_mat.T).dot(sln)))
+
     def bin_to_pixel(self, i_order=0, grid_pix=None, grid_f_k=None, convolved_spectrum=None,
                      spectrum=None, bounds_error=False, throughput=None, **kwargs):
         """
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# General imports.
+import os
+import time
+import tempfile
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Local imports.
+from SOSS.dms import engine_utils
+from SOSS.dms.soss_engine import ExtractionEngine
+
+# State of a worker process (the engine is built once per worker).
+_WORKER = dict()
+
+
+def _save_arrays(arrays, tmpdir, prefix):
+    """Save a list of arrays as .npy files and return their paths."""
+
+    paths = []
+    for i, array in enumerate(arrays):
+        path = os.path.join(tmpdir, '{}_{}.npy'.format(prefix, i))
+        np.save(path, np.asarray(array))
+        paths.append(path)
+
+    return paths
+
+
+def _load_arrays(paths):
+    """Memory-map the .npy files written by _save_arrays."""
+
+    return [np.load(path, mmap_mode='r') for path in paths]
+
+
+def _build_engine(wave_maps, spat_pros, throughputs, kernels, wave_grid,
+                  orders, engine_kwargs):
+    """ Build the ExtractionEngine from reference arrays.
+
+    :param wave_maps: Wavelength map of each order.
+    :param spat_pros: Spatial profile of each order.
+    :param throughputs: (wavelength, throughput) arrays of each order.
+    :param kernels: Kernel of each order, either an array or callable passed
+        directly to the engine, or (wave_kernels, kernels, n_os, n_pix) used to
+        build a WebbKernel with the wavelength map of the order.
+    :param wave_grid: Wavelength grid of the extracted spectrum.
+    :param orders: The orders to extract.
+    :param engine_kwargs: Other keyword arguments passed to the engine.
+
+    :type wave_maps: List[array[float]]
+    :type spat_pros: List[array[float]]
+    :type throughputs: List[Tuple(array[float], array[float])]
+    :type kernels: List
+    :type wave_grid: array[float]
+    :type orders: List[int]
+    :type engine_kwargs: dict
+
+    :returns: engine - the extraction engine.
+    :rtype: ExtractionEngine
+    """
+
+    # The engine needs float64 arrays in memory.
+    wave_maps = [np.array(wave_map, dtype='float64') for wave_map in wave_maps]
+    spat_pros = [np.array(spat_pro, dtype='float64') for spat_pro in spat_pros]
+
+    # Throughput of each order.
+    thrpt_list = [engine_utils.ThroughputSOSS(wave, thrpt) for wave, thrpt in throughputs]
+
+    # Kernel of each order.
+    ker_list = []
+    for kernel, wave_map in zip(kernels, wave_maps):
+
+        if isinstance(kernel, tuple):
+            wave_kernels, kernel, n_os, n_pix = kernel
+            kernel = engine_utils.WebbKernel(wave_kernels, kernel, wave_map, n_os, n_pix)
+
+        ker_list.append(kernel)
+
+    engine = ExtractionEngine(wave_maps, spat_pros, thrpt_list, ker_list,
+                              wave_grid=wave_grid, orders=orders, **engine_kwargs)
+
+    return engine
+
+
+def _init_worker(ref_paths, throughputs, kernels, wave_grid, orders, engine_kwargs,
+                 data_paths, out_name, out_shape):
+    """Build the engine once per worker and attach the data and output."""
+
+    wave_paths, pro_paths = ref_paths
+    wave_maps, spat_pros = _load_arrays(wave_paths), _load_arrays(pro_paths)
+
+    _WORKER['engine'] = _build_engine(wave_maps, spat_pros, throughputs, kernels,
+                                      wave_grid, orders, engine_kwargs)
+
+    # Memory-mapped data, error and mask cubes.
+    _WORKER['data'] = _load_arrays(data_paths)
+
+    # Shared output spectra.
+    shm = shared_memory.SharedMemory(name=out_name)
+    _WORKER['shm'] = shm
+    _WORKER['spectra'] = np.ndarray(out_shape, dtype=np.float64, buffer=shm.buf)
+
+    return
+
+
+def _extract_chunk(i_ints, extract_kwargs):
+    """Extract some integrations in a worker and write the spectra in the shared output."""
+
+    data, error, mask = _WORKER['data']
+    i_ints = np.asarray(i_ints)
+
+    spectra = _WORKER['engine'].extract_batch(data[i_ints], error=error[i_ints],
+                                              mask=mask[i_ints], **extract_kwargs)
+    _WORKER['spectra'][i_ints] = spectra
+
+    return len(i_ints)
+
+
+def extract_tso(scidata, scierr, scimask, wave_maps, spat_pros, throughputs, kernels,
+                wave_grid=None, orders=None, n_os=2, n_proc=1, chunksize=8,
+                engine_kwargs=None, extract_kwargs=None, verbose=False):
+    """ Extract the spectra of all integrations of a time series with a pool of
+    processes. Each worker builds the ExtractionEngine (reference maps,
+    throughputs and kernels) once at startup and keeps it for all the
+    integrations it extracts. The reference arrays and the data are
+    memory-mapped from .npy files, and the spectra are written in an output
+    array in shared memory.
+
+    :param scidata: The science images of each integration.
+    :param scierr: The errors of each integration.
+    :param scimask: The bad pixel mask of each integration (True = bad).
+    :param wave_maps: Wavelength map of each order.
+    :param spat_pros: Spatial profile of each order.
+    :param throughputs: (wavelength, throughput) arrays of each order.
+    :param kernels: Kernel of each order, either an array or callable passed
+        directly to the engine, or (wave_kernels, kernels, n_os, n_pix) used to
+        build a WebbKernel with the wavelength map of the order.
+    :param wave_grid: Wavelength grid of the extracted spectrum. Default is
+        computed from the wavelength maps and spatial profiles (the same for
+        all workers).
+    :param orders: The orders to extract. Default is [1, 2].
+    :param n_os: Oversampling of the default wavelength grid.
+    :param n_proc: Number of processes. Default is 1.
+    :param chunksize: Number of integrations extracted together by a worker.
+    :param engine_kwargs: Other keyword arguments passed to the engine.
+    :param extract_kwargs: Keyword arguments passed to
+        ExtractionEngine.extract_batch (e.g. tikhonov and factor).
+    :param verbose: If set True some diagnostic messages are printed.
+
+    :type scidata: array[float]
+    :type scierr: array[float]
+    :type scimask: array[bool]
+    :type wave_maps: List[array[float]]
+    :type spat_pros: List[array[float]]
+    :type throughputs: List[Tuple(array[float], array[float])]
+    :type kernels: List
+    :type wave_grid: array[float]
+    :type orders: List[int]
+    :type n_os: int
+    :type n_proc: int
+    :type chunksize: int
+    :type engine_kwargs: dict
+    :type extract_kwargs: dict
+    :type verbose: bool
+
+    :returns: wave_grid, spectra - the wavelength grid and the spectrum of each
+        integration, shape (n_int, n_wave).
+    :rtype: Tuple(array[float], array[float])
+    """
+
+    if orders is None:
+        orders = [1, 2]
+
+    if engine_kwargs is None:
+        engine_kwargs = dict()
+
+    if extract_kwargs is None:
+        extract_kwargs = dict()
+
+    nints = np.shape(scidata)[0]
+
+    # Use the same wavelength grid in all workers.
+    if wave_grid is None:
+        if len(orders) == 2:
+            wave_grid = engine_utils.get_soss_grid(wave_maps, spat_pros, n_os=n_os)
+        else:
+            wave_grid = engine_utils.grid_from_map(wave_maps[0], spat_pros[0], n_os=n_os)
+
+    # Split the integrations in chunks.
+    chunks = [np.arange(i, min(i + chunksize, nints)) for i in range(0, nints, chunksize)]
+
+    # Output spectra in shared memory.
+    out_shape = (nints, len(wave_grid))
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(out_shape))*8)
+
+    try:
+        spectra = np.ndarray(out_shape, dtype=np.float64, buffer=shm.buf)
+        spectra[:] = np.nan
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            # Reference arrays and data are shared as memory-mapped files.
+            ref_paths = (_save_arrays(wave_maps, tmpdir, 'wave_map'),
+                         _save_arrays(spat_pros, tmpdir, 'spat_pro'))
+            data_paths = _save_arrays([scidata, scierr, scimask], tmpdir, 'data')
+
+            initargs = (ref_paths, throughputs, kernels, wave_grid, orders, engine_kwargs,
+                        data_paths, shm.name, out_shape)
+
+            start = time.time()
+            with mp.Pool(processes=n_proc, initializer=_init_worker, initargs=initargs) as pool:
+                results = [pool.apply_async(_extract_chunk, args=(chunk, extract_kwargs))
+                           for chunk in chunks]
+                for result in results:
+                    result.get()
+
+            if verbose:
+                print('Extracted {} integrations with {} processes in {:.2f} s'.format(
+                    nints, n_proc, time.time() - start))
+
+        out = spectra.copy()
+        del spectra
+
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return wave_grid, out
+
+
+def _synthetic_tso(nints, nrows=256, ncols=2048, seed=0):
+    """Synthetic single order time series to benchmark extract_tso."""
+
+    rng = np.random.default_rng(seed)
+
+    # Wavelength decreasing along the columns, constant along the rows.
+    wave = np.linspace(2.8, 0.9, ncols)
+    wave_map = np.tile(wave, (nrows, 1))
+
+    # Gaussian spatial profile (normalized along the columns).
+    rows = np.arange(nrows)[:, None]
+    trace = nrows / 2 + 20 * np.sin(np.linspace(0, np.pi, ncols))
+    spat_pro = np.exp(-0.5 * ((rows - trace) / 6.) ** 2)
+    spat_pro /= spat_pro.sum(axis=0)
+
+    # Constant throughput and gaussian kernel.
+    throughput = (np.linspace(0.5, 3.0, 100), np.full(100, 0.5))
+    kernel = engine_utils.gaussians(np.arange(-7, 8), 0, 2.)
+
+    # Noisy images of a flat spectrum.
+    model = 1e4 * spat_pro
+    scierr = np.sqrt(np.tile(model + 10., (nints, 1, 1)))
+    scidata = model + scierr * rng.standard_normal((nints, nrows, ncols))
+    scimask = np.zeros((nints, nrows, ncols), dtype=bool)
+
+    return scidata, scierr, scimask, [wave_map], [spat_pro], [throughput], [kernel]
+
+
+def main():
+    """Benchmark extract_tso on a synthetic 256x2048 cube with 1 to N cores."""
+
+    nints = 32
+    inputs = _synthetic_tso(nints)
+
+    # The system without regularisation is singular. With this factor the
+    # chi2 of the synthetic images is within 0.3% of the unregularised one.
+    extract_kwargs = {'tikhonov': True, 'factor': 1e-12}
+
+    n_proc = 1
+    while n_proc <= mp.cpu_count():
+
+        start = time.time()
+        extract_tso(*inputs, orders=[1], n_proc=n_proc, extract_kwargs=extract_kwargs)
+        duration = time.time() - start
+
+        print('{:3d} processes: {:7.2f} s, {:7.1f} integrations/min'.format(
+            n_proc, duration, 60 * nints / duration))
+
+        n_proc *= 2
+
+    return
+
+
+if __name__ == '__main__':
+    main()
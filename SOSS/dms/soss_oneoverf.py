@@ -3,9 +3,42 @@ from astropy.io import fits
 from jwst import datamodels
 import os
 
-def stack(cube):
-    deepstack = np.nanmedian(cube, axis=0)
-    rms = np.nanstd(cube, axis=0)
+
+def stack(cube, memory_budget=4e9):
+    """Median (deep stack) and standard deviation over the integrations,
+    computed by chunks of rows so that the outputs and the working copies of
+    the data stay within memory_budget bytes. The result is exact, not an
+    approximation.
+
+    :param cube: the data cube (nint, ngroup, nrows, ncols).
+    :param memory_budget: memory (in bytes) allowed for the outputs and the
+        chunk working copies.
+
+    :type cube: array[float]
+    :type memory_budget: float
+
+    :returns: deepstack, rms - arrays of shape (ngroup, nrows, ncols).
+    :rtype: Tuple(array[float], array[float])
+    """
+
+    nint, ngroup, nrows, ncols = np.shape(cube)
+
+    # The float64 deepstack and rms are kept for all the rows.
+    resident_bytes = 2 * ngroup * nrows * ncols * 8
+
+    # Number of rows fitting in the rest of the memory budget. Each row of a
+    # chunk is held 4 times: the float64 chunk, the masked and sorted copies
+    # made by nanmedian, and the deviations computed by nanstd.
+    row_bytes = nint * ngroup * ncols * 8 * 4
+    nrows_chunk = int(max(1, min(nrows, (memory_budget - resident_bytes) // row_bytes)))
+
+    deepstack = np.zeros((ngroup, nrows, ncols))
+    rms = np.zeros((ngroup, nrows, ncols))
+    for r0 in range(0, nrows, nrows_chunk):
+        chunk = np.asarray(cube[:, :, r0:r0 + nrows_chunk, :], dtype='float64')
+        deepstack[:, r0:r0 + nrows_chunk, :] = np.nanmedian(chunk, axis=0)
+        rms[:, r0:r0 + nrows_chunk, :] = np.nanstd(chunk, axis=0)
+
     return deepstack, rms
 
 def makemask(stack, rms):
@@ -13,75 +46,99 @@ def makemask(stack, rms):
 
     return
 
-def applycorrection(uncal_datamodel, uncal_filename):
+def amplifier_strips(subarray, nrows):
+    """Row slices over which the 1/f DC level is measured for each column.
+
+    :param subarray: the subarray name (SUBSTRIP256, SUBSTRIP96 or FULL).
+    :param nrows: the number of rows.
+
+    :returns: strips - list of row slices.
+    :rtype: List[slice]
+    """
+
+    if subarray == 'FULL':
+        # The 4 amplifiers are read independently
+        return [slice(yo, yo + 512) for yo in range(0, nrows, 512)]
+    elif subarray in ['SUBSTRIP256', 'SUBSTRIP96']:
+        return [slice(0, nrows)]
+    else:
+        raise ValueError('Unknown subarray {}.'.format(subarray))
+
+def applycorrection(uncal_datamodel, uncal_filename, memory_budget=4e9, diagnostics=False):
+    """Custom 1/f correction. The deep stack of each group is subtracted from
+    each integration and the weighted (1/rms) average of the residuals of each
+    column (over each amplifier) is removed from the data.
+
+    The data are corrected in place, one block of integrations at a time, so
+    that the deep stack, its rms, the weights and the working copies stay
+    within memory_budget bytes.
+
+    :param uncal_datamodel: the uncal datamodel, corrected in place.
+    :param uncal_filename: the uncal file name, used to name the diagnostics
+        output directory.
+    :param memory_budget: memory (in bytes) allowed for the deep stack, its rms,
+        the weights and the working copies.
+    :param diagnostics: if True, write the deep stack, its rms and the 1/f DC
+        levels (nint, ngroup, namp, ncols) in the oneoverf_<basename> directory.
+
+    :type uncal_datamodel: jwst.datamodels.RampModel
+    :type uncal_filename: str
+    :type memory_budget: float
+    :type diagnostics: bool
+
+    :returns: uncal_datamodel - the corrected datamodel.
+    :rtype: jwst.datamodels.RampModel
+    """
 
     print('Custom 1/f correction step. Generating a deep stack for each frame using all integrations...')
 
-    # Forge output directory where data may be written
-    basename = os.path.basename(os.path.splitext(uncal_filename)[0])
-    outdir = os.path.dirname(uncal_filename)+'/oneoverf_'+basename+'/'
-    # Create the output directory if it does not exist
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
-
-    # The readout setup
-    ngroup = uncal_datamodel.meta.exposure.ngroups
-    nint = uncal_datamodel.meta.exposure.nints
-    dimx = np.shape(uncal_datamodel.data)[-1]
+    data = uncal_datamodel.data
+    nint, ngroup, nrows, ncols = np.shape(data)
+    strips = amplifier_strips(uncal_datamodel.meta.subarray.name, nrows)
 
     # Generate the deep stack and rms of it
-    deepstack, rms = stack(uncal_datamodel.data)
-
-    # Write these on disk in a sub folder
-    hdu = fits.PrimaryHDU(deepstack)
-    print(outdir+'/deepstack1.fits')
-    hdu.writeto(outdir+'/deepstack1.fits', overwrite=True)
-    hdu = fits.PrimaryHDU(rms)
-    hdu.writeto(outdir+'/rms1.fits', overwrite=True)
+    deepstack, rms = stack(data, memory_budget=memory_budget)
 
     # Weighted average to determine the 1/F DC level
     w = 1/rms # weight
-    print(np.shape(w))
-    print(np.shape(w * uncal_datamodel.data[0]))
+    wsum = [np.nansum(w[:, strip, :], axis=1) for strip in strips]
+
+    # The float64 deepstack, rms and weights are kept for the whole correction,
+    # and the DC levels too for the diagnostics.
+    resident_bytes = 3 * ngroup * nrows * ncols * 8
+    if diagnostics:
+        resident_bytes += nint * ngroup * len(strips) * ncols * 8
+
+    # Number of integrations fitting in the rest of the memory budget. Each
+    # integration of a block is held 3 times: the residuals from the deep
+    # stack, their weighted product and its copy without NaNs in nansum.
+    integ_bytes = ngroup * nrows * ncols * 8 * 3
+    nint_block = int(max(1, min(nint, (memory_budget - resident_bytes) // integ_bytes)))
 
     print('Applying the 1/f correction.')
-    dcmap = np.copy(uncal_datamodel.data)
-    subcorr = np.copy(uncal_datamodel.data)
-    for i in range(nint):
-        sub = uncal_datamodel.data[i] - deepstack
-        hdu = fits.PrimaryHDU(sub)
-        hdu.writeto(outdir+'/sub.fits', overwrite=True)
-        if uncal_datamodel.meta.subarray.name == 'SUBSTRIP256':
-            dc = np.nansum(w * sub, axis=1) / np.nansum(w, axis=1)
-            # dc is 2-dimensional - expand to the 3rd (columns) dimension
-            dcmap[i,:,:,:] = np.repeat(dc, 256).reshape((ngroup, 2048, 256)).swapaxes(1,2)
-            subcorr[i, :, :, :] = sub - dcmap[i, :, :, :]
-        elif uncal_datamodel.meta.subarray.name == 'SUBSTRIP96':
-            dc = np.nansum(w * sub, axis=1) / np.nansum(w, axis=1)
-            # dc is 2-dimensional - expand to the 3rd (columns) dimension
-            dcmap[i,:,:,:] = np.repeat(dc, 256).reshape((ngroup, 2048, 256)).swapaxes(1,2)
-            subcorr[i, :, :, :] = sub - dcmap[i, :, :, :]
-        elif uncal_datamodel.meta.subarray.name == 'FULL':
-            for amp in range(4):
-                yo = amp*512
-                dc = np.nansum(w[:, :, yo:yo+512, :] * sub[:, :, yo:yo+512, :], axis=1) / np.nansum(w[:, :, yo:yo+512, :], axis=1)
-                # dc is 2-dimensional - expand to the 3rd (columns) dimension
-                dcmap[i, :, yo:yo+512, :] = np.repeat(dc, 512).reshape((ngroup, 2048, 512)).swapaxes(1,2)
-                subcorr[i, :, yo:yo+512, :] = sub[:, yo:yo+512, :] - dcmap[i, :, yo:yo+512, :]
-
-    hdu = fits.PrimaryHDU(subcorr)
-    hdu.writeto(outdir+'/subcorr.fits', overwrite=True)
-    hdu = fits.PrimaryHDU(dcmap)
-    hdu.writeto(outdir+'/noisemap.fits', overwrite=True)
-
-    corrected = uncal_datamodel.data - dcmap
-    hdu = fits.PrimaryHDU(corrected)
-    hdu.writeto(outdir+'/corrected.fits', overwrite=True)
-
-    datamodel_corr = uncal_datamodel.copy()
-    datamodel_corr.data = corrected
-
-    return datamodel_corr
+    if diagnostics:
+        dclevels = np.zeros((nint, ngroup, len(strips), ncols))
+    for i0 in range(0, nint, nint_block):
+        i1 = min(i0 + nint_block, nint)
+        sub = data[i0:i1] - deepstack
+        for iamp, strip in enumerate(strips):
+            dc = np.nansum(w[:, strip, :] * sub[:, :, strip, :], axis=2) / wsum[iamp]
+            # dc is the same for all the rows of the amplifier
+            data[i0:i1, :, strip, :] -= dc[:, :, None, :].astype(data.dtype)
+            if diagnostics:
+                dclevels[i0:i1, :, iamp, :] = dc
+
+    # Write the diagnostics on disk in a sub folder
+    if diagnostics:
+        basename = os.path.basename(os.path.splitext(uncal_filename)[0])
+        outdir = os.path.dirname(uncal_filename)+'/oneoverf_'+basename+'/'
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        fits.PrimaryHDU(deepstack).writeto(outdir+'/deepstack1.fits', overwrite=True)
+        fits.PrimaryHDU(rms).writeto(outdir+'/rms1.fits', overwrite=True)
+        fits.PrimaryHDU(dclevels).writeto(outdir+'/dclevels.fits', overwrite=True)
+
+    return uncal_datamodel
 
 
 if __name__ == "__main__":
@@ -90,11 +147,11 @@ if __name__ == "__main__":
     exposurename = '/genesis/jwst/userland-soss/loic_review/GTO/wasp52b/IDTSOSS_clear_noisy.fits'
     uncal_datamodel = datamodels.open(exposurename)
 
-    # Run the 1/f correction step
-    map = applycorrection(uncal_datamodel, exposurename)
-
-    # Free up the input time series
-    uncal_datamodel.close()
+    # Run the 1/f correction step (in place)
+    map = applycorrection(uncal_datamodel, exposurename, diagnostics=True)
 
     # Write down the output corrected time series
     map.write('/genesis/jwst/userland-soss/loic_review/oneoverf/uncal_corrected.fits')
+
+    # Free up the time series
+    uncal_datamodel.close()
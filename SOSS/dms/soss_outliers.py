@@ -1,5 +1,8 @@
+import multiprocessing as mp
+
 import numpy as np
 from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import median_filter, uniform_filter
 from jwst.datamodels.dqflags import pixel
 
 if False:
@@ -118,13 +121,115 @@ def find_outliers(image, window_size, n_sig=5):
     return outliers
 
 
-def flag_outliers(result, nn=2, window_size=(1, 33), n_sig=5, verbose=False):
+def find_outliers_block(images, window_size, n_sig=5):
+    '''
+    Same as find_outliers, but for a stack of medianCombined frames at once.
+    Instead of unfolding the images, the window median is computed with
+    scipy.ndimage.median_filter and the window standard deviation with moving
+    (uniform) filters of the valid pixels. The image edges are reflected.
+
+    Inputs:
+    =======
+    images      : (array) Stack of detector 2D images (n_images, rows, cols)
+    window_size : (tuple) The size of the box to slide across the images. (rows, cols)
+    n_sig       : (int)   Number of standard deviations away from the median to be called outlier
+
+    Returns:
+    ========
+    outliers : (array) Boolean array with same dimensions as the images.
+                        True where outliers were identified
+
+    '''
+
+    images = np.asarray(images, dtype='float64')
+
+    # Row outliers-----------------------------------------------------------
+    row_median = np.nanmedian(images, axis=-1)
+    row_std = np.nanstd(images, axis=-1)
+    row_outliers = images > (row_median + n_sig * row_std)[..., None]
+    # Row outliers-----------------------------------------------------------
+
+    # Window outliers--------------------------------------------------------
+    # the same window for each image of the stack
+    size = (1,) + tuple(window_size)
+    valid = np.isfinite(images)
+
+    # median_filter does not handle NaNs, use the row median instead
+    filled = np.where(valid, images, row_median[..., None])
+    median_map = median_filter(filled, size=size, mode='reflect')
+
+    # moving mean and mean of squares of the valid pixels give the std. dev.
+    zeroed = np.where(valid, images, 0.)
+    count = uniform_filter(valid.astype('float64'), size=size, mode='reflect')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_map = uniform_filter(zeroed, size=size, mode='reflect') / count
+        mean2_map = uniform_filter(zeroed ** 2, size=size, mode='reflect') / count
+        std_map = np.sqrt(np.maximum(mean2_map - mean_map ** 2, 0))
+
+        window_outliers = images > (median_map + n_sig * std_map)
+    # Window outliers--------------------------------------------------------
+
+    return row_outliers | window_outliers
+
+
+def neighbour_indices(nb_int, nn):
+    '''
+    Indices of the 2*nn integrations compared with each integration: the nn
+    preceding and following integrations, or the nearest 2*nn integrations at
+    the start and end of the timeseries
+
+    Inputs:
+    =======
+    nb_int : (int) number of integrations
+    nn     : (int) number of integrations to consider before and after each integration
+
+    Returns:
+    ========
+    neighbours : (array) Indices of the neighbours of each integration, shape (nb_int, 2*nn)
+
+    '''
+
+    integrations = np.arange(nb_int)
+
+    # first integration of the 2*nn+1 window, kept inside the timeseries
+    first = np.clip(integrations - nn, 0, nb_int - 2 * nn - 1)
+    window = first[:, None] + np.arange(2 * nn + 1)
+
+    # remove the target integration from its window
+    keep = window != integrations[:, None]
+
+    return window[keep].reshape(nb_int, 2 * nn)
+
+
+def _outliers_block(args):
+    '''
+    Find the outliers of a block of integrations. The median of the differences
+    target - neighbours is target - median(neighbours), computed for the whole
+    block at once from a slab of consecutive integrations.
+    '''
+
+    slab, dq, targets, neighbours, window_size, n_sig = args
+
+    medianCombined = slab[targets] - np.nanmedian(slab[neighbours], axis=1)
+    # do not overwrite the dq map of already flagged bad pixels
+    medianCombined[dq != pixel['GOOD']] = 0
+
+    return find_outliers_block(medianCombined, window_size, n_sig)
+
+
+def flag_outliers(result, nn=2, window_size=(1, 33), n_sig=5, block_size=16, n_proc=1,
+                  verbose=False):
     '''
     Function that takes a timeseries of integrations and for each, finds the
     outlier pixels and flags them as such in the data quality (dq) object
 
     The outlier identification routine is based on Nikolov et al. 2014
 
+    The time axis is processed by blocks of integrations: for each block, the
+    median of the differences with the neighbouring integrations and the
+    outliers are computed in vectorized calls (see find_outliers_block).
+    Blocks can be processed in parallel.
+
     Inputs:
     =======
     result      : (jwst object) Stage 2 jwst pipeline object
@@ -133,6 +238,8 @@ def flag_outliers(result, nn=2, window_size=(1, 33), n_sig=5, verbose=False):
     window_size : (tuple) The size of the box to slide across the image when
                             scanning for outliers (rows, cols), should keep odd so there is a clear center pixel
     n_sig       : (int) Number of standard deviations away from the median to be called outlier
+    block_size  : (int) Number of integrations processed together
+    n_proc      : (int) Number of processes used to process the blocks
     verbose     : (bool) If True, activates print statements
 
     Returns:
@@ -147,85 +254,38 @@ def flag_outliers(result, nn=2, window_size=(1, 33), n_sig=5, verbose=False):
         print('Warning: Outlier flagging was skipped - not enough integrations.')
         return result
 
-    # We will process each integration one after the other
-    for i in range(nb_int):
-
-        # The first step is to compute the difference between our integration we want
-        # to analyze and the neighbouring integrations in time
-        # We compute the difference with the preceding/following nn integrations
-
-        # Near the start of the integration, we make sure we still choose the 2*nn nearest integrations
-        # but can't choose nn on each side
-        if i < nn:
-            if verbose: print('Processing integration {}'.format(i))
-            # define the target integration
-            target = result.data[i]
-
-            # define the list of the indices of the neighbouring frames
-            # we need to handle them differently since we are at the start of the timeseries
-            neighbours = np.arange(0, 2 * nn + 1)
-            # remove the target frame from the list
-            neighbours = np.delete(neighbours, np.argwhere(neighbours == i))
-
-            # create an empty list that will hold the difference images
-            # differenceImages = Target - neighbouringImages
-            differenceImages = []
-            for ii in neighbours:
-                # Compute target-neighbour for preceding/next nn images
-                differenceImages.append(target - result.data[ii])
-
-
-        # Near the end of the timeseries, we again find the nearest 2*nn integrations, but
-        # we can't choose nn on each side
-        elif nb_int - i <= nn:
-            if verbose: print('Processing integration {}'.format(i))
-            # define the target integration
-            target = result.data[i]
-
-            # define the list of the indices of the neighbouring frames
-            # we need to handle them differently since we are at the start of the time series
-            neighbours = np.arange(nb_int - 2 * nn - 1, nb_int)
-            # remove the target frame from the list
-            neighbours = np.delete(neighbours, np.argwhere(neighbours == i))
-
-            # create an empty list that will hold the difference images
-            # differenceImages = Target - neighbouringImages
-            differenceImages = []
-            for ii in neighbours:
-                # Compute target-neighbour for preceding/next nn images
-                differenceImages.append(target - result.data[ii])
-
-        # In the middle of the timeseries, we simply choose nn frames before
-        # and nn frames after
-        else:
-            if verbose: print('Processing integration {}'.format(i))
-            # define the target integration
-            target = result.data[i]
-
-            # create an empty list that will hold the difference images
-            # differenceImages = Target - neighbouringImages
-            differenceImages = []
-            for ii in range(1, nn + 1):
-                # Compute target-neighbour for preceding/next nn images
-                differenceImages.append(target - result.data[i - ii])
-                differenceImages.append(target - result.data[i + ii])
-
-        # Compute the median of the set of differenceImages for our given integration
-        medianCombined = np.nanmedian(differenceImages, axis=0)
-        # Now, to ensure we do not overwrite the dq map of already flagged bad pixels,
-        # we set these already flagged bad pixels to 0
-        medianCombined[result.dq[i] != pixel['GOOD']] = 0
-
-        # From here, we identify the outliers in the medianCombined image
-        outliers = find_outliers(medianCombined, window_size, n_sig)
-
-        # update the dq map with the new outliers
-        result.dq[i][outliers] = pixel['OUTLIER']
-
-        if verbose: print(
-            'Processing integration {} : Identified {} outlier pixels\n'.format(i, np.count_nonzero(outliers)))
+    # the neighbouring integrations of each integration
+    neighbours = neighbour_indices(nb_int, nn)
+
+    # blocks of consecutive integrations
+    blocks = [(i0, min(i0 + block_size, nb_int)) for i0 in range(0, nb_int, block_size)]
+
+    def block_args():
+        # only the slab of integrations needed by each block is passed
+        for i0, i1 in blocks:
+            lo, hi = neighbours[i0:i1].min(), neighbours[i0:i1].max() + 1
+            lo, hi = min(lo, i0), max(hi, i1)
+            yield (result.data[lo:hi], result.dq[i0:i1], np.arange(i0, i1) - lo,
+                   neighbours[i0:i1] - lo, window_size, n_sig)
+
+    def update_dq(block_outliers):
+        for (i0, i1), outliers in zip(blocks, block_outliers):
+
+            # update the dq map with the new outliers
+            result.dq[i0:i1][outliers] = pixel['OUTLIER']
+
+            if verbose:
+                for i in range(i0, i1):
+                    print('Processing integration {} : Identified {} outlier pixels'.format(
+                        i, np.count_nonzero(outliers[i - i0])))
+
+    if n_proc > 1:
+        with mp.Pool(processes=n_proc) as pool:
+            update_dq(pool.imap(_outliers_block, block_args()))
+    else:
+        update_dq(map(_outliers_block, block_args()))
 
     return result
 
 # example
-# result = flag_outliers(result, verbose=True)
\ No newline at end of file
+# result = flag_outliers(result, verbose=True)
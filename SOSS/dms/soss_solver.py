@@ -4,6 +4,8 @@
 # TODO Theoretically it could be removed entirely, but the way coords and image
 # TODO handle it are different by default (lower-left vs center).
 
+import multiprocessing as mp
+
 from astropy.io import fits
 import numpy as np
 from scipy.ndimage import shift, rotate
@@ -142,6 +144,240 @@ def solve_transform(scidata, scimask, xref, yref, subarray, verbose=False):
     return simple_transform
 
 
+def _ccf_peak(images_pad, template, lags, pad):
+    """Position of the peak of the cross-correlation of each column of the
+    (padded) images with the template, refined with a parabola through the
+    three highest values. NaN if the peak is at the edge of the lags.
+    """
+
+    dimy = template.shape[-2]
+
+    # Cross-correlation for each lag, images[y + lag] vs. template[y].
+    ccf = np.stack([np.sum(images_pad[..., pad + lag:pad + lag + dimy, :] * template, axis=-2)
+                    for lag in lags], axis=-1)
+
+    # Find the peak, and refine it with a parabola.
+    ipeak = np.clip(np.argmax(ccf, axis=-1), 1, len(lags) - 2)
+    cm, c0, cp = [np.take_along_axis(ccf, (ipeak + i)[..., np.newaxis], axis=-1)[..., 0]
+                  for i in (-1, 0, 1)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        peak = lags[ipeak] + 0.5 * (cm - cp) / (cm - 2 * c0 + cp)
+
+    # Peaks at the edge of the lags, or without signal, are not valid.
+    valid = (c0 > cm) & (c0 >= cp)
+    peak = np.where(valid, peak, np.nan)
+
+    return peak
+
+
+def column_offsets(images, template, ypos, halfwidth=16, maxlag=5, niter=2):
+    """Measure the y-offsets of the trace in each column of one or more images
+    relative to a template image, from the 1D cross-correlation of each column
+    with the same column of the template. The background of each column (10th
+    percentile) is subtracted and the template is restricted to a window
+    around the trace.
+
+    The peak of the cross-correlation is first found on integer lags up to
+    maxlag and refined with a parabola. The parabola is biased for fractional
+    offsets, so the template is then shifted (in Fourier space) by the current
+    offsets and the residual offsets are measured again, niter times.
+
+    :param images: The image(s) with masked pixels set to NaN,
+        shape (dimy, ncols) or (nints, dimy, ncols).
+    :param template: The template image, shape (dimy, ncols).
+    :param ypos: The position of the trace in each column of the template.
+    :param halfwidth: The half-size of the template window in pixels, should
+        cover the full trace.
+    :param maxlag: The largest offset searched in pixels.
+    :param niter: The number of refinement iterations.
+
+    :type images: array[float]
+    :type template: array[float]
+    :type ypos: array[float]
+    :type halfwidth: int
+    :type maxlag: int
+    :type niter: int
+
+    :returns: offsets - the y-offset of the trace in each column of the images,
+        NaN if the peak is not found within maxlag.
+    :rtype: array[float]
+    """
+
+    dimy = template.shape[0]
+    ypix = np.arange(dimy)[:, np.newaxis]
+
+    with warnings.catch_warnings():
+        # All NaN columns give NaN offsets.
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        # Subtract the background level of each column, masked pixels do not contribute.
+        images = images - np.nanpercentile(images, 10, axis=-2)[..., np.newaxis, :]
+        template = template - np.nanpercentile(template, 10, axis=0)
+
+    images = np.where(np.isfinite(images), images, 0)
+    template = np.where(np.isfinite(template), template, 0)
+
+    pad = [(0, 0)] * (images.ndim - 2) + [(maxlag, maxlag), (0, 0)]
+    images_pad = np.pad(images, pad)
+
+    # First pass - integer lags, template restricted to a window around the trace.
+    window = np.abs(ypix - ypos) <= halfwidth
+    lags = np.arange(-maxlag, maxlag + 1)
+    offsets = _ccf_peak(images_pad, np.where(window, template, 0), lags, maxlag)
+
+    with np.errstate(invalid='ignore'):
+        offsets = np.where(np.abs(offsets) < maxlag, offsets, np.nan)
+
+    # Refinement - cross-correlate with the shifted template around zero lag.
+    freqs = np.fft.rfftfreq(dimy)[:, np.newaxis]
+    template_fft = np.fft.rfft(template, axis=0)
+    for i in range(niter):
+
+        valid = np.isfinite(offsets)
+        shifts = np.where(valid, offsets, 0)[..., np.newaxis, :]
+
+        phase = np.exp(-2j * np.pi * freqs * shifts)
+        template_shift = np.fft.irfft(template_fft * phase, n=dimy, axis=-2)
+        window = np.abs(ypix - ypos - shifts) <= halfwidth
+        template_shift = np.where(window, template_shift, 0)
+
+        residuals = _ccf_peak(images_pad, template_shift, np.arange(-1, 2), maxlag)
+        offsets = np.where(valid, offsets + residuals, np.nan)
+
+    return offsets
+
+
+def _track_chunk(xref, yref, xdat, ydats, guess_transform):
+    """Find the transformation of consecutive integrations, starting each
+    optimization from the solution of the previous integration.
+
+    :param xref: a priori expectation of the trace x-positions.
+    :param yref: a priori expectation of the trace y-positions.
+    :param xdat: the x-positions of the measured centroids.
+    :param ydats: the y-positions of the measured centroids of each integration.
+    :param guess_transform: the starting point of the first integration.
+
+    :type xref: array[float]
+    :type yref: array[float]
+    :type xdat: array[float]
+    :type ydats: array[float]
+    :type guess_transform: array[float]
+
+    :returns: transforms - the angle, x-shift and y-shift of each integration.
+    :rtype: array[float]
+    """
+
+    transforms = np.zeros((len(ydats), 3))
+    for i, ydat in enumerate(ydats):
+
+        result = minimize(chi_squared, guess_transform, args=(xref, yref, xdat, ydat))
+        transforms[i] = guess_transform = result.x
+
+    return transforms
+
+
+def track_transform(scicube, scimask, xref, yref, subarray, col_step=8, halfwidth=16,
+                    maxlag=5, ncpu=1, nchunks=None, verbose=False):
+    """Given a time series of science images, find the simple transformation
+    needed to match xcen_ref and ycen_ref to each integration.
+
+    The full centroid analysis and optimization (as in solve_transform) is done
+    only once, on the deep stack of the time series. For each integration the
+    order 1 y-centroids are then obtained on a subset of columns from the
+    offsets measured by cross-correlating each column with the same column of
+    the deep stack (see column_offsets), and the optimization starts from the solution of the previous integration.
+    Chunks of integrations can be solved in parallel, each starting from the
+    deep stack solution.
+
+    :param scicube: the images of the SOSS trace, shape (nints, dimy, dimx).
+    :param scimask: a boolean mask of pixels to be excluded, shape (dimy, dimx)
+        or (nints, dimy, dimx).
+    :param xref: a priori expectation of the trace x-positions.
+    :param yref: a priori expectation of the trace y-positions.
+    :param subarray: the subarray of the observations.
+    :param col_step: use one column every col_step columns.
+    :param halfwidth: the half-size of the cross-correlation window in pixels,
+        should cover the full order 1 trace.
+    :param maxlag: the largest offset from the deep stack in pixels.
+    :param ncpu: the number of processes.
+    :param nchunks: the number of chunks of integrations, default is ncpu.
+    :param verbose: If set True provide diagnostic information.
+
+    :type scicube: array[float]
+    :type scimask: array[bool]
+    :type xref: array[float]
+    :type yref: array[float]
+    :type subarray: str
+    :type col_step: int
+    :type halfwidth: int
+    :type maxlag: int
+    :type ncpu: int
+    :type nchunks: int
+    :type verbose: bool
+
+    :returns: transforms - Array of shape (nints, 3) containing the angle,
+        x-shift and y-shift needed to match xcen_ref and ycen_ref to each
+        integration.
+    :rtype: array[float]
+    """
+
+    nints = scicube.shape[0]
+
+    if nchunks is None:
+        nchunks = ncpu
+
+    # Remove any NaNs used to pad the xref, yref coordinates.
+    mask = np.isfinite(xref) & np.isfinite(yref)
+    xref = xref[mask]
+    yref = yref[mask]
+
+    # Build the deep stack of the time series.
+    scicube = np.where(scimask, np.nan, scicube)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        deepstack = np.nanmedian(scicube, axis=0)
+
+    # Get centroids from the deep stack.
+    centroids = get_soss_centroids(deepstack, mask=~np.isfinite(deepstack),
+                                   subarray=subarray, verbose=verbose)
+    xdat = centroids['order 1']['X centroid']
+    ydat = centroids['order 1']['Y centroid']
+
+    # Find the best-fit transformation of the deep stack.
+    guess_transform = np.array([0.15, 1, 1])
+    result = minimize(chi_squared, guess_transform, args=(xref, yref, xdat, ydat))
+    deep_transform = result.x
+
+    if verbose:
+        print('Deep stack transformation: {}'.format(deep_transform))
+
+    # Select a subset of the columns with a valid centroid.
+    dimx = deepstack.shape[1]
+    valid = np.isfinite(xdat) & np.isfinite(ydat)
+    valid[valid] = (np.around(xdat[valid]) >= 0) & (np.around(xdat[valid]) < dimx)
+    xdat, ydat = xdat[valid][::col_step], ydat[valid][::col_step]
+    cols = np.around(xdat).astype(int)
+
+    # Trace offsets of each integration relative to the deep stack.
+    offsets = column_offsets(scicube[:, :, cols], deepstack[:, cols], ydat,
+                             halfwidth=halfwidth, maxlag=maxlag)
+    ydats = ydat + offsets
+
+    # Find the transformation of each integration, by chunks.
+    chunks = np.array_split(np.arange(nints), max(1, min(nchunks, nints)))
+    args = [(xref, yref, xdat, ydats[chunk], deep_transform) for chunk in chunks]
+
+    if ncpu > 1:
+        with mp.Pool(processes=ncpu) as pool:
+            results = pool.starmap(_track_chunk, args)
+    else:
+        results = [_track_chunk(*arg) for arg in args]
+
+    transforms = np.concatenate(results)
+
+    return transforms
+
+
 def rotate_image(image, angle, origin):
     """Rotate an image around a specific pixel.
 
@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import numpy as np
+import warnings
 
-from astropy.stats import SigmaClip
+import numpy as np
 
 
 def make_profile_mask(ref_2d_profile, threshold=1e-3):
@@ -26,6 +26,58 @@ def make_profile_mask(ref_2d_profile, threshold=1e-3):
     return bkg_mask
 
 
+def sigma_clipped_column_mean(data, mask, sigma=3, maxiters=None):
+    """Columnwise (over the rows, axis=-2) sigma-clipped mean of one or more
+    images at once. Same as astropy SigmaClip(sigma=sigma, cenfunc='mean')
+    along the rows, but using NaN-aware NumPy reductions on all the images
+    together.
+
+    :param data: the image(s), shape (ny, nx) or (n_int, ny, nx).
+    :param mask: a boolean mask of the pixels to be excluded, broadcastable to
+        the shape of data.
+    :param sigma: the number of standard deviations used for clipping.
+    :param maxiters: the maximum number of clipping iterations, if None iterate
+        until no more pixels are clipped.
+
+    :type data: array[float]
+    :type mask: array[bool]
+    :type sigma: float
+    :type maxiters: int
+
+    :returns: col_mean, npix - the clipped mean of each column and the number
+        of pixels used, shape (nx,) or (n_int, nx).
+    :rtype: Tuple(array[float], array[int])
+    """
+
+    # Masked pixels are set to NaN.
+    values = np.where(mask, np.nan, data)
+
+    with warnings.catch_warnings():
+        # Fully masked columns give NaN.
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        niter = 0
+        while maxiters is None or niter < maxiters:
+
+            # Clip the pixels too far from the column mean.
+            col_mean = np.nanmean(values, axis=-2, keepdims=True)
+            col_std = np.nanstd(values, axis=-2, keepdims=True)
+            with np.errstate(invalid='ignore'):
+                clip = np.abs(values - col_mean) > sigma * col_std
+
+            niter += 1
+            if not clip.any():
+                break
+
+            values[clip] = np.nan
+
+        col_mean = np.nanmean(values, axis=-2)
+
+    npix = np.isfinite(values).sum(axis=-2)
+
+    return col_mean, npix
+
+
 def soss_background(scidata, scimask, bkg_mask=None):
     """Compute a columnwise background for a SOSS observation.
 
@@ -56,21 +108,15 @@ def soss_background(scidata, scimask, bkg_mask=None):
             msg = 'scidata and bkg_mask must have the same shape.'
             raise ValueError(msg)
 
-    # Combine the masks and create a masked array.
+    # Combine the masks.
     if bkg_mask is not None:
         mask = scimask | bkg_mask
     else:
         mask = scimask
 
-    scidata_masked = np.ma.array(scidata, mask=mask)
-
-    # Mask additional pixels using sigma-clipping.
-    sigclip = SigmaClip(sigma=3, maxiters=None, cenfunc='mean')
-    scidata_clipped = sigclip(scidata_masked, axis=0)
-
-    # Compute the mean for each column and record the number of pixels used.
-    col_bkg = scidata_clipped.mean(axis=0)
-    npix_bkg = (~scidata_clipped.mask).sum(axis=0)
+    # Compute the sigma-clipped mean for each column and record the number
+    # of pixels used.
+    col_bkg, npix_bkg = sigma_clipped_column_mean(scidata, mask, sigma=3)
 
     # Background subtract the science data.
     scidata_bkg = scidata - col_bkg
@@ -155,44 +201,85 @@ def soss_oneoverf_correction(scidata, scimask, deepstack, bkg_mask=None,
         msg = 'scidata and scimask must have the same shape.'
         raise ValueError(msg)
 
-    if deepstack.shape != data_shape:
-        msg = 'scidata and deepstack must have the same shape.'
+    # Use the cube version with a single integration.
+    scidata_cor, col_cor, npix_cor, bias = soss_oneoverf_correction_cube(
+        scidata[np.newaxis], scimask[np.newaxis], deepstack, bkg_mask=bkg_mask,
+        zero_bias=zero_bias)
+
+    return scidata_cor[0], col_cor[0], npix_cor[0], bias[0]
+
+
+def soss_oneoverf_correction_cube(scidata, scimask, deepstack, bkg_mask=None,
+                                  zero_bias=False):
+    """Compute a columnwise correction to the 1/f noise on the difference
+    images of all the integrations of a SOSS observation at once (i.e. each
+    integration - a deep image of the same observation).
+
+    :param scidata: the images of the SOSS trace, shape (n_int, ny, nx).
+    :param scimask: a boolean mask of pixels to be excluded based on the DQ
+        values, shape (n_int, ny, nx) or (ny, nx) for all integrations.
+    :param deepstack: a deep image of the trace constructed by combining
+        individual integrations of the observation, shape (ny, nx).
+    :param bkg_mask: a boolean mask of pixels to be excluded because they are in
+        the trace, use for example make_background_mask to construct such a
+        mask, shape (ny, nx).
+    :param zero_bias: if True the corrections to individual columns will be
+        adjusted so that their mean is zero.
+
+    :type scidata: array[float]
+    :type scimask: array[bool]
+    :type deepstack: array[float]
+    :type bkg_mask: array[bool]
+    :type zero_bias: bool
+
+    :returns: scidata_cor, col_cor, npix_cor, bias - The 1/f corrected images,
+        columnwise correction values (n_int, nx), number of pixels used in each
+        column (n_int, nx), and the net change to each image (n_int,) if
+        zero_bias was False.
+    :rtype: Tuple(array[float], array[float], array[float], array[float])
+    """
+
+    # Check the validity of the input.
+    image_shape = scidata.shape[-2:]
+
+    if scimask.shape[-2:] != image_shape:
+        msg = 'scidata and scimask must have the same image shape.'
+        raise ValueError(msg)
+
+    if deepstack.shape != image_shape:
+        msg = 'scidata and deepstack must have the same image shape.'
         raise ValueError(msg)
 
     if bkg_mask is not None:
 
-        if bkg_mask.shape != data_shape:
-            msg = 'scidata and bkg_mask must have the same shape.'
+        if bkg_mask.shape != image_shape:
+            msg = 'scidata and bkg_mask must have the same image shape.'
             raise ValueError(msg)
 
-    # Subtract the deep stack from the image.
+    # Subtract the deep stack from the images.
     diffimage = scidata - deepstack
 
-    # Combine the masks and create a masked array.
+    # Combine the masks.
     mask = scimask | ~np.isfinite(deepstack)  # TODO invalid values in deepstack?
 
     if bkg_mask is not None:
         mask = mask | bkg_mask
 
-    diffimage_masked = np.ma.array(diffimage, mask=mask)
-
-    # Mask additional pixels using sigma-clipping.
-    sigclip = SigmaClip(sigma=3, maxiters=None, cenfunc='mean')
-    diffimage_clipped = sigclip(diffimage_masked, axis=0)
-
-    # Compute the mean for each column and record the number of pixels used.
-    col_cor = diffimage_clipped.mean(axis=0)
-    npix_cor = (~diffimage_clipped.mask).sum(axis=0)
+    # Compute the sigma-clipped mean for each column and record the number
+    # of pixels used.
+    col_cor, npix_cor = sigma_clipped_column_mean(diffimage, mask, sigma=3)
 
-    # Compute the net change to the image.
-    bias = np.nanmean(col_cor)
+    # Compute the net change to each image.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        bias = np.nanmean(col_cor, axis=-1)
 
     # Set the net bias to zero.
     if zero_bias:
-        col_cor = col_cor - bias
+        col_cor = col_cor - bias[:, np.newaxis]
 
-    # Apply the 1/f correction to the image.
-    scidata_cor = scidata - col_cor
+    # Apply the 1/f correction to the images.
+    scidata_cor = scidata - col_cor[:, np.newaxis, :]
 
     return scidata_cor, col_cor, npix_cor, bias
 
@@ -16,15 +16,18 @@
 
 # Loop on orders to create convolved image
 
+import contextlib
 import numpy as np
 from skimage.transform import downscale_local_mean, resize
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import os.path
 from astropy.io import fits
 from astropy.io import ascii
 from astropy.table import Table
 import scipy.constants as sc_cst
 from scipy import interpolate #spline interpolation
+import scipy.signal
 import matplotlib.pyplot as plt
 import time as clocktimer
 
@@ -837,7 +840,7 @@ def seed_trace_geometry(simuPars, tracePars, spectral_order, models_grid_wv,
 
 def loictrace(simuPars, response, bin_models_wv, bin_starmodel_flux, bin_ld_coeff,
               bin_planetmodel_rprs, time, itime, solin, spectral_order, tracePars,
-              specpix_trace_offset=0, spatpix_trace_offset=0):
+              specpix_trace_offset=0, spatpix_trace_offset=0, subpixel=1):
     '''
     :param simuPars:
     :param response:
@@ -852,6 +855,7 @@ def loictrace(simuPars, response, bin_models_wv, bin_starmodel_flux, bin_ld_coef
     :param tracePars:
     :param specpix_trace_offset:
     :param spatpix_trace_offset:
+    :param subpixel: number of sub-columns per column used to seed the trace (see spread_trace)
     :return:
     '''
     # Get the pixel bounds, central wavelength and seed image dimensions
@@ -918,22 +922,14 @@ def loictrace(simuPars, response, bin_models_wv, bin_starmodel_flux, bin_ld_coef
     # Now need to distribute this flux along the y-axis using the trace centroid position
     # still want to seed a 1-pixel high trace. But in regions where the curvature is strong,
     # determine the center of mass of the flux (y * f) within a column as a better y position.
-    seedtrace = np.zeros((paddimy, paddimx))
     # for now just assign the value to all rows
     make_trace_straight = False
 
     if make_trace_straight is False:
-        # Assume that the flux is uniformly distributed.
-        for i in range(paddimx):
-            if True:
-                # Grey pixels
-                seedtrace[:, i] = np.transpose(spread_spatially(paddimy, y1[i], y2[i], pixelflux[i]))
-            else:
-                # Black or white pixels - was proven to produce large flux
-                # oscillations - do not use
-                ycenter = (y1[i]+y2[i])/2
-                seedtrace[int(np.round(ycenter)), i] = pixelflux[i]
+        # Assume that the flux is uniformly distributed (grey pixels), all columns at once.
+        seedtrace = spread_trace(paddimy, y1, y2, pixelflux, subpixel=subpixel)
     else:
+        seedtrace = np.zeros((paddimy, paddimx))
         # Generate horizontal straight traces without curvature.
         # This can be useful for testing and debugging.
         # Seed the 1, 2 3 traces so they are evenly spaced
@@ -1011,13 +1007,63 @@ def spread_spatially(dimy, y1, y2, flux):
     return column
 
 
+def spread_trace(dimy, y1, y2, flux, subpixel=1):
+    '''
+    Vectorized version of spread_spatially for all the columns of a seed image.
+    The flux of each column is spread uniformly between y1 and y2, over at
+    least 1 pixel centered on the trace, and each pixel receives the fraction
+    of that range that it overlaps. Flux falling outside the image is lost.
+    :param dimy: number of rows of the seed image
+    :param y1: array of the trace position at the left edge of each column
+    :param y2: array of the trace position at the right edge of each column
+    :param flux: array of the flux of each column
+    :param subpixel: number of sub-columns in which each column is split. The
+        trace position is interpolated linearly between y1 and y2 and each
+        sub-column spreads its share of the flux separately. The default of 1
+        reproduces spread_spatially.
+    :return: seed image of shape (dimy, number of columns)
+    '''
+    y1, y2, flux = np.asarray(y1, dtype=float), np.asarray(y2, dtype=float), np.asarray(flux, dtype=float)
+    ncol = np.size(flux)
+    col = np.arange(ncol)
+
+    if subpixel > 1:
+        # Split each column in sub-columns following the trace
+        frac = np.arange(subpixel + 1) / subpixel
+        edges = y1[:, np.newaxis] + (y2 - y1)[:, np.newaxis] * frac
+        y1, y2 = edges[:, :-1].ravel(), edges[:, 1:].ravel()
+        flux = np.repeat(flux / subpixel, subpixel)
+        col = np.repeat(col, subpixel)
+
+    # Range over which the flux is spread, at least 1 pixel
+    center = (y1 + y2) / 2
+    width = np.maximum(np.abs(y2 - y1), 1.0)
+    ylo, yhi = center - width / 2, center + width / 2
+    flux_density = flux / width
+
+    # Pixels overlapped by each range. A y pixel runs from -0.5 to +0.5 (center at 0)
+    pixmin = np.floor(ylo + 0.5).astype(int)
+    npix = np.max(np.floor(yhi + 0.5).astype(int) - pixmin) + 1
+    pix = pixmin[:, np.newaxis] + np.arange(npix)
+    overlap = np.minimum(yhi[:, np.newaxis], pix + 0.5) - np.maximum(ylo[:, np.newaxis], pix - 0.5)
+    values = np.clip(overlap, 0, None) * flux_density[:, np.newaxis]
+
+    # Scatter into the image
+    valid = (pix >= 0) & (pix < dimy) & (values != 0)
+    index = pix * ncol + col[:, np.newaxis]
+    seedtrace = np.bincount(index[valid], weights=values[valid], minlength=dimy * ncol)
+
+    return seedtrace.reshape((dimy, ncol))
+
+
 def add_wings(convolved_slice, noversample):
     '''
     Takes an image of the convolved trace and extends the wings across the
     image along the columns, assuming that the wing slop eis constant (in log(flux)).
+    All columns are processed at once and the image is modified in place.
     :param convolved_slice: a 2D image of the convolved trace, may be oversampled
     :param noversample: the oversampling of the image
-    :return:
+    :return: convolved_slice, with the wings added
     '''
 
     # The wings are roughly a linear trend in log(flux). CV3 characterization
@@ -1032,49 +1078,36 @@ def add_wings(convolved_slice, noversample):
 
     # Obtain the image dimensions
     dimy, dimx = np.shape(convolved_slice)
-    # Repeat for each column
-    for col in range(dimx):
-        data = np.copy(convolved_slice[:,col])
-        indzero = np.where(data < fluxthreshold)[0]
-        nzero = np.size(indzero)
-        indtrace = np.where(data >= fluxthreshold)[0]
-        ntrace = np.size(indtrace)
-        # A branch of possibilities here
-        if nzero < dimy:
-            # Go further unless all pixels of this column are zero
-            indmax = np.max(indtrace)
-            indmin = np.min(indtrace)
-            if indmax < dimy-1:
-                # At least 1 pixel is zero at the top of the column
-                # take value of pixel below and extend across column above
-                logflux = np.log10(fluxthreshold) + slope * np.arange(dimy - indmax) / noversample
-                # convolved_slice[indmax:,col] = np.exp(logflux)
-                convolved_slice[indmax:,col] = np.power(10, logflux)
-                if False:
-                    if col%100 == 0:
-                        plt.figure()
-                        y = np.arange(dimy)
-                        plt.scatter(y, np.log10(data), s=2)
-                        plt.scatter(y[indmax], np.log10(data[indmax]))
-                        y_wing = np.arange(dimy - indmax) + indmax
-                        plt.scatter(y_wing, logflux)
-            if indmin > 0:
-                # At least 1 pixel is zero at the bottom of the column
-                # take value of pixel above and extend across column below
-                logflux = np.log10(fluxthreshold) + slope * np.arange(indmin) / noversample
-                # convolved_slice[:indmin,col] = np.exp(np.flip(logflux))
-                convolved_slice[:indmin, col] = np.power(10, np.flip(logflux))
-                if False:
-                    if col%100 == 0:
-                        plt.scatter(y[indmax], np.log10(data[indmax]))
-                        y_wing = np.arange(indmin)
-                        plt.scatter(y_wing, np.flip(logflux))
-                        plt.plot(y, np.log10(convolved_slice[:,col]))
-                        plt.show()
+
+    # First and last rows of each column where the trace is above threshold
+    intrace = convolved_slice >= fluxthreshold
+    has_trace = np.any(intrace, axis=0)
+    indmin = np.argmax(intrace, axis=0).astype(np.int32)
+    indmax = (dimy - 1 - np.argmax(intrace[::-1, :], axis=0)).astype(np.int32)
+    intrace = None
+
+    # Wing flux as a function of the distance (in oversampled pixels) to the trace
+    logflux = np.log10(fluxthreshold) + slope * np.arange(dimy) / noversample
+    wing = np.power(10, logflux)
+    rows = np.arange(dimy, dtype=np.int32)[:, np.newaxis]
+
+    # At least 1 pixel is below threshold at the top of the column:
+    # extend the wing across the column above (starting at the last trace pixel)
+    distance = rows - indmax
+    extend = (distance >= 0) & (has_trace & (indmax < dimy - 1))
+    convolved_slice[extend] = wing[distance[extend]]
+
+    # At least 1 pixel is below threshold at the bottom of the column:
+    # extend the wing across the column below
+    distance = (indmin - 1) - rows
+    extend = (distance >= 0) & (has_trace & (indmin > 0))
+    convolved_slice[extend] = wing[distance[extend]]
+
     return convolved_slice
 
 
-def readmonochromatickernels(psfdir, wls=0.5, wle=5.2, dwl=0.05, os=4, wfe=0):
+def readmonochromatickernels(psfdir, wls=0.5, wle=5.2, dwl=0.05, os=4, wfe=0,
+                             cachedir=spgen.KERNEL_CACHE_DIR):
     """
     Inputs
      psfdir    : psf FITS files directory
@@ -1083,9 +1116,11 @@ def readmonochromatickernels(psfdir, wls=0.5, wle=5.2, dwl=0.05, os=4, wfe=0):
      dwl       : wavelength spacing for Kernels (uw)
      os        : amount of oversampling.  Much be an integer >=1.
      wfe       : WF map realization (integer between 0 and 9)
+     cachedir  : directory of the normalized kernels cache (see spgen.cached_kernels). None to disable.
+    Returns the normalized kernels (read-only float32 array) and their wavelengths (um)
     """
 
-    kernels = []
+    fnames = []
     kernels_wv = []
 
     # Handle the pixel oversampling
@@ -1112,30 +1147,187 @@ def readmonochromatickernels(psfdir, wls=0.5, wle=5.2, dwl=0.05, os=4, wfe=0):
         # fname=workdir+kerneldir+kdir+prename+wname+extname
         # (2020/09/02) New path in order to harmonize with rest of code
         fname = psfdir + prename + wname + extname
-        # print(fname)
-        hdulist = fits.open(fname)
-        # Extract data and rotate (ds9 to sim coordinates). Deprecated.
-        # kernel_1=hdulist[0].data.T
-        # Extract data (of PSFs generated in the DMS coordinates)
-        kernel_1 = hdulist[0].data
-        # Normalize PSF flux to 1
-        kernel_1 = kernel_1 / np.sum(kernel_1)
-        # Stack up each wavelength's PSF
-        kernels.append(np.copy(kernel_1))
+        fnames.append(fname)
         kernels_wv.append(np.float(wl))
 
-        hdulist.close()
-
         wl += dwl
 
-    return np.array(kernels), np.array(kernels_wv)
+    return spgen.cached_kernels(fnames, kernels_wv, (psfdir, os, wfe, wls, wle, dwl),
+                                cachedir=cachedir, mmap=True)
+
+
+def trace_time_basis(column_flux, reference_flux, rtol=1e-8):
+    '''
+    Decomposes the time variations of the flux seeded along a trace in a
+    low-rank basis. When the trace does not move, the seed image at time t is
+    the reference seed image with each column scaled by
+    column_flux[t] / reference_flux, i.e. sum_r coeffs[t, r] * basis[r]. The
+    seed being linear in the column fluxes, so is its convolution.
+    :param column_flux: (ntime, dimx) flux seeded in each column at each time step
+    :param reference_flux: (dimx) column flux of the reference seed image
+    :param rtol: singular values below rtol times the largest one are dropped
+    :return: coeffs (ntime, rank) and basis (rank, dimx) of the column scalings
+    '''
+    ratio = np.zeros_like(column_flux)
+    np.divide(column_flux, reference_flux, out=ratio, where=reference_flux > 0)
+
+    u, singular_values, vt = np.linalg.svd(ratio, full_matrices=False)
+    rank = max(1, int(np.sum(singular_values > rtol * singular_values[0])))
+    coeffs = u[:, :rank] * singular_values[:rank]
+
+    return coeffs, vt[:rank]
+
+
+# State attached by each worker of a ConvolutionPool (filled by _init_convolution_worker)
+_convolution_worker = {}
+
+
+def _init_convolution_worker(kernels_spec, trace_spec, kernel_shape, block_width,
+                             dtype=np.float64, max_cache_bytes=None):
+    '''
+    Initializer of the ConvolutionPool workers. Attaches, once per worker
+    process, the shared memory blocks holding the FFTs of the PSF kernels (or
+    the kernels themselves if max_cache_bytes is set) and the trace image, and
+    builds the worker's PSF convolver around them.
+    :param kernels_spec: (name, shape, dtype) of the shared kernel FFT cube, or
+                         of the shared kernel cube if max_cache_bytes is set
+    :param trace_spec: (name, shape, dtype) of the shared trace image
+    :param kernel_shape: (ky, kx) of the PSF kernels
+    :param block_width: overlap-add block width of the convolver
+    :param dtype: precision of the FFTs (lazy kernel FFTs only)
+    :param max_cache_bytes: size of the kernel FFT cache of each worker, None
+                            if the kernel FFTs are shared
+    '''
+    for key, (name, shape, spec_dtype) in (('kernels', kernels_spec), ('trace', trace_spec)):
+        shm = shared_memory.SharedMemory(name=name)
+        # Keep a reference to the shared memory block or the buffer gets unmapped
+        _convolution_worker[key+'_shm'] = shm
+        _convolution_worker[key] = np.ndarray(shape, dtype=spec_dtype, buffer=shm.buf)
+    if max_cache_bytes is None:
+        _convolution_worker['convolver'] = spgen.PSFConvolver.from_kernels_ft(
+            _convolution_worker['kernels'], kernel_shape, trace_spec[1], block_width=block_width)
+    else:
+        _convolution_worker['convolver'] = spgen.PSFConvolver(
+            _convolution_worker['kernels'], trace_spec[1], block_width=block_width,
+            dtype=dtype, max_cache_bytes=max_cache_bytes)
+
+
+def _convolve_wv_chunk(wv_indices, fac):
+    '''
+    Convolves the shared trace image with a subgroup of the PSF kernels
+    and returns the sum of the weighted convolved traces.
+    :param wv_indices: indices of the PSF kernels to process
+    :param fac: column weights of those kernels, shape (len(wv_indices), dimx)
+    :return: 2D image, sum of the convolved traces of the subgroup
+    '''
+    convolver = _convolution_worker['convolver']
+
+    return convolver.convolve(_convolution_worker['trace'], fac, wv_indices=wv_indices)
+
+
+class ConvolutionPool():
+    '''
+    Long-lived pool of worker processes convolving seeded trace images with the
+    monochromatic PSF kernels (see spgen.PSFConvolver). The kernel FFTs are
+    computed and published once in shared memory (or, with max_cache_bytes,
+    the kernels are published and each worker computes their FFTs lazily in a
+    bounded cache) and each trace image is
+    copied in a shared buffer, so that tasks only carry kernel indices and
+    column weights. Each worker returns the sum of its share of the
+    wavelengths rather than one image per wavelength.
+
+    Usage:
+        with ConvolutionPool(kernels, (dimy, dimx), ncpu=16) as pool:
+            convolved = pool.convolve(trace_image, fac)
+    '''
+
+    def __init__(self, kernels, image_shape, ncpu=16, dtype=np.float64, max_cache_bytes=None):
+        '''
+        :param kernels: cube of monochromatic PSF kernels (nwv, ky, kx)
+        :param image_shape: (dimy, dimx) of the padded, oversampled trace images
+        :param ncpu: number of worker processes
+        :param dtype: precision of the FFTs, np.float64 or np.float32 (see spgen.PSFConvolver)
+        :param max_cache_bytes: if set, only the kernels are shared and each worker
+                    keeps at most max_cache_bytes of kernel FFTs (see spgen.PSFConvolver).
+                    Default is None, all the kernel FFTs are shared.
+        '''
+        self.ncpu = ncpu
+        self.image_shape = tuple(image_shape)
+
+        if max_cache_bytes is None:
+            # Compute the kernel FFTs once, directly in shared memory, for the whole run
+            convolver = spgen.PSFConvolver(kernels, self.image_shape, dtype=dtype, max_cache_bytes=0)
+            self._kernels_shm = shared_memory.SharedMemory(create=True, size=convolver.kernels_ft_nbytes)
+            shared_kernels = np.ndarray((convolver.nkernel,) + convolver.ft_shape, dtype=convolver.ft_dtype,
+                                        buffer=self._kernels_shm.buf)
+            convolver.compute_kernels_ft(out=shared_kernels)
+            del convolver
+        else:
+            # Publish the kernels, their FFTs are computed by the workers
+            kernels = np.asarray(kernels, dtype=np.float64)
+            self._kernels_shm = shared_memory.SharedMemory(create=True, size=kernels.nbytes)
+            shared_kernels = np.ndarray(kernels.shape, dtype=kernels.dtype, buffer=self._kernels_shm.buf)
+            shared_kernels[:] = kernels
+        kernels_spec = (self._kernels_shm.name, shared_kernels.shape, shared_kernels.dtype)
+        del shared_kernels
+
+        # Buffer in which each trace image is handed over to the workers
+        nbytes = int(np.prod(self.image_shape)) * np.dtype(np.float64).itemsize
+        self._trace_shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.trace = np.ndarray(self.image_shape, dtype=np.float64, buffer=self._trace_shm.buf)
+
+        trace_spec = (self._trace_shm.name, self.image_shape, np.float64)
+        kernel_shape = np.shape(kernels)[1:]
+        self.pool = mp.Pool(processes=ncpu, initializer=_init_convolution_worker,
+                            initargs=(kernels_spec, trace_spec, kernel_shape, kernel_shape[1],
+                                      dtype, max_cache_bytes))
+
+    def convolve(self, trace_image, fac):
+        '''
+        Convolves a seeded trace image with all the monochromatic PSF kernels.
+        :param trace_image: 2D seeded trace image of shape image_shape
+        :param fac: column weights of each kernel, shape (nwv, dimx). See spgen.convolve_1wv_weights
+        :return: 2D image, the sum over all kernels of the weighted convolved traces
+        '''
+        self.trace[:] = trace_image
+
+        # Only the wavelengths whose weight is non zero on at least one column contribute
+        wv_indices = np.where(np.any(fac > 0, axis=1))[0]
+        nchunk = max(1, min(self.ncpu, wv_indices.size))
+        results = [self.pool.apply_async(_convolve_wv_chunk, args=(chunk, fac[chunk]))
+                   for chunk in np.array_split(wv_indices, nchunk) if chunk.size > 0]
+
+        # Wait for all workers before the trace buffer can be reused
+        convolved = np.zeros(self.image_shape)
+        for result in results:
+            convolved += result.get()
+
+        return convolved
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        # Views on the shared buffers must be released before closing them
+        self.trace = None
+        for shm in (self._kernels_shm, self._trace_shm):
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.pool.terminate()
+        self.close()
 
 
 def generate_traces(savingprefix, pathPars, simuPars, tracePars, throughput,
                     star_angstrom, star_flux, ld_coeff,
                     planet_angstrom, planet_rprs,
                     timesteps, granularitytime,
-                    specpix_trace_offset=0.0, spatpix_trace_offset=0.0):
+                    specpix_trace_offset=0.0, spatpix_trace_offset=0.0, ncpu=16,
+                    separable=False, separable_rtol=1e-8, cube_filename=None):
     '''
     :param pathPars:
     :param simuPars:
@@ -1149,7 +1341,19 @@ def generate_traces(savingprefix, pathPars, simuPars, tracePars, throughput,
     :param timesteps: clock time of the whole frame or integration series (in seconds)
     :param granularitytime: time duration of each frame or integration (in seconds)
     :param trace_position_dxdy:
-    :return:
+    :param ncpu: number of worker processes used for the PSF convolutions
+    :param separable: if True and the trace does not move, the seeded traces of
+        all time steps are decomposed in a low-rank basis (see trace_time_basis)
+        that is convolved once. Each time step is then a linear combination of
+        the convolved basis images.
+    :param separable_rtol: relative singular value threshold of that basis
+    :param cube_filename: if set, all time steps are streamed into that single
+        FITS cube (see SimulationCubeWriter) and the seeded traces into a second cube
+        named with a _trace suffix, instead of two FITS files per time step.
+    :return: list of the per time step FITS files. With cube_filename, a
+        SimulationCubeList that can be used in the same way (indexed, iterated,
+        passed to write_dmsready_fits_init or smag.measure_actual_flux) but
+        reads each time step lazily from the cube.
     '''
 
     # output is a cube (1 slice per spectral order) at the requested
@@ -1262,114 +1466,128 @@ def generate_traces(savingprefix, pathPars, simuPars, tracePars, throughput,
     convolved_image=np.zeros((nimage,ymax,xmax))
     trace_image=np.zeros((nimage,ymax,xmax))
 
+    # The convolve-once mode requires the same trace position at all time steps
+    if separable and ((np.size(np.unique(specpix_offset_array)) > 1) or
+                      (np.size(np.unique(spatpix_offset_array)) > 1)):
+        print('Warning. Trace position offsets vary with time, separable mode is turned off.')
+        separable = False
+
     # list of temporary filenames
     filelist = []
-    # Loop over all time steps for the entire Time-Series duration
-    for t in range(len(timesteps)):
-        # Loop over all spectral orders
-        for m in range(len(simuPars.orderlist)):
-            spectral_order = int(np.copy(simuPars.orderlist[m]))  # very important to pass an int here or tracepol fails
-            currenttime = second2day(timesteps[t])
-            exposetime = second2day(granularitytime)
-            print('Time step {:} hours - Order {:}'.format(currenttime*24, spectral_order))
-            if False:
-                pixels=spgen.gen_unconv_image(simuPars, throughput, star_angstrom_bin, star_flux_bin,
-                                      ld_coeff_bin, planet_rprs_bin,
-                                      currenttime, exposetime, solin, spectral_order, tracePars)
-
-                pixels_t=np.copy(pixels.T)
-            else:
-                print('     Seeding flux onto a narrow trace on a 2D image')
-                pixels_t = loictrace(simuPars, throughput, star_angstrom_bin, star_flux_bin,
+    with contextlib.ExitStack() as stack:
+        # One pool of workers for the whole run, the kernels are shared once
+        convolution_pool = stack.enter_context(ConvolutionPool(kernel_resize, (ymax, xmax), ncpu=ncpu))
+        # Single cubes receiving all time steps, if requested
+        if cube_filename is not None:
+            cube_writer = stack.enter_context(
+                SimulationCubeWriter(cube_filename, len(timesteps), nimage, ymax, xmax, simuPars))
+            trace_cube_writer = stack.enter_context(
+                SimulationCubeWriter(os.path.splitext(cube_filename)[0]+'_trace.fits',
+                                     len(timesteps), nimage, ymax, xmax, simuPars))
+
+        if separable:
+            # Seed all time steps, decompose the column fluxes in a time basis
+            # and convolve each basis image only once per order.
+            separable_basis = []
+            for m in range(len(simuPars.orderlist)):
+                spectral_order = int(np.copy(simuPars.orderlist[m]))
+                print('Separable mode - Order {:} - Seeding all time steps'.format(spectral_order))
+                column_flux = np.zeros((len(timesteps), xmax))
+                reference_seed = None
+                for t in range(len(timesteps)):
+                    seed = loictrace(simuPars, throughput, star_angstrom_bin, star_flux_bin,
                                      ld_coeff_bin, planet_rprs_bin,
-                                     currenttime, exposetime, solin, spectral_order, tracePars,
+                                     second2day(timesteps[t]), second2day(granularitytime), solin,
+                                     spectral_order, tracePars,
                                      specpix_trace_offset=specpix_offset_array[t],
                                      spatpix_trace_offset=spatpix_offset_array[t])
-
-
-
-            if False:
-                # Replace by a simple horizontal trace of intensity 10000
-                a = np.zeros_like(pixels_t)
-                a[500,:] = 10000
-                pixels_t = a
-
-
-            #Enable threads (not working?!?!)
-            #pyfftw.config.NUM_THREADS = 1 #do not need multi-cpu for pools
-            #with scipy.fft.set_backend(pyfftw.interfaces.scipy_fft):
-            # Turn on the cache for optimum performance
-            #pyfftw.interfaces.cache.enable()
-
-            #do the convolution
-            print('     Convolving trace with monochromatic PSFs')
-            # x=pixels_t*0+1.0e-10
-
-            # Identify wavelengths whose wings fall on the detector
-            wv_indices = spgen.convolve_1wv_wave_indices(kernel_resize, kernels_wv, simuPars, spectral_order, tracePars)
-            kernels_wv_subgroup = kernels_wv[wv_indices]
-            kernel_resize_subgroup = kernel_resize[wv_indices,:,:]
-
-            nwv=len(kernels_wv_subgroup) #number of wavelengths to process
-            #pbar = tqdm_notebook(total=nwv)  #Will make a progressbar to monitor processing.
-            ncpu = 16
-            pool = mp.Pool(processes=ncpu)  #Use lots of threads - because we can!
-
-            #arguments = (pixels_t, kernel_resize, kernels_wv, wv_idx, simuPars, spectral_order, tracePars,)
-            #results = [pool.apply_async(spgen.convolve_1wv, args = (pixels_t, kernel_resize, kernels_wv, wv_idx, simuPars, spectral_order, tracePars,), callback=barupdate) for wv_idx in range(nwv)]
-            tic = clocktimer.perf_counter()
-
-
-            results = [pool.apply_async(spgen.convolve_1wv, args = (pixels_t, kernel_resize_subgroup, kernels_wv_subgroup, wv_idx, simuPars, spectral_order, tracePars,)) for wv_idx in range(nwv)]
-
-
-            pixels_c = [p.get() for p in results]
-
-            pool.close()
-            pool.join()
-
-            # Save the intermediate convolutions
-            #if spectral_order == 1:
-            #    dimy, dimx = np.shape(pixels_t)
-            #    conv_intermediate = np.zeros((nwv, dimy, dimx))
-
-            #bring together the results
-            x=pixels_t*0+1.0e-10
-            n = 0
-            for p in pixels_c:
-                x+=p
-                #if spectral_order == 1: conv_intermediate[n, :, :] = np.copy(p)
-                n = n + 1
-
-            toc = clocktimer.perf_counter()
-            print('     Elapsed time = {:.4f}'.format(toc - tic))
-            pixels_c=None #release Memory
-
-            #if spectral_order == 1:
-            #    h = fits.PrimaryHDU(conv_intermediate)
-            #    h.writeto('/genesis/jwst/userland-soss/loic_review/convolved_intermediate.fits', overwrite=True)
-            #    conv_intermediate=None
-
-            trace_image[m,:,:] = np.copy(pixels_t)
-            convolved_image[m,:,:] = np.copy(x) - 1e-10
-
-            # Sum in the flux for that order
-            y1 = simuPars.ypadding * simuPars.noversample
-            y2 = y1 + simuPars.yout * simuPars.noversample
-            x1 = simuPars.xpadding * simuPars.noversample
-            x2 = x1 + simuPars.xout * simuPars.noversample
-            actual_counts = np.sum(convolved_image[m,y1:y2,x1:x2])
-            print('     Actual counts measured on the simulation = {:} e-/sec'.format(actual_counts))
-
-            # Extend wings across the columns (neglect the flux associated with it)
-            if simuPars.addwings == True:
-                convolved_image[m,:,:] = add_wings(convolved_image[m,:,:], simuPars.noversample)
-
+                    column_flux[t] = np.sum(seed, axis=0)
+                    # The brightest time step (out of transit) is the reference
+                    if (reference_seed is None) or (np.sum(column_flux[t]) > np.sum(reference_seed)):
+                        reference_seed = seed
+                coeffs, basis = trace_time_basis(column_flux, np.sum(reference_seed, axis=0),
+                                                 rtol=separable_rtol)
+                print('     Convolving {:} basis images with monochromatic PSFs'.format(len(basis)))
+                fac = spgen.convolve_1wv_weights(kernels_wv, simuPars, spectral_order, tracePars)
+                convolved_basis = np.array([convolution_pool.convolve(reference_seed * b, fac) for b in basis])
+                separable_basis.append((reference_seed, coeffs, basis, convolved_basis))
             print()
 
-        tmp = write_intermediate_fits(trace_image, savingprefix+'_trace', t, simuPars)
-        tmpfilename = write_intermediate_fits(convolved_image, savingprefix, t, simuPars)
-        filelist.append(tmpfilename)
+        # Loop over all time steps for the entire Time-Series duration
+        for t in range(len(timesteps)):
+            # Loop over all spectral orders
+            for m in range(len(simuPars.orderlist)):
+                spectral_order = int(np.copy(simuPars.orderlist[m]))  # very important to pass an int here or tracepol fails
+                currenttime = second2day(timesteps[t])
+                exposetime = second2day(granularitytime)
+                print('Time step {:} hours - Order {:}'.format(currenttime*24, spectral_order))
+                if separable:
+                    print('     Combining the convolved time basis images')
+                    reference_seed, coeffs, basis, convolved_basis = separable_basis[m]
+                    pixels_t = reference_seed * np.dot(coeffs[t], basis)
+                    x = np.tensordot(coeffs[t], convolved_basis, axes=1)
+                else:
+                    if False:
+                        pixels=spgen.gen_unconv_image(simuPars, throughput, star_angstrom_bin, star_flux_bin,
+                                              ld_coeff_bin, planet_rprs_bin,
+                                              currenttime, exposetime, solin, spectral_order, tracePars)
+
+                        pixels_t=np.copy(pixels.T)
+                    else:
+                        print('     Seeding flux onto a narrow trace on a 2D image')
+                        pixels_t = loictrace(simuPars, throughput, star_angstrom_bin, star_flux_bin,
+                                             ld_coeff_bin, planet_rprs_bin,
+                                             currenttime, exposetime, solin, spectral_order, tracePars,
+                                             specpix_trace_offset=specpix_offset_array[t],
+                                             spatpix_trace_offset=spatpix_offset_array[t])
+
+
+
+                    if False:
+                        # Replace by a simple horizontal trace of intensity 10000
+                        a = np.zeros_like(pixels_t)
+                        a[500,:] = 10000
+                        pixels_t = a
+
+                    #do the convolution
+                    print('     Convolving trace with monochromatic PSFs')
+
+                    # Weight of each pixel column for each wavelength. Wavelengths whose
+                    # weights are all zero on the detector are skipped by the pool.
+                    fac = spgen.convolve_1wv_weights(kernels_wv, simuPars, spectral_order, tracePars)
+
+                    tic = clocktimer.perf_counter()
+                    x = convolution_pool.convolve(pixels_t, fac)
+                    toc = clocktimer.perf_counter()
+                    print('     Elapsed time = {:.4f}'.format(toc - tic))
+
+                trace_image[m,:,:] = np.copy(pixels_t)
+                convolved_image[m,:,:] = np.copy(x)
+
+                # Sum in the flux for that order
+                y1 = simuPars.ypadding * simuPars.noversample
+                y2 = y1 + simuPars.yout * simuPars.noversample
+                x1 = simuPars.xpadding * simuPars.noversample
+                x2 = x1 + simuPars.xout * simuPars.noversample
+                actual_counts = np.sum(convolved_image[m,y1:y2,x1:x2])
+                print('     Actual counts measured on the simulation = {:} e-/sec'.format(actual_counts))
+
+                # Extend wings across the columns (neglect the flux associated with it)
+                if simuPars.addwings == True:
+                    add_wings(convolved_image[m,:,:], simuPars.noversample)
+
+                print()
+
+            if cube_filename is not None:
+                trace_cube_writer.write(trace_image)
+                cube_writer.write(convolved_image)
+            else:
+                tmp = write_intermediate_fits(trace_image, savingprefix+'_trace', t, simuPars)
+                tmpfilename = write_intermediate_fits(convolved_image, savingprefix, t, simuPars)
+                filelist.append(tmpfilename)
+
+    if cube_filename is not None:
+        return(SimulationCubeList(cube_filename))
 
     return(filelist)
 
@@ -1465,60 +1683,184 @@ def write_intermediate_fits(image, savingprefix, timestep_index, simuPars):
 
     return(filename_current)
 
+class SimulationCubeWriter():
+    '''
+    Writes the time steps of a simulation, each a (norder, dimy, dimx) image,
+    one after the other into a single float32 FITS cube of shape
+    (ntime, norder, dimy, dimx). The dimensions are set in the header when the
+    file is created (astropy StreamingHDU), so each time step goes to disk as
+    soon as it is simulated. Read it back lazily with read_simulation_cube.
+
+    Usage:
+        with SimulationCubeWriter(filename, ntime, norder, dimy, dimx, simuPars) as writer:
+            for t in range(ntime):
+                writer.write(image)
+    '''
+
+    def __init__(self, filename, ntime, norder, dimy, dimx, simuPars):
+        self.filename = filename
+        self.shape = (ntime, norder, dimy, dimx)
+        self.nwritten = 0
+
+        header = fits.Header()
+        header['SIMPLE'] = True
+        header['BITPIX'] = -32
+        header['NAXIS'] = 4
+        header['NAXIS1'] = dimx
+        header['NAXIS2'] = dimy
+        header['NAXIS3'] = norder
+        header['NAXIS4'] = ntime
+        header['XPADDING'] = simuPars.xpadding
+        header['YPADDING'] = simuPars.ypadding
+        header['NOVRSAMP'] = simuPars.noversample
+
+        # create a directory if it does not yet exists
+        directory_name = os.path.dirname(filename)
+        if (directory_name != '') and (os.path.exists(directory_name) is False):
+            os.makedirs(directory_name)
+        # StreamingHDU appends to an existing file, start from scratch
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.hdu = fits.StreamingHDU(filename, header)
+
+    def write(self, image):
+        '''
+        Appends the next time step.
+        :param image: (norder, dimy, dimx) image of the current time step
+        '''
+        if self.nwritten == self.shape[0]:
+            raise ValueError('SimulationCubeWriter: all {:} time steps were already written to {:}'.format(
+                self.shape[0], self.filename))
+        self.hdu.write(np.asarray(image, dtype='>f4').reshape(self.shape[1:]))
+        self.nwritten += 1
+
+    def close(self):
+        self.hdu.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        # An incomplete cube is not a valid FITS file
+        if exc_type is not None and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class SimulationCubeStep(str):
+    '''
+    Name of a simulation cube (a str, so it can be passed where a per time
+    step FITS file name is expected) that also carries the time step index.
+    '''
+
+    def __new__(cls, filename, timestep):
+        self = super().__new__(cls, filename)
+        self.timestep = timestep
+        return self
+
+
+class SimulationCubeList(list):
+    '''
+    Stands for the list of per time step FITS files returned by generate_traces
+    when the time steps are in a single cube written by SimulationCubeWriter.
+    Each item is a SimulationCubeStep, the cube file name with its time step.
+    write_dmsready_fits_init and smag.measure_actual_flux read only that time
+    step from the cube.
+    '''
+
+    def __init__(self, filename):
+        with fits.open(filename, memmap=True) as hdulist:
+            ntime = hdulist[0].header['NAXIS4']
+        super().__init__(SimulationCubeStep(filename, t) for t in range(ntime))
+        self.filename = filename
+
+
+def read_simulation_cube(filename):
+    '''
+    Opens a simulation cube written by SimulationCubeWriter without reading it.
+    Slicing the returned array (e.g. cube[t]) only reads that time step from disk.
+    :param filename:
+    :return: memory-mapped (ntime, norder, dimy, dimx) float32 array
+    '''
+    with fits.open(filename, memmap=True) as hdulist:
+        cube = hdulist[0].data
+
+    return cube
+
+
+def _read_rate_image(imagelist, t, normalization_scale, os=1):
+    '''
+    Reads the time step t of the output of generate_traces, bins it to native
+    pixels, scales each order by its normalization factor and sums the orders.
+    :return: (dimy, dimx) rate image
+    '''
+    item = imagelist[t]
+    if isinstance(item, SimulationCubeStep):
+        with fits.open(item, memmap=True) as hdu:
+            image = np.array(hdu[0].section[item.timestep], dtype=float)
+    else:
+        with fits.open(item) as hdu:
+            image = np.array(hdu[0].data)
+    image = rebin(image, os)
+    # Scale the flux for each order by the normalization factor passed as input
+    for m in range(np.shape(image)[0]):
+        image[m,:,:] = image[m,:,:] * normalization_scale[m]
+
+    return np.sum(image, axis=0)
+
+
 def write_dmsready_fits_init(imagelist, normalization_scale,
                              ngroup, nint, frametime, granularity,
-                             verbose=None, os=1):
+                             verbose=None, os=1, out=None):
+    '''
+    :param imagelist: list of the per time step FITS files returned by generate_traces,
+        or the SimulationCubeList (or cube file name) returned with cube_filename.
+        Time steps are read one at a time, only when a read needs them.
+    :param out: optional (nint, ngroup, dimy, dimx) array (e.g. a np.memmap) that
+        receives the reads, so that the exposure does not need to fit in memory.
+    '''
     if verbose:
         print('Entered write_dmsready_fits_init')
         print('imagelist =', imagelist)
         print('nint={:}, ngroup={:}, frametime={:} sec '.format(nint, ngroup, frametime))
         print('Granularity = {:}'.format(granularity))
 
-    ntimesteps = len(imagelist)
-    for t in range(ntimesteps):
-        # Read the current image
-        with fits.open(imagelist[t]) as hdu:
-            image = np.array(hdu[0].data)
-            image = rebin(image, os)
-            # Create the cube of reads (if first iteration in loop)
-            if t == 0:
-                # First image, use dimensiosn and create a large cube
-                norders, dimy, dimx = np.shape(image)
-                #print('Bug tracing - norder={:d} dimy={:d} dimx={:d}'.format(norders, dimy, dimx))
-                fluxratecube = np.zeros((ntimesteps, dimy, dimx))
-            # Scale the flux for each order by the normalization factor passed as input
-            for m in range(norders):
-                image[m,:,:] = image[m,:,:] * normalization_scale[m]
-            imflat = np.sum(image, axis=0)
-            fluxratecube[t,:,:] = np.copy(imflat)
+    if isinstance(imagelist, str):
+        imagelist = SimulationCubeList(imagelist)
 
     # At this point, each image is a slope image (calibrated flux per second) for
     # a chunk of time that is either at the frame granularity or at the integration
     # granularity. It is time to divide in frame with the properly scaled flux as
     # happens during an integraiton.
-    #ngroup = np.copy(simuPars.ngroup)
-    #nint = np.copy(simuPars.nint)
-    #frametime = np.copy(simuPars.frametime)
     print('nint={:}, ngroup={:}, frametime={:} sec '.format(nint,ngroup,frametime))
 
-    # Initialize the exposure array containing up-the-ramp reads.
-    exposure = np.zeros((nint, ngroup, dimy, dimx), dtype=float)
+    # Initialize the exposure array containing up-the-ramp reads, its size
+    # is that of the first rate image.
+    rate = _read_rate_image(imagelist, 0, normalization_scale, os=os)
+    dimy, dimx = np.shape(rate)
+    if out is None:
+        exposure = np.zeros((nint, ngroup, dimy, dimx), dtype=float)
+    else:
+        exposure = out
     if granularity == 'FRAME':
         # Then we already have a rate image for each individual read.
         for i in range(nint):
             cumulative = np.zeros((dimy, dimx))
             for g in range(ngroup):
                 n = i*ngroup+g
-                cumulative = cumulative + fluxratecube[n,:,:] * frametime
-                print('i={:} g={:} n={:} flux={:} rate={:}'.format(i,g,n,np.sum(cumulative),np.sum(fluxratecube[n,:,:])))
-                exposure[i, g, :, :] = np.copy(cumulative.reshape((1,1,dimy,dimx)))
+                if n > 0:
+                    rate = _read_rate_image(imagelist, n, normalization_scale, os=os)
+                cumulative = cumulative + rate * frametime
+                print('i={:} g={:} n={:} flux={:} rate={:}'.format(i,g,n,np.sum(cumulative),np.sum(rate)))
+                exposure[i, g, :, :] = cumulative
     elif granularity == 'INTEGRATION':
         # We need to create ngroup reads per simulated rate image.
         for i in range(nint):
+            if i > 0:
+                rate = _read_rate_image(imagelist, i, normalization_scale, os=os)
             for g in range(ngroup):
-                n = np.copy(i)
                 print('{:} {:}'.format(i,g))
-                exposure[i, g, :, :] = fluxratecube[n, :, :].reshape((1, 1, dimy, dimx)) * frametime * (g+1)
+                exposure[i, g, :, :] = rate * frametime * (g+1)
     else:
         print('We are missing the granularity parameter in the simulation.')
         sys.exit()
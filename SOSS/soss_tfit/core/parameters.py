@@ -189,6 +189,14 @@ params.set(key='CORBETA', value=dict(trail=1, full=0.3), source=__NAME__,
            desc='correction to beta term for deMCMC vector jump',
            dtype=dict, path='mcmc_params.corbeta')
 
+# Number of steps between two checkpoints of the walker chains
+#      (set to 0 to only save a checkpoint at the end of each loop)
+params.set(key='CHECKPOINT_INTERVAL', value=10000, source=__NAME__,
+           desc='Number of steps between two checkpoints of the walker '
+                'chains\n\t(set to 0 to only save a checkpoint at the end '
+                'of each loop)',
+           dtype=int, path='mcmc_params.checkpoint_interval')
+
 # Number of walker threads
 #      Must be equal to 1 or a multiple of the number of walkers
 params.set(key='N_WALKER_THREADS', value=1, source=__NAME__,
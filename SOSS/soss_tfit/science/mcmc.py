@@ -11,6 +11,7 @@ Created on 2022-04-06
 """
 from astropy.io import fits
 from astropy.table import Table
+import hashlib
 import numpy as np
 import os
 import pickle
@@ -133,6 +134,9 @@ class TransitFit:
     # the rejection [rejected, parameter number]   where rejected = 0 for
     #   accepted and rejected = 1 for rejected
     ac: List[int]
+    # the per bandpass loglikelihood cache (p0 [n_param, n_phot], loglikelihood
+    #   of each bandpass [n_phot]) or None if not computed yet
+    llcache: Optional[Tuple[np.ndarray, np.ndarray]]
 
     def __init__(self):
         # the number of integrations we have
@@ -199,6 +203,9 @@ class TransitFit:
         # the rejection [rejected, parameter number]   where rejected = 0 for
         #   accepted and rejected = 1 for rejected
         self.ac = []
+        # the per bandpass loglikelihood cache (p0 [n_param, n_phot],
+        #   loglikelihood of each bandpass [n_phot]) - never modified in place
+        self.llcache = None
 
     def __getstate__(self) -> dict:
         """
@@ -288,6 +295,9 @@ class TransitFit:
         # the rejection [rejected, parameter number]   where rejected = 0 for
         #   accepted and rejected = 1 for rejected
         new.ac = []
+        # the per bandpass loglikelihood cache (never modified in place so
+        #    can be shared)
+        new.llcache = self.llcache
         # ---------------------------------------------------------------------
         return new
 
@@ -705,6 +715,32 @@ def lnpriors(tfit) -> float:
     return logl
 
 
+def changed_bandpasses(tfit, sol: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the bandpasses whose loglikelihood must be recomputed for the trial
+    solution, i.e. those where any parameter differs from the solution the
+    cached loglikelihood was computed for. A Gibbs step on a chromatic
+    parameter changes a single bandpass, a step on a shared parameter
+    (e.g. T0, RHO_STAR, PERIOD) or a deMCMC jump changes them all.
+
+    :param tfit: the transit fit class
+    :param sol: np.ndarray - the trial solution [n_param, n_phot]
+
+    :return: tuple, 1. the bandpasses to recompute (bool [n_phot])
+                    2. a copy of the cached loglikelihood of each bandpass
+                       [n_phot] (to be updated for the changed bandpasses)
+    """
+    # nothing cached (or cache from a different set up) --> compute all
+    if tfit.llcache is None or tfit.llcache[0].shape != sol.shape:
+        return np.ones(tfit.n_phot, dtype=bool), np.zeros(tfit.n_phot)
+    # get the cached solution and loglikelihood terms
+    cache_sol, cache_terms = tfit.llcache
+    # any parameter change in a bandpass forces recomputing it
+    changed = np.any(sol != cache_sol, axis=0)
+    # return the bandpasses to recompute and the terms to update
+    return changed, np.array(cache_terms)
+
+
 def lnprob(tfit: TransitFit) -> float:
     """
     The loglikelihood function
@@ -771,8 +807,10 @@ def lnprob(tfit: TransitFit) -> float:
     # -------------------------------------------------------------------------
     # QUESTION: Can we parallelize this?
     # QUESTION: If one phot_it is found to be inf, we can skip rest?
+    # only recompute the band passes that changed since the cached solution
+    changed, lnl_terms = changed_bandpasses(tfit, sol)
     # loop around band passes
-    for phot_it in range(n_phot):
+    for phot_it in np.where(changed)[0]:
         # check dscale, ascale and lscale hyper parameters
         #    (they must be positive)
         if (dscale[phot_it] <= 0.0) and fit_error_scale:
@@ -796,13 +834,17 @@ def lnprob(tfit: TransitFit) -> float:
                 sum1 = np.sum(log1)
                 sqrdiff = (flux[phot_it] - model)**2
                 sum2 = np.sum(sqrdiff / (fluxerr**2 * dscale[phot_it]**2))
-                logl += -0.5 * (sum1 + sum2)
+                lnl_terms[phot_it] = -0.5 * (sum1 + sum2)
+            else:
+                lnl_terms[phot_it] = 0.0
         # else we return our bad log likelihood
         else:
             return BADLPR
+    # update the cache (mhg_mcmc / de_mhg_mcmc restore it on rejection)
+    tfit.llcache = (sol, lnl_terms)
     # if we have got to here we return the good loglikelihood (sum of each
     #   bandpass)
-    return logl
+    return logl + np.sum(lnl_terms)
 
 
 def mhg_mcmc(tfit: TransitFit, loglikelihood: Any, beta: np.ndarray,
@@ -857,6 +899,7 @@ def mhg_mcmc(tfit: TransitFit, loglikelihood: Any, beta: np.ndarray,
     else:
         tfit.x0 = np.array(tfit0.x0)
         tfit.p0 = np.array(tfit0.p0)
+        tfit.llcache = tfit0.llcache
         tfit.ac = [1, tfit.n_tmp]
     # return tfit instance
     return tfit
@@ -922,6 +965,7 @@ def de_mhg_mcmc(tfit: TransitFit, loglikelihood: Any, beta: np.ndarray,
     else:
         tfit.x0 = np.array(tfit0.x0)
         tfit.p0 = np.array(tfit0.p0)
+        tfit.llcache = tfit0.llcache
         tfit.ac = [1, tfit.n_tmp]
     # return tfit instance
     return tfit
@@ -973,7 +1017,7 @@ def beta_rescale(params: ParamDict, tfit: TransitFit,
     # print progress
     cprint('Beta Rescale: Initial Gen Chain', level='info')
     # initial run of gen chain
-    hchain, hrejects = genchain(tfit, nsteps, tfit.beta, mcmcfunc,
+    hchain, hrejects, _ = genchain(tfit, nsteps, tfit.beta, mcmcfunc,
                                 loglikelihood, progress=True)
     # update x0 and p0 with the last chain
     tfitb = update_x0_p0_from_chain(tfitb, hchain, -1)
@@ -1020,7 +1064,7 @@ def beta_rescale(params: ParamDict, tfit: TransitFit,
         # print progress
         cprint(f'Beta Rescale: Gen Chain loop {nloop}')
         # initial run of gen chain
-        hchain, hrejects = genchain(tfit, nsteps, beta_in, mcmcfunc,
+        hchain, hrejects, _ = genchain(tfit, nsteps, beta_in, mcmcfunc,
                                     loglikelihood, progress=True)
         # update x0 and p0 with the last chain
         tfitb = update_x0_p0_from_chain(tfitb, hchain, -1)
@@ -1081,7 +1125,12 @@ def genchain(tfit: TransitFit, niter: int, beta: np.ndarray,
              buffer: Optional = None, corbeta: float = 1.0,
              progress: bool = False,
              nwalker: Optional[int] = None,
-             ngroup: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+             ngroup: Optional[int] = None,
+             checkpoint: Optional[str] = None,
+             checkpoint_interval: int = 0,
+             nloop: int = 0,
+             run_id: Optional[str] = None
+             ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     Generate Markov Chain
 
@@ -1102,32 +1151,56 @@ def genchain(tfit: TransitFit, niter: int, beta: np.ndarray,
                     as a buffer (mcmcfunc=deMCMC only)
     :param progress: bool, if True uses tqdm to print progress of the
                      MCMC chain
+    :param checkpoint: str, if set the chain is saved to this file (.npz)
+                       every checkpoint_interval steps, and resumed from it
+                       if it already exists for this run and loop
+    :param checkpoint_interval: int, the number of steps between checkpoints
+    :param nloop: int, the sampler loop number (to check the checkpoint is
+                  for this loop)
+    :param run_id: str or None, the run identifier of the sampler (to check
+                   the checkpoint is for this run)
 
     :return: tuple, 1. chains (numpy array [n_iter, n_x])
                     2. rejects (numpy array [n_iter, 2]
                        where reject=(rejected 1 or 0, parameter num changed)
+                    3. loglikelihoods (numpy array [n_iter])
     """
     # deal with no buffer set
     if buffer is None:
         buffer = []
     # -------------------------------------------------------------------------
-    # Initialize list to hold chain values and set first value to the initial
-    #    solution
-    chains = [np.array(tfit.x0)]
+    # Initialize arrays to hold chain values and set first value to the
+    #    initial solution
+    chains = np.empty([niter + 1, tfit.n_x])
     # Track our acceptance rate - and set the first one to (0, 0)
     #    note reject=(rejected 1 or 0, parameter changed)
-    rejections = [(0, 0)]
-    # -------------------------------------------------------------------------
-    # pre-compute the first log-likelihood
-    tfit.llx = loglikelihood(tfit)
+    rejections = np.zeros([niter + 1, 2], dtype=int)
+    # Track the loglikelihood
+    lls = np.empty(niter + 1)
+    # -------------------------------------------------------------------------
+    # resume from the checkpoint of this loop or start from the initial
+    #   solution
+    start_it = load_chain_checkpoint(checkpoint, run_id, nloop, niter, tfit,
+                                     chains, rejections, lls)
+    if start_it == 0:
+        chains[0] = tfit.x0
+        # pre-compute the first log-likelihood
+        tfit.llx = loglikelihood(tfit)
+        lls[0] = tfit.llx
     # -------------------------------------------------------------------------
     # inner loop to save repeating code
-    def inner_loop_code(tfitloop: TransitFit):
+    def inner_loop_code(tfitloop: TransitFit, n_it: int):
         # run the mcmc function
         tfitloop = mcmcfunc(tfitloop, loglikelihood, beta, buffer, corbeta)
-        # append results to chains and rejections lists
-        chains.append(np.array(tfitloop.x0))
-        rejections.append(np.array(tfitloop.ac))
+        # push results into the chains, rejections and loglikelihood arrays
+        chains[n_it + 1] = tfitloop.x0
+        rejections[n_it + 1] = tfitloop.ac
+        lls[n_it + 1] = tfitloop.llx
+        # save a checkpoint every checkpoint_interval steps
+        if checkpoint is not None and checkpoint_interval > 0:
+            if (n_it + 1) % checkpoint_interval == 0:
+                save_chain_checkpoint(checkpoint, run_id, nloop, niter,
+                                      n_it + 1, chains, rejections, lls)
         return tfitloop
 
     # -------------------------------------------------------------------------
@@ -1138,7 +1211,7 @@ def genchain(tfit: TransitFit, niter: int, beta: np.ndarray,
         # store timings
         timings = [0.0]
         # loop around iterations
-        for n_it in range(0, niter):
+        for n_it in range(start_it, niter):
             # print every 10%
             if n_it % (0.1 * niter) == 0:
                 cprint(f'\tGroup={ngroup} walker={nwalker} '
@@ -1146,7 +1219,7 @@ def genchain(tfit: TransitFit, niter: int, beta: np.ndarray,
                        f' ({np.mean(timings):.3f} s/it)')
             # start time
             start = time.time()
-            tfit = inner_loop_code(tfit)
+            tfit = inner_loop_code(tfit, n_it)
             # add to timings
             timings.append(time.time() - start)
         # print timing
@@ -1155,21 +1228,103 @@ def genchain(tfit: TransitFit, niter: int, beta: np.ndarray,
     # deal with wanting to display process (linear run)
     elif progress:
         # loop around iterations
-        for _ in tqdm(range(0, niter)):
-            tfit = inner_loop_code(tfit)
+        for n_it in tqdm(range(start_it, niter)):
+            tfit = inner_loop_code(tfit, n_it)
     # otherwise display nothing
     else:
         # loop around iterations
-        for _ in range(0, niter):
-            tfit = inner_loop_code(tfit)
+        for n_it in range(start_it, niter):
+            tfit = inner_loop_code(tfit, n_it)
 
     # -------------------------------------------------------------------------
-    # convert lists to arrays
-    chains = np.array(chains)
-    rejections = np.array(rejections)
-    # -------------------------------------------------------------------------
-    # return the chains and rejections
-    return chains, rejections
+    # return the chains, rejections and loglikelihoods
+    return chains, rejections, lls
+
+
+def save_chain_checkpoint(filename: str, run_id: Optional[str], nloop: int,
+                          niter: int, n_done: int, chains: np.ndarray,
+                          rejections: np.ndarray, lls: np.ndarray):
+    """
+    Save the first n_done steps of a chain (and the random number generator
+    state) to a checkpoint file. The file is replaced atomically so a killed
+    job always leaves a readable checkpoint.
+
+    :param filename: str, the checkpoint filename (.npz)
+    :param run_id: str or None, the run identifier of the sampler
+    :param nloop: int, the sampler loop number
+    :param niter: int, the number of steps of the chain in this loop
+    :param n_done: int, the number of steps done
+    :param chains: np.ndarray, the chain [niter + 1, n_x]
+    :param rejections: np.ndarray, the rejections [niter + 1, 2]
+    :param lls: np.ndarray, the loglikelihoods [niter + 1]
+
+    :return: None, writes checkpoint to disk
+    """
+    # get the random number generator state
+    rname, rkeys, rpos, rhas_gauss, rgauss = np.random.get_state()
+    # write to a temporary file and then move it
+    tmpname = filename + '.tmp.npz'
+    np.savez(tmpname, run_id=str(run_id), nloop=nloop, niter=niter,
+             n_done=n_done, chains=chains[:n_done + 1],
+             rejections=rejections[:n_done + 1],
+             lls=lls[:n_done + 1], rng_name=rname, rng_keys=rkeys,
+             rng_pos=rpos, rng_has_gauss=rhas_gauss, rng_gauss=rgauss)
+    os.replace(tmpname, filename)
+
+
+def load_chain_checkpoint(filename: Optional[str], run_id: Optional[str],
+                          nloop: int, niter: int, tfit: TransitFit,
+                          chains: np.ndarray, rejections: np.ndarray,
+                          lls: np.ndarray) -> int:
+    """
+    Resume a chain from its checkpoint file (if it exists and was written
+    for this run and loop). Fills the start of chains, rejections and lls,
+    and restores tfit (x0, p0, llx) and the random number generator state.
+    A checkpoint left by another run (a run with the same OUTNAME but other
+    inputs, see sampler_run_id) is removed.
+
+    :param filename: str or None, the checkpoint filename (.npz)
+    :param run_id: str or None, the run identifier of the sampler
+    :param nloop: int, the sampler loop number
+    :param niter: int, the number of steps of the chain in this loop
+    :param tfit: Transit fit class of parameters
+    :param chains: np.ndarray, the chain [niter + 1, n_x]
+    :param rejections: np.ndarray, the rejections [niter + 1, 2]
+    :param lls: np.ndarray, the loglikelihoods [niter + 1]
+
+    :return: int, the number of steps already done (0 if not resumed)
+    """
+    # deal with no checkpoint
+    if filename is None or not os.path.exists(filename):
+        return 0
+    # load the checkpoint
+    with np.load(filename) as ckpt:
+        # a checkpoint from another run is stale (never resume it)
+        stale = 'run_id' not in ckpt.files or run_id is None
+        stale = stale or str(ckpt['run_id']) != str(run_id)
+        if not stale:
+            # only resume a checkpoint from this loop
+            if int(ckpt['nloop']) != nloop or int(ckpt['niter']) != niter:
+                return 0
+            n_done = int(ckpt['n_done'])
+            chains[:n_done + 1] = ckpt['chains']
+            rejections[:n_done + 1] = ckpt['rejections']
+            lls[:n_done + 1] = ckpt['lls']
+            np.random.set_state((str(ckpt['rng_name']), ckpt['rng_keys'],
+                                 int(ckpt['rng_pos']),
+                                 int(ckpt['rng_has_gauss']),
+                                 float(ckpt['rng_gauss'])))
+    # remove a stale checkpoint
+    if stale:
+        cprint(f'\tRemoving stale checkpoint {filename}', level='warning')
+        os.remove(filename)
+        return 0
+    # restart from the last position of the chain
+    update_x0_p0_from_chain(tfit, chains, n_done)
+    tfit.x0 = np.array(tfit.x0)
+    tfit.llx = lls[n_done]
+    cprint(f'\tResuming {filename} at step {n_done}/{niter}')
+    return n_done
 
 
 def calculate_acceptance_rates(rejections: np.ndarray,
@@ -1328,6 +1483,7 @@ class Sampler:
     """
     wchains: Dict[int, np.ndarray]
     wrejects: Dict[int, np.ndarray]
+    wlls: Dict[int, np.ndarray]
     chains: np.ndarray
     reject: np.ndarray
     acc_dict: Dict[int, float]
@@ -1338,15 +1494,90 @@ class Sampler:
         self.mode = mode
         self.wchains = dict()
         self.wrejects = dict()
+        self.wlls = dict()
         self.chain = np.array([])
         self.reject = np.array([])
         self.acc_dict = dict()
         # added manually if required
         self.data = None
-        # set up storage of chainns
+        # the loop state (saved in checkpoints, so run_mcmc can resume)
+        #   run_id identifies the walker checkpoints written by a run with
+        #   the same inputs (so a killed run started again resumes them)
+        self.run_id = sampler_run_id(params, self.tfit, mode)
+        self.nloop = 1
+        self.nsteps = None
+        self.converged = False
+        # set up storage of chains (preallocated and grown per loop)
+        #   wchains, wrejects and wlls are views of this storage
+        self.wstorage = dict()
         for nwalker in range(self.params['WALKERS']):
+            self.wstorage[nwalker] = dict(chain=ChainStorage(self.tfit.n_x),
+                                          reject=ChainStorage(2, dtype=int),
+                                          lls=ChainStorage())
             self.wchains[nwalker] = np.array([])
             self.wrejects[nwalker] = np.array([])
+            self.wlls[nwalker] = np.array([])
+
+    def add_walker_chains(self, nwalker: int, chain: np.ndarray,
+                          reject: np.ndarray, lls: np.ndarray):
+        """
+        Append new steps to the chains of a walker (in place, without
+        concatenating the previous steps)
+
+        :param nwalker: int, the walker number
+        :param chain: np.ndarray, the new steps of the chain [n_steps, n_x]
+        :param reject: np.ndarray, the new rejects [n_steps, 2]
+        :param lls: np.ndarray, the new loglikelihoods [n_steps]
+
+        :return: None, updates wchains, wrejects and wlls
+        """
+        storage = self.wstorage[nwalker]
+        self.wchains[nwalker] = storage['chain'].extend(chain)
+        self.wrejects[nwalker] = storage['reject'].extend(reject)
+        self.wlls[nwalker] = storage['lls'].extend(lls)
+
+    def checkpoint_name(self, nwalker: Optional[int] = None) -> str:
+        """
+        The checkpoint filename of the sampler (nwalker=None) or of the
+        chain of one walker in the current loop
+
+        :param nwalker: int or None, the walker number
+
+        :return: str, the absolute path to the checkpoint file
+        """
+        # get output path
+        outpath = self.params['OUTDIR']
+        outname = self.params['OUTNAME'] + f'_{self.mode}'
+        # deal with no output dir
+        if not os.path.exists(outpath):
+            os.makedirs(outpath)
+        if nwalker is None:
+            return os.path.join(outpath, outname + '_checkpoint.pickle')
+        else:
+            return os.path.join(outpath, outname + f'_walker{nwalker}'
+                                                   f'_checkpoint.npz')
+
+    def checkpoint(self):
+        """
+        Save the sampler at the end of a loop (can be resumed with
+        Sampler.load and run_mcmc). The walker checkpoints of the loop
+        are removed as their chains are now in the sampler.
+
+        :return: None, writes checkpoint to disk
+        """
+        # get the checkpoint filename
+        filename = self.checkpoint_name()
+        # write to a temporary file and then move it
+        with open(filename + '.tmp', 'wb') as pfile:
+            pickle.dump(self, pfile)
+        os.replace(filename + '.tmp', filename)
+        # remove the walker checkpoints
+        for nwalker in self.wchains:
+            wfilename = self.checkpoint_name(nwalker)
+            if os.path.exists(wfilename):
+                os.remove(wfilename)
+        # print progress
+        cprint(f'\tSaved checkpoint {filename}')
 
     def run_mcmc(self, corscale: np.ndarray, loglikelihood, mcmcfunc,
                  trial: Optional['Sampler'] = None):
@@ -1371,8 +1602,6 @@ class Sampler:
         # ---------------------------------------------------------------------
         # get the maximum number of loops for this mode
         nloopsmax = self.params['NLOOPMAX'][self.mode]
-        # get the number of steps for the MCMC for this mode
-        nsteps = self.params['NSTEPS'][self.mode]
         # set number of walkers
         nwalkers = self.params['WALKERS']
         # set the burnin parameter
@@ -1383,36 +1612,44 @@ class Sampler:
         nsteps_inc = self.params['NSTEPS_INC'][self.mode]
         # correction to beta term for deMCMC
         corbeta = self.params['CORBETA'][self.mode]
+        # number of steps between two checkpoints of the chains
+        checkpoint_interval = self.params['CHECKPOINT_INTERVAL']
+        # ---------------------------------------------------------------------
+        # get the number of steps for the MCMC for this mode (unless we
+        #   are resuming from a checkpoint)
+        if self.nsteps is None:
+            self.nsteps = self.params['NSTEPS'][self.mode]
+        # deal with a sampler loaded from a checkpoint that already converged
+        if self.converged:
+            return
         # ---------------------------------------------------------------------
         # deal with having a trial sampler
         in_sampler = trial
+        # deal with resuming a full run after its first loop
+        if self.nloop > 1 and self.mode == 'full':
+            in_sampler = self
         # ---------------------------------------------------------------------
         # loop around
         # ---------------------------------------------------------------------
-        # start loop counter
-        nloop = 1
-        # ---------------------------------------------------------------------
         # Loop around iterations until we break (convergence met) or max
         #     number of loops exceeded
         # ---------------------------------------------------------------------
-        while nloop < nloopsmax:
+        while self.nloop < nloopsmax:
             # set the constant genchain parameters
-            gkwargs = dict(niter=nsteps, beta=self.tfit.beta * corscale,
+            gkwargs = dict(niter=self.nsteps, beta=self.tfit.beta * corscale,
                            loglikelihood=loglikelihood, mcmcfunc=mcmcfunc,
-                           corbeta=corbeta)
+                           corbeta=corbeta,
+                           checkpoint_interval=checkpoint_interval,
+                           nloop=self.nloop, run_id=self.run_id)
             # print progress
-            cprint(f'MCMC Loop {nloop} [{self.mode}]', level='info')
+            cprint(f'MCMC Loop {self.nloop} [{self.mode}]', level='info')
             # -----------------------------------------------------------------
             # loop around walkers
             # -----------------------------------------------------------------
             # print progress
             cprint(f'\tGetting chains for {nwalkers} walkers', level='info')
-            # get the chains in a parallel way
-            wchains, wrejects = _multi_process_pool(self, in_sampler,
-                                                    nwalkers, gkwargs)
-            # push chains/rejects into Sampler
-            self.wchains = wchains
-            self.wrejects = wrejects
+            # get the chains in a parallel way (pushed into the Sampler)
+            _multi_process_pool(self, in_sampler, nwalkers, gkwargs)
 
             # -----------------------------------------------------------------
             # Calculate the Gelman-Rubin Convergence
@@ -1460,15 +1697,20 @@ class Sampler:
             # Question: Is this the same thing?
             #  previously sum(grtest[accept_mask] / grtest[accept_mask])
             if np.sum(grtest < buf_converge_crit) == len(grtest):
+                self.converged = True
+                # save the state of the sampler
+                self.checkpoint()
                 break
             else:
                 # add to the number of steps (for next loop)
-                nsteps += nsteps_inc
+                self.nsteps += nsteps_inc
                 # add to the loop iteration
-                nloop += 1
+                self.nloop += 1
                 # deal with chain update for next loop
                 if self.mode == 'full':
                     in_sampler = self
+                # save the state of the sampler
+                self.checkpoint()
 
     def posterior_print(self):
 
@@ -1733,6 +1975,11 @@ class Sampler:
         """
         Load the sampler class from the pickle file
 
+        This can be a sampler checkpoint (see Sampler.checkpoint), in which
+        case calling run_mcmc again resumes the run from the last completed
+        loop, and each walker resumes from its own checkpoint within the
+        current loop.
+
         :return:
         """
         # load the class and return
@@ -1740,6 +1987,81 @@ class Sampler:
             return pickle.load(pfile)
 
 
+class ChainStorage:
+    """
+    Preallocated storage for a growing chain (or rejects / loglikelihoods)
+
+    Steps are appended into a buffer that grows geometrically, so appending
+    a loop of steps does not copy (and double the memory of) the previous
+    steps every time.
+    """
+    def __init__(self, width: Optional[int] = None, dtype: Any = float):
+        """
+        :param width: int or None, the size of a step (None for scalar steps)
+        :param dtype: the data type of the steps
+        """
+        self.width = width
+        self.size = 0
+        if width is None:
+            self.buffer = np.empty(0, dtype=dtype)
+        else:
+            self.buffer = np.empty((0, width), dtype=dtype)
+
+    def __getstate__(self) -> dict:
+        """
+        For when we have to pickle the class (only keep the valid steps)
+        :return:
+        """
+        state = dict(self.__dict__)
+        state['buffer'] = self.buffer[:self.size]
+        return state
+
+    def __setstate__(self, state: dict):
+        """
+        For when we have to unpickle the class
+
+        :param state: dictionary from pickle
+        :return:
+        """
+        self.__dict__.update(state)
+
+    @property
+    def data(self) -> np.ndarray:
+        """
+        The valid steps (a view of the buffer)
+        """
+        return self.buffer[:self.size]
+
+    def reserve(self, nsteps: int):
+        """
+        Make sure there is space for nsteps more steps
+
+        :param nsteps: int, the number of steps to make space for
+        :return: None, grows the buffer if required
+        """
+        if self.size + nsteps <= len(self.buffer):
+            return
+        # grow geometrically (amortized copies)
+        capacity = max(self.size + nsteps, 2 * len(self.buffer))
+        buffer = np.empty((capacity,) + self.buffer.shape[1:],
+                          dtype=self.buffer.dtype)
+        buffer[:self.size] = self.buffer[:self.size]
+        self.buffer = buffer
+
+    def extend(self, steps: np.ndarray) -> np.ndarray:
+        """
+        Append steps to the storage
+
+        :param steps: np.ndarray, the steps to add [n_steps (, width)]
+        :return: np.ndarray, the valid steps (a view of the buffer)
+        """
+        nsteps = len(steps)
+        self.reserve(nsteps)
+        self.buffer[self.size:self.size + nsteps] = steps
+        self.size += nsteps
+        return self.data
+
+
 def merge_chains(chain1: np.ndarray, chain2: np.ndarray) -> np.ndarray:
     """
     Merge two chains, and account for the first chain being empty
@@ -1817,6 +2139,60 @@ def join_chains(sampler: Sampler, burnin: int) -> Tuple[np.ndarray, np.ndarray]:
     return chains, rejects
 
 
+def _hash_update(digest: Any, value: Any):
+    """
+    Update a hash with a value made of numpy arrays, dictionaries, lists,
+    functions and scalars (functions are hashed by name, not by address,
+    so the hash is the same in another process)
+
+    :param digest: hashlib hash object
+    :param value: the value to add to the hash
+
+    :return: None, updates digest
+    """
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        digest.update(f'{value.dtype.str}{value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, np.ndarray):
+        _hash_update(digest, value.tolist())
+    elif isinstance(value, dict):
+        for key in sorted(value, key=str):
+            _hash_update(digest, key)
+            _hash_update(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            _hash_update(digest, item)
+    elif callable(value):
+        name = getattr(value, '__qualname__', type(value).__qualname__)
+        digest.update(f'{value.__module__}.{name}'.encode())
+    else:
+        digest.update(repr(value).encode())
+
+
+def sampler_run_id(params: ParamDict, tfit: TransitFit, mode: str) -> str:
+    """
+    The run identifier of a sampler: a hash of its inputs (the data, the
+    priors, the initial solution, the number of steps and walkers and the
+    mode). A killed run started again with the same inputs gets the same
+    identifier, so its walkers resume their checkpoints (the loop number is
+    checked separately), while the checkpoints of any other run are stale.
+
+    :param params: ParamDict, parameter dictionary of constants
+    :param tfit: Transit fit parameter container
+    :param mode: str, the sampler mode (trial or full)
+
+    :return: str, the run identifier
+    """
+    digest = hashlib.sha1()
+    for value in [mode, tfit.time, tfit.itime, tfit.flux, tfit.fluxerr,
+                  tfit.pnames, tfit.p0, tfit.fmask, tfit.wmask, tfit.prior,
+                  params['NSTEPS'][mode], params['NSTEPS_INC'][mode],
+                  params['WALKERS']]:
+        _hash_update(digest, value)
+    return digest.hexdigest()
+
+
 def update_x0_p0_from_chain(tfit: TransitFit, chain: np.ndarray,
                             chain_num: int) -> TransitFit:
     """
@@ -1895,7 +2271,11 @@ def _multi_process_pool(sampler: Sampler, in_sampler: Sampler, nwalkers: int,
 
     split into groups based on the max number of N_WALKER_THREADS requested
 
+    The new steps of each walker are appended to the sampler storage
+    (sampler.wchains, sampler.wrejects and sampler.wlls)
+
     :param sampler: Sampler class
+    :param in_sampler: Sampler class, used for buffer if provided
     :param nwalkers: int, the total number of walkers
     :param gkwargs: dictionary, constant args to pass to the linear process
 
@@ -1909,71 +2289,63 @@ def _multi_process_pool(sampler: Sampler, in_sampler: Sampler, nwalkers: int,
         set_start_method("spawn")
     except RuntimeError:
         pass
-    # start process manager
-    wchains = dict()
-    wrejects = dict()
     # get the number of threads (N_WALKER_THREADS)
     n_walker_threads = sampler.params['N_WALKER_THREADS']
     # --------------------------------------------------------------------------
-    # populate the return dictionary
-    for nwalker in range(nwalkers):
-        wchains[nwalker] = np.array([])
-        wrejects[nwalker] = np.array([])
+    # get the buffer from previous chain and update tfit from
+    #   previous chain (once, rather than sending the samplers to every
+    #   process)
+    # Previous chain can be from another sampler or from a
+    #   previous iteration of the NLOOP while loop
+    # Also updates the starting x0 and p0 for htfit
+    htfit = sampler.tfit.copy()
+    buffer, htfit = start_from_previous_chains(sampler, htfit, in_sampler)
     # --------------------------------------------------------------------------
     # list of params for each entry
     params_per_process = []
     # populate params for each sub group
     for nwalker in range(nwalkers):
-        args = (sampler, in_sampler, nwalker, gkwargs, 0)
+        # checkpoint file for this walker
+        if gkwargs['checkpoint_interval'] > 0:
+            checkpoint = sampler.checkpoint_name(nwalker)
+        else:
+            checkpoint = None
+        args = (htfit, buffer, nwalker, gkwargs, 0, checkpoint)
         params_per_process.append(args)
     # start parallel jobs
     with get_context('spawn').Pool(n_walker_threads, maxtasksperchild=1) as pool:
         results = pool.starmap(_linear_process, params_per_process)
     # --------------------------------------------------------------------------
-    # fudge back into return dictionary
+    # push the new steps into the sampler storage
     for row in range(len(results)):
-        wchains[row] = results[row][0]
-        wrejects[row] = results[row][1]
+        sampler.add_walker_chains(row, *results[row])
     # --------------------------------------------------------------------------
     # return these
-    return wchains, wrejects
+    return sampler.wchains, sampler.wrejects
 
 
-def _linear_process(sampler: Sampler, in_sampler: Sampler,
-                    nwalker: int, gkwargs: dict,
-                    ngroup: int) -> Tuple[np.ndarray, np.ndarray]:
+def _linear_process(htfit: TransitFit, buffer: Optional[np.ndarray],
+                    nwalker: int, gkwargs: dict, ngroup: int,
+                    checkpoint: Optional[str] = None
+                    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     The linear process to run in parallel
 
-    :param sampler: Sampler class
-    :param in_sampler: Sampler class, used for buffer if provided
+    :param htfit: TransitFit object (starting point of the walker)
+    :param buffer: previous chain used as buffer for de_mcmc
     :param nwalker: int, the walker number
-    :param gkwargs: dictionary, constant args to pass to the linear process
+    :param gkwargs: dictionary, constant args to pass to genchain
     :param ngroup: int, the group number
-    :param return_dict: the multiprocessing return dictionary (acts like
-                        normal dictionary)
-    :param loglikelihood: function: loglikelihood function
-    :param mcmcfunc: function: mcmcfunc function
+    :param checkpoint: str or None, the checkpoint file for this walker
 
-    :return: tuple, 1. the chains, 2. the rejects
+    :return: tuple, 1. the chains, 2. the rejects, 3. the loglikelihoods
     """
-    # copy tfit
-    htfit = sampler.tfit.copy()
-    # get the buffer from previous chain and update tfit from
-    #   previous chain.
-    # Previous chain can be from another sampler or from a
-    #   previous iteration of the NLOOP while loop
-    # Also updates the starting x0 and p0 for htfit
-    buffer, htfit = start_from_previous_chains(sampler, htfit, in_sampler)
     # get chains and rejects for this walker
-    hchains, hrejects = genchain(htfit, buffer=buffer, nwalker=nwalker,
-                                 ngroup=ngroup, **gkwargs)
-    # push chains into walker storage
-    wchains = merge_chains(sampler.wchains[nwalker], hchains)
-    # push rejects into walker storage
-    wrejects = merge_chains(sampler.wrejects[nwalker], hrejects)
-    # return the return_dict
-    return wchains, wrejects
+    hchains, hrejects, hlls = genchain(htfit, buffer=buffer, nwalker=nwalker,
+                                       ngroup=ngroup, checkpoint=checkpoint,
+                                       **gkwargs)
+    # return the new steps
+    return hchains, hrejects, hlls
 
 
 # =============================================================================
@@ -212,6 +212,13 @@ params.set(key='N_WALKER_THREADS', value=1, source=__NAME__,
                 'Must be equal to 1 or a multiple of the number of walkers',
            dtype=int, path='mcmc_params.optimization.N_walker_threads')
 
+# Run all walkers in lockstep in a single process (instead of one process
+#      per walker)
+params.set(key='ENSEMBLE', value=False, source=__NAME__,
+           desc='Run all walkers in lockstep in a single process '
+                '(instead of one process per walker)',
+           dtype=bool, path='mcmc_params.optimization.ensemble')
+
 # Number of chain threads per walker
 params.set(key='N_CHAIN_THREADS', value=1, source=__NAME__,
            desc='Number of chain threads per walker',
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+# Online MCMC convergence diagnostics
+
+Running (Welford) means and variances of each batch of steps of each
+walker, acceptance counters and a bounded history for the autocorrelation
+time, updated as the steps are produced. Convergence can then be tested at
+any time from the batch statistics instead of recomputing the statistics
+over the full chains.
+
+Created on 2026-10-18
+"""
+import numpy as np
+from typing import Dict, Tuple
+
+from soss_tfit.core import base
+from soss_tfit.core import base_classes
+
+# =============================================================================
+# Define variables
+# =============================================================================
+__NAME__ = 'science.diagnostics.py'
+__version__ = base.__version__
+__date__ = base.__date__
+__authors__ = base.__authors__
+# printer
+cprint = base_classes.Printer()
+
+
+# =============================================================================
+# Define classes
+# =============================================================================
+class OnlineDiagnostics:
+    """
+    Streaming Gelman-Rubin, acceptance rate and autocorrelation time of an
+    ensemble of walkers
+
+    The means, variances and acceptance counters are accumulated per batch
+    of steps, so the statistics after any burnin are merged from the batches
+    instead of recomputed from the chains. The burnin is a fraction of the
+    current chain length (as in mcmc.gelman_rubin_convergence), rounded up
+    to a whole batch.
+    """
+    def __init__(self, n_walkers: int, n_x: int, npt: int,
+                 burninf: float = 0.0, batch: int = 100,
+                 acor_window: int = 4096):
+        """
+        :param n_walkers: int, the number of walkers
+        :param n_x: int, the number of fitted parameters
+        :param npt: int, the number of data points (for the Gelman-Rubin
+                    degrees of freedom)
+        :param burninf: float, the fraction of the steps of each walker to
+                        ignore
+        :param batch: int, the number of steps per batch (the burnin is
+                      rounded up to a multiple of it)
+        :param acor_window: int, the number of most recent steps of each
+                            walker kept for the autocorrelation time
+        """
+        self.n_walkers = n_walkers
+        self.n_x = n_x
+        self.npt = npt
+        self.burninf = burninf
+        self.batch = batch
+        # the number of steps seen by each walker
+        self.nseen = np.zeros(n_walkers, dtype=int)
+        # the count, mean and sum of squared differences of each batch of
+        #   each walker (grown as needed)
+        self.count = np.zeros((n_walkers, 0), dtype=int)
+        self.mean = np.zeros((n_walkers, 0, n_x))
+        self.m2 = np.zeros((n_walkers, 0, n_x))
+        # the acceptance counters of each batch (all walkers) for each
+        #   parameter (Gibbs) and deMCMC
+        self.n_prop = np.zeros((0, n_x), dtype=int)
+        self.n_reject = np.zeros((0, n_x), dtype=int)
+        self.de_nprop = np.zeros(0, dtype=int)
+        self.de_nreject = np.zeros(0, dtype=int)
+        # the most recent steps of each walker (ring buffer)
+        self.acor_window = acor_window
+        self.history = np.zeros((n_walkers, acor_window, n_x))
+
+    def _grow(self, nbatch: int):
+        """
+        Make room for nbatch batches in the batch statistics
+
+        :param nbatch: int, the number of batches needed
+        """
+        size = self.count.shape[1]
+        if nbatch <= size:
+            return
+        extra = max(nbatch, 2 * size) - size
+        self.count = np.pad(self.count, ((0, 0), (0, extra)))
+        self.mean = np.pad(self.mean, ((0, 0), (0, extra), (0, 0)))
+        self.m2 = np.pad(self.m2, ((0, 0), (0, extra), (0, 0)))
+        self.n_prop = np.pad(self.n_prop, ((0, extra), (0, 0)))
+        self.n_reject = np.pad(self.n_reject, ((0, extra), (0, 0)))
+        self.de_nprop = np.pad(self.de_nprop, (0, extra))
+        self.de_nreject = np.pad(self.de_nreject, (0, extra))
+
+    def update(self, nwalker: int, chain: np.ndarray, rejects: np.ndarray):
+        """
+        Add new steps of a walker
+
+        :param nwalker: int, the walker number
+        :param chain: np.ndarray, the new steps [n_steps, n_x]
+        :param rejects: np.ndarray, the new rejects [n_steps, 2]
+                        (rejected, param_number), param_number=-1 for deMCMC
+
+        :return: None, updates the statistics
+        """
+        rejects = np.asarray(rejects)
+        nnew = len(chain)
+        if nnew == 0:
+            return
+        start = self.nseen[nwalker]
+        self.nseen[nwalker] += nnew
+        self._grow(-(-self.nseen[nwalker] // self.batch))
+        # ---------------------------------------------------------------------
+        # split the new steps at the batch boundaries
+        bounds = np.arange((start // self.batch + 1) * self.batch,
+                           start + nnew, self.batch) - start
+        for seg_chain, seg_rejects, pos in zip(
+                np.split(chain, bounds), np.split(rejects, bounds),
+                np.concatenate([[start], start + bounds])):
+            k = pos // self.batch
+            # merge the segment statistics into the batch ones (Chan et al.)
+            nold = self.count[nwalker, k]
+            nseg = len(seg_chain)
+            ntot = nold + nseg
+            smean = np.mean(seg_chain, axis=0)
+            sm2 = np.sum((seg_chain - smean) ** 2, axis=0)
+            delta = smean - self.mean[nwalker, k]
+            self.mean[nwalker, k] += delta * nseg / ntot
+            self.m2[nwalker, k] += sm2 + delta ** 2 * nold * nseg / ntot
+            self.count[nwalker, k] = ntot
+            # acceptance counters (0 = accept, 1 = reject)
+            gibbs = seg_rejects[:, 1] >= 0
+            self.n_prop[k] += np.bincount(seg_rejects[gibbs, 1],
+                                          minlength=self.n_x)
+            self.n_reject[k] += np.bincount(seg_rejects[gibbs, 1],
+                                            weights=seg_rejects[gibbs, 0],
+                                            minlength=self.n_x).astype(int)
+            self.de_nprop[k] += int(np.sum(~gibbs))
+            self.de_nreject[k] += int(np.sum(seg_rejects[~gibbs, 0]))
+        # ---------------------------------------------------------------------
+        # push the most recent steps into the ring buffer
+        window = self.acor_window
+        pos = (start + np.arange(max(nnew - window, 0), nnew)) % window
+        self.history[nwalker, pos] = chain[-window:]
+
+    def burnin(self) -> int:
+        """
+        The number of steps of each walker ignored: burninf of the current
+        chain length, rounded up to a whole batch
+
+        :return: int, the burnin in steps
+        """
+        burnin = int(np.min(self.nseen) * self.burninf)
+        return -(-burnin // self.batch) * self.batch
+
+    def walker_stats(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The count, mean and variance of each walker after the burnin,
+        merged from its batches
+
+        :return: tuple, 1. count [n_walkers], 2. mean [n_walkers, n_x],
+                 3. variance (same as np.var) [n_walkers, n_x]
+        """
+        first = self.burnin() // self.batch
+        count = self.count[:, first:]
+        mean = self.mean[:, first:]
+        ntot = np.sum(count, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            wmean = np.sum(count[:, :, None] * mean, axis=1) / ntot[:, None]
+            m2 = np.sum(self.m2[:, first:], axis=1)
+            m2 += np.sum(count[:, :, None] * (mean - wmean[:, None]) ** 2,
+                         axis=1)
+            return ntot, wmean, m2 / ntot[:, None]
+
+    def gelman_rubin(self) -> np.ndarray:
+        """
+        The potential scale reduction factor (Brooks and Gelman 1997) from the
+        batch statistics after the burnin, same as
+        mcmc.gelman_rubin_convergence
+
+        :return: numpy array [n_x], the gelman rubin convergence for each
+                 parameter
+        """
+        count, wmean, pvar = self.walker_stats()
+        # assume all walkers have the same number of steps
+        n_chain = np.min(count)
+        # calculate the posterior mean for each parameter
+        posteriormean = np.mean(wmean, axis=0)
+        # Calculate between chains variance
+        bvar = np.sum((wmean - posteriormean) ** 2, axis=0)
+        bvar = bvar * n_chain / (self.n_walkers - 1.0)
+        # Calculate within chain variance
+        wvar = np.sum(pvar, axis=0) / self.n_walkers
+        # Calculate the pooled variance
+        part1 = (n_chain - 1) * (wvar / n_chain)
+        part2 = bvar * (self.n_walkers + 1) / (self.n_walkers * n_chain)
+        vvar = part1 + part2
+        # degrees of freedom
+        dof = self.npt - 1
+        # dof ratio for rc and ru
+        dofr = (dof + 3.0) / (dof + 1.0)
+        # PSRF from Brooks and Gelman (1997)
+        return np.sqrt(dofr * vvar / wvar)
+
+    def converged(self, criteria: float) -> bool:
+        """
+        Whether the Gelman-Rubin factor of all parameters is below criteria
+
+        :param criteria: float, the convergence criteria
+
+        :return: bool, True if converged
+        """
+        # we need at least two steps per walker after the burnin
+        if np.min(self.nseen) - self.burnin() < 2:
+            return False
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return bool(np.all(self.gelman_rubin() < criteria))
+
+    def acceptance_rates(self) -> Dict[int, float]:
+        """
+        Acceptance rate of each parameter (and deMCMC with key -1) after the
+        burnin, same as mcmc.calculate_acceptance_rates
+
+        :return: acceptance dictionary, keys = [-1, 0 to n_param]
+                 values = the acceptance for each key
+        """
+        first = self.burnin() // self.batch
+        n_prop = np.sum(self.n_prop[first:], axis=0)
+        n_reject = np.sum(self.n_reject[first:], axis=0)
+        de_nprop = int(np.sum(self.de_nprop[first:]))
+        de_nreject = int(np.sum(self.de_nreject[first:]))
+        # global acceptance rate
+        nprop = np.sum(n_prop) + de_nprop
+        nreject = np.sum(n_reject) + de_nreject
+        gaccept = (nprop - nreject) / max(nprop, 1)
+        cprint(f'Global Acceptance Rate: {gaccept:.3f}')
+        # acceptance rate of each parameter
+        acceptance = (n_prop - n_reject) / (n_prop + 1)
+        acceptance_dict = dict(enumerate(acceptance))
+        # if we have deMCMC results, report the acceptance rate.
+        if de_nprop > 0:
+            de_acceptance = (de_nprop - de_nreject) / de_nprop
+            cprint(f'deMCMC: Acceptance Rate {de_acceptance:.3f}')
+            acceptance_dict[-1] = de_acceptance
+        return acceptance_dict
+
+    def autocorr_time(self, c: float = 5.0) -> np.ndarray:
+        """
+        Integrated autocorrelation time of each parameter over the most recent
+        steps of all walkers (transitfit5.autocorr_new for all parameters at
+        once)
+
+        :param c: float, the Sokal (1989) window constant
+
+        :return: numpy array [n_x], the autocorrelation time in steps
+        """
+        nsteps = min(np.min(self.nseen), self.acor_window)
+        # put each walker history back in time order
+        order = (self.nseen[:, None] - nsteps + np.arange(nsteps)) % \
+            self.acor_window
+        y = self.history[np.arange(self.n_walkers)[:, None], order]
+        # autocorrelation function of each walker and parameter
+        n = 1
+        while n < nsteps:
+            n = n << 1
+        f = np.fft.rfft(y - np.mean(y, axis=1, keepdims=True), n=2 * n,
+                        axis=1)
+        acf = np.fft.irfft(f * np.conjugate(f), axis=1)[:, :nsteps]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            acf /= acf[:, :1]
+        # average over walkers
+        f = np.mean(acf, axis=0)
+        taus = 2.0 * np.cumsum(f, axis=0) - 1.0
+        # Automated windowing procedure following Sokal (1989)
+        m = np.arange(nsteps)[:, None] < c * taus
+        window = np.where(np.any(m, axis=0), np.argmin(m, axis=0), nsteps - 1)
+        return taus[window, np.arange(self.n_x)]
+
+
+# =============================================================================
+# Start of code
+# =============================================================================
+if __name__ == "__main__":
+    # print hello world
+    print('Hello World')
+
+# =============================================================================
+# End of code
+# =============================================================================
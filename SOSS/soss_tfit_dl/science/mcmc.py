@@ -13,6 +13,7 @@ from astropy.io import fits
 from astropy.table import Table, vstack
 import numpy as np
 import bottleneck as bn
+from multiprocessing import shared_memory
 import os
 import pickle
 import time as timemod
@@ -22,6 +23,7 @@ import warnings
 
 from soss_tfit.core import base
 from soss_tfit.core import base_classes
+from soss_tfit.science import diagnostics
 from soss_tfit.science import general
 from soss_tfit.science import models
 
@@ -45,6 +47,10 @@ BADLPR = -np.inf
 
 # These are the attributes of TransitFit that have the same length as x0
 X_ATTRIBUTES = ['x0', 'beta', 'x0pos']
+# These are the (large, read only) data attributes of TransitFit that are put
+#   in shared memory for the walker processes
+SHARED_ATTRIBUTES = ['wavelength', 'time', 'itime', 'flux', 'fluxerr',
+                     'trends_vec']
 
 
 # =============================================================================
@@ -132,10 +138,17 @@ class TransitFit:
     # the rejection [rejected, parameter number]   where rejected = 0 for
     #   accepted and rejected = 1 for rejected
     ac: List[int]
+    # the per bandpass loglikelihood cache (p0 [n_param, n_phot], loglikelihood
+    #   of each bandpass [n_phot]) or None if not computed yet
+    llcache: Optional[Tuple[np.ndarray, np.ndarray]]
 
     def __init__(self):
         # the transitmodel function to use
         self.tmodel_func: None ###DL###
+        # the batched transitmodel function (all bandpasses in one call)
+        self.tmodel_batch_func = None
+        # preallocated model buffer [n_phot, n_int] (filled by lnprob)
+        self.model_buffer = None
         # number of planets
         self.n_planets = 0
         # number of spots
@@ -212,6 +225,9 @@ class TransitFit:
         # the rejection [rejected, parameter number]   where rejected = 0 for
         #   accepted and rejected = 1 for rejected
         self.ac = []
+        # the per bandpass loglikelihood cache (p0 [n_param, n_phot],
+        #   loglikelihood of each bandpass [n_phot]) - never modified in place
+        self.llcache = None
         # define a dictionary to store the 2D positions of all x0 variables
         #   (for use when updating a single x variable)
         self.x0_to_p0 = dict()
@@ -261,6 +277,7 @@ class TransitFit:
         new.params = self.params
         #the transit model function
         new.tmodel_func = self.tmodel_func ###DL###
+        new.tmodel_batch_func = self.tmodel_batch_func
         # number of planets
         new.n_planets = self.n_planets
         # number of planets
@@ -336,6 +353,9 @@ class TransitFit:
         # the rejection [rejected, parameter number]   where rejected = 0 for
         #   accepted and rejected = 1 for rejected
         new.ac = []
+        # the per bandpass loglikelihood cache (never modified in place so
+        #    can be shared)
+        new.llcache = self.llcache
         # ---------------------------------------------------------------------
         # the x0 to p0 translation dictionary
         new.x0_to_p0 = self.x0_to_p0
@@ -872,6 +892,7 @@ def setup_params_mcmc(params: ParamDict, data: InputData) -> TransitFit:
     tfit.params = params ###DL###
     # add the data to the transit fit
     tfit.tmodel_func= models.TMODEL_FUNC[model] ###DL###
+    tfit.tmodel_batch_func = models.TMODEL_BATCH_FUNC[model]
     tfit.wavelength = data.phot['WAVELENGTH']
     tfit.time = data.phot['TIME']
     tfit.itime = data.phot['ITIME']
@@ -967,6 +988,49 @@ def lnpriors(tfit) -> float:
     #    passed)
     return lnprior
 
+def changed_bandpasses(tfit, sol: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the bandpasses whose loglikelihood must be recomputed for the trial
+    solution, i.e. those where any parameter differs from the solution the
+    cached loglikelihood was computed for. A Gibbs step on a chromatic
+    parameter changes a single bandpass, a step on a shared parameter
+    (e.g. T0, RHO_STAR, PERIOD) or a deMCMC jump changes them all.
+
+    :param tfit: the transit fit class
+    :param sol: np.ndarray - the trial solution [n_param, n_phot]
+
+    :return: tuple, 1. the bandpasses to recompute (bool [n_phot])
+                    2. a copy of the cached loglikelihood of each bandpass
+                       [n_phot] (to be updated for the changed bandpasses)
+    """
+    # nothing cached (or cache from a different set up) --> compute all
+    if tfit.llcache is None or tfit.llcache[0].shape != sol.shape:
+        return np.ones(tfit.n_phot, dtype=bool), np.zeros(tfit.n_phot)
+    # get the cached solution and loglikelihood terms
+    cache_sol, cache_terms = tfit.llcache
+    # any parameter change in a bandpass forces recomputing it
+    changed = np.any(sol != cache_sol, axis=0)
+    # return the bandpasses to recompute and the terms to update
+    return changed, np.array(cache_terms)
+
+
+def bandpass_loglikelihood(flux: np.ndarray, fluxerr: np.ndarray,
+                           dscale: np.ndarray, model: np.ndarray) -> np.ndarray:
+    """
+    Uncorrelated noise loglikelihood of several bandpasses at once
+
+    :param flux: np.ndarray, the flux [n_band, n_int]
+    :param fluxerr: np.ndarray, the flux error [n_band, n_int]
+    :param dscale: np.ndarray, the photometric error scale [n_band]
+    :param model: np.ndarray, the transit model [n_band, n_int]
+
+    :return: np.ndarray, the loglikelihood of each bandpass [n_band]
+    """
+    sqrerr = np.square(fluxerr * dscale[:, None])
+    sqrdiff = np.square(flux - model)
+    return -0.5 * bn.nansum(np.log(sqrerr) + sqrdiff / sqrerr, axis=1)
+
+
 def lnprob(tfit: TransitFit) -> float:
     """
     The loglikelihood function
@@ -1036,26 +1100,144 @@ def lnprob(tfit: TransitFit) -> float:
     # -------------------------------------------------------------------------
     # QUESTION: Can we parallelize this?
     # QUESTION: If one phot_it is found to be inf, we can skip rest?
-    # loop around band passes
-    for phot_it in range(n_phot):        
-        #compute model for this bandpass
-        model=tfit.tmodel_func(tfit, phot_it)
-            
-        # Question: What about the GP model, currently it does not update logl
-        # non-correlated noise-model
-        if model_type == 0:
-            sqrerr = np.square(fluxerr[phot_it] * dscale[phot_it])
-            sqrdiff = np.square(flux[phot_it] - model)
-            sumtot = -0.5 * bn.nansum(np.log(sqrerr) + sqrdiff / sqrerr)
-        # check for NaNs -- we don't want these.
-        if np.isfinite(sumtot):
-            logl += sumtot
+    # trial solution (copy, kept in the cache)
+    sol = tfit.p0.copy()
+    # only recompute the band passes that changed since the cached solution
+    changed, lnl_terms = changed_bandpasses(tfit, sol)
+    phot_its = np.where(changed)[0]
+    # compute the models of all changed band passes at once in the
+    #   preallocated buffer
+    if tfit.model_buffer is None or tfit.model_buffer.shape != flux.shape:
+        tfit.model_buffer = np.empty(flux.shape)
+    model = tfit.tmodel_batch_func(tfit, phot_its,
+                                   tfit.model_buffer[:len(phot_its)])
+    # Question: What about the GP model, currently it does not update logl
+    # non-correlated noise-model
+    if model_type == 0:
+        sumtot = bandpass_loglikelihood(flux[phot_its], fluxerr[phot_its],
+                                        dscale[phot_its], model)
+    # check for NaNs -- we don't want these.
+    if not np.all(np.isfinite(sumtot)):
         # else we return our bad log likelihood
-        else:
-            return BADLPR
+        return BADLPR
+    lnl_terms[phot_its] = sumtot
+    # update the cache (mhg_mcmc / de_mhg_mcmc restore it on rejection)
+    tfit.llcache = (sol, lnl_terms)
     # if we have got to here we return the good loglikelihood (sum of each
     #   bandpass)
-    return logl
+    return logl + np.sum(lnl_terms)
+
+
+class EnsembleModelView:
+    """
+    Stand-in for a TransitFit, given to the batched transit models
+    (models.TMODEL_BATCH_FUNC), whose bandpass k is the bandpass bands[k] of
+    the walker whose trial solution is the column k of p0. Any other
+    attribute is the one of the TransitFit (the data are shared by walkers).
+    """
+    def __init__(self, tfit: TransitFit, p0: np.ndarray, bands: np.ndarray):
+        """
+        :param tfit: the transit fit class of any of the walkers
+        :param p0: np.ndarray, the stacked trial solutions [n_param, n_pairs]
+        :param bands: np.ndarray, the bandpass of each column of p0 [n_pairs]
+        """
+        self._tfit = tfit
+        self.p0 = p0
+        self.time = tfit.time[bands]
+        self.itime = tfit.itime[bands]
+        if tfit.n_trends > 0:
+            self.trends_vec = np.asarray(tfit.trends_vec)[:, bands]
+        if len(tfit.ld_func) > 0:
+            self.ld_func = [tfit.ld_func[band] for band in bands]
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._tfit, name)
+
+
+def lnprob_ensemble(tfits: List[TransitFit]) -> np.ndarray:
+    """
+    The loglikelihood function (lnprob) of several walkers at once
+
+    The priors and the per bandpass caches are handled walker by walker as in
+    lnprob, but the models of the bandpasses that changed in all walkers are
+    computed in one call of the batched transit model (see
+    EnsembleModelView), and their loglikelihoods in one vectorized call.
+
+    :param tfits: list of transit fit classes, one per walker (sharing the
+                  data)
+
+    :return: np.ndarray, the loglikelihood of each walker [n_walkers]
+    """
+    # the data (shared by all walkers)
+    tfit0 = tfits[0]
+    flux = tfit0.flux
+    fluxerr = tfit0.fluxerr
+    # -------------------------------------------------------------------------
+    # Step 1: Prior calculation and bandpasses to recompute, per walker
+    # -------------------------------------------------------------------------
+    lls = np.full(len(tfits), BADLPR, dtype=float)
+    walkers, logls, sols, terms, bands = [], [], [], [], []
+    for it, tfit in enumerate(tfits):
+        logl = lnpriors(tfit)
+        # if out of limits this walker is done
+        if not (logl > BADLPR):
+            continue
+        sol = tfit.p0.copy()
+        changed, lnl_terms = changed_bandpasses(tfit, sol)
+        walkers.append(it)
+        logls.append(logl)
+        sols.append(sol)
+        terms.append(lnl_terms)
+        bands.append(np.where(changed)[0])
+    if len(walkers) == 0:
+        return lls
+    # -------------------------------------------------------------------------
+    # Step 2: Calculate loglikelihood of all (walker, bandpass) pairs
+    # -------------------------------------------------------------------------
+    pair_bands = np.concatenate(bands)
+    npairs = len(pair_bands)
+    if npairs > 0:
+        p0 = np.concatenate([sol[:, band] for sol, band in zip(sols, bands)],
+                            axis=1)
+        dscale = np.concatenate([tfits[it].get('DSC', 'p0')[band]
+                                 for it, band in zip(walkers, bands)])
+        view = EnsembleModelView(tfit0, p0, pair_bands)
+        model = tfit0.tmodel_batch_func(view, np.arange(npairs),
+                                        np.empty((npairs, tfit0.n_int)))
+        sumtot = bandpass_loglikelihood(flux[pair_bands], fluxerr[pair_bands],
+                                        dscale, model)
+    # -------------------------------------------------------------------------
+    # Step 3: Sum the bandpasses of each walker and update its cache
+    # -------------------------------------------------------------------------
+    start = 0
+    for it, logl, sol, lnl_terms, band in zip(walkers, logls, sols, terms,
+                                              bands):
+        walker_sum = sumtot[start:start + len(band)] if npairs > 0 else []
+        start += len(band)
+        # check for NaNs -- we don't want these.
+        if not np.all(np.isfinite(walker_sum)):
+            continue
+        lnl_terms[band] = walker_sum
+        tfits[it].llcache = (sol, lnl_terms)
+        lls[it] = logl + np.sum(lnl_terms)
+    return lls
+
+
+def ensemble_loglikelihood(loglikelihood: Any,
+                           tfits: List[TransitFit]) -> np.ndarray:
+    """
+    The loglikelihood of each walker: with lnprob all walkers are computed
+    at once (lnprob_ensemble), any other function is called walker by walker
+
+    :param loglikelihood: log likelihood function
+        - arguments: tfit: TransitFit
+    :param tfits: list of transit fit classes, one per walker
+
+    :return: np.ndarray, the loglikelihood of each walker [n_walkers]
+    """
+    if loglikelihood is lnprob:
+        return lnprob_ensemble(tfits)
+    return np.array([loglikelihood(tfit) for tfit in tfits])
 
 
 def mhg_mcmc(tfit: TransitFit, loglikelihood: Any, beta: np.ndarray,
@@ -1080,6 +1262,7 @@ def mhg_mcmc(tfit: TransitFit, loglikelihood: Any, beta: np.ndarray,
     p0 = tfit.p0.copy()
     x0 = tfit.x0.copy()
     llx0 = tfit.llx
+    llcache0 = tfit.llcache
     # -------------------------------------------------------------------------
     # Step 1: Generate trial state
     # -------------------------------------------------------------------------
@@ -1109,6 +1292,7 @@ def mhg_mcmc(tfit: TransitFit, loglikelihood: Any, beta: np.ndarray,
         tfit.x0 = x0
         tfit.p0 = p0
         tfit.llx = llx0
+        tfit.llcache = llcache0
         tfit.ac = [1, tfit.n_tmp]
     # return tfit instance
     return tfit
@@ -1139,6 +1323,7 @@ def de_mhg_mcmc(tfit: TransitFit, loglikelihood: Any, beta: np.ndarray,
     p0 = tfit.p0.copy()
     x0 = tfit.x0.copy()
     llx0 = tfit.llx
+    llcache0 = tfit.llcache
     # draw a random number to decide which sampler to use
     rsamp = tfit.rng.random()
     # -------------------------------------------------------------------------
@@ -1172,6 +1357,7 @@ def de_mhg_mcmc(tfit: TransitFit, loglikelihood: Any, beta: np.ndarray,
         tfit.x0 = x0
         tfit.p0 = p0
         tfit.llx = llx0
+        tfit.llcache = llcache0
         tfit.ac = [1, tfit.n_tmp]
     # return tfit instance
     return tfit
@@ -1740,6 +1926,163 @@ def genchain(tfit: TransitFit, niter: int, beta: np.ndarray,
     # return the chains and rejections
     return chains, rejections, lls
 
+def genensemble(tfits: List[TransitFit], niter: int, beta: np.ndarray,
+                mcmcfunc, loglikelihood,
+                buffer: Optional[np.ndarray] = None, corbeta: float = 1.0,
+                thinning: int = 1,
+                online: Optional[diagnostics.OnlineDiagnostics] = None,
+                converge_crit: Optional[float] = None,
+                check_interval: int = 100
+                ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Generate the Markov Chains of an ensemble of walkers in lockstep
+
+    The state of all walkers is kept in [n_walkers, n_x] arrays: the Gibbs
+    and deMCMC proposals, the acceptance tests and the chain storage are done
+    for all walkers at once. Each walker keeps its own TransitFit (sharing
+    the data) for its solution and likelihood cache.
+
+    :param tfits: list of Transit fit class of parameters, one per walker
+    :param niter: int, the number of steps for each chain to run through
+    :param beta: np.ndarray, the Gibb's factor : characteristic step size
+                 for each parameter
+    :param mcmcfunc: MCMC function (mhg_mcmc or de_mhg_mcmc), only used to
+                     select the proposals (de_mhg_mcmc mixes Gibbs and deMCMC)
+    :param loglikelihood: log likelihood function
+        - arguments: tfit: TransitFit
+    :param buffer: np.ndarray, previous chains to use as a buffer
+                   (mcmcfunc=deMCMC only)
+    :param corbeta: float, a fractional multipier for previous chain used
+                    as a buffer (mcmcfunc=deMCMC only)
+    :param thinning: int, keep one step every thinning steps
+    :param online: OnlineDiagnostics, if set it is updated with the steps
+                   as they are produced
+    :param converge_crit: float, if set (with online) stop as soon as
+                          all the Gelman-Rubin factors are below it
+    :param check_interval: int, the number of kept (thinned) steps between
+                           two updates of the diagnostics
+
+    :return: tuple, 1. chains (numpy array [n_iter, n_walkers, n_x])
+                    2. rejects (numpy array [n_iter, n_walkers, 2]
+                       where reject=(rejected 1 or 0, parameter num changed)
+                    3. loglikelihoods (numpy array [n_iter, n_walkers])
+    """
+    # one RNG for the whole ensemble
+    rng = np.random.default_rng()
+    # number of walkers and fitted parameters
+    nwalkers = len(tfits)
+    n_x = tfits[0].n_x
+    # probability to use the deMCMC sampler
+    if mcmcfunc.__name__ == 'de_mhg_mcmc':
+        if buffer is None:
+            emsg = 'buffer must not be None for de_mhg_mcmc()'
+            raise base_classes.TransitFitExcept(emsg)
+        pdemcmc = 0.5
+    else:
+        pdemcmc = 0.0
+    # -------------------------------------------------------------------------
+    # the state of all walkers
+    xs = np.array([tfit.x0 for tfit in tfits])
+    # pre-compute the first log-likelihoods
+    llx = ensemble_loglikelihood(loglikelihood, tfits)
+    # -------------------------------------------------------------------------
+    # Initialize arrays to hold chain values
+    nthinned = np.ceil(niter / thinning).astype(int)
+    chains = np.empty([nthinned, nwalkers, n_x])
+    rejections = np.empty([nthinned, nwalkers, 2], dtype=int)
+    lls = np.empty([nthinned, nwalkers])
+    # -------------------------------------------------------------------------
+    # loop around iterations
+    n_it_update = max(round(0.1 * niter), 1)
+    # the number of kept steps already pushed into the diagnostics
+    ndiag = 0
+    start = timemod.time()
+    for n_it in range(niter):
+        # print every 10%
+        if n_it % n_it_update == 0:
+            cprint(f'\tEnsemble of {nwalkers} walkers iteration={n_it}/{niter}',
+                   flush=True)
+        # ---------------------------------------------------------------------
+        # Step 1: Generate trial states
+        # ---------------------------------------------------------------------
+        xt = np.array(xs)
+        # the parameter varied by each walker (-1 for a deMCMC jump)
+        n_tmp = rng.integers(0, n_x, size=nwalkers)
+        demcmc = rng.random(nwalkers) < pdemcmc
+        n_tmp[demcmc] = -1
+        gibbs = ~demcmc
+        # Gibbs sampler: one parameter per walker
+        xt[gibbs, n_tmp[gibbs]] += rng.normal(0.0, beta[n_tmp[gibbs]])
+        # deMCMC sampler: vector jump between two buffer states
+        if np.any(demcmc):
+            int1, int2 = rng.integers(0, len(buffer), size=(2, np.sum(demcmc)))
+            xt[demcmc] += (buffer[int1] - buffer[int2]) * corbeta
+        # ---------------------------------------------------------------------
+        # Step 2: Compute log(p(x'|d))=log(p(x'))+log(p(d|x'))
+        # ---------------------------------------------------------------------
+        p0s, llcaches = [], []
+        for it, tfit in enumerate(tfits):
+            # keep the current solution (ready for a reset if rejected)
+            p0s.append(tfit.p0.copy())
+            llcaches.append(tfit.llcache)
+            tfit.x0 = xt[it]
+            if gibbs[it]:
+                tfit.p0[tfit.x0_to_p0[n_tmp[it]]] = xt[it, n_tmp[it]]
+            else:
+                tfit.update_p0_from_x0()
+        # the models of all walkers are computed at once
+        llxt = ensemble_loglikelihood(loglikelihood, tfits)
+        # ---------------------------------------------------------------------
+        # Step 3 Compute the acceptance probability and accept or reject
+        # ---------------------------------------------------------------------
+        # llxt can be -np.inf --> therefore we suppress overflow warning here
+        with np.errstate(over='ignore', invalid='ignore'):
+            alpha = np.exp(llxt - llx)
+        accept = rng.random(nwalkers) <= alpha
+        xs[accept] = xt[accept]
+        llx[accept] = llxt[accept]
+        # reset the rejected walkers to their previous point
+        for it in np.where(~accept)[0]:
+            tfits[it].x0 = xs[it]
+            tfits[it].p0 = p0s[it]
+            tfits[it].llcache = llcaches[it]
+        # ---------------------------------------------------------------------
+        # add results to arrays
+        if not n_it % thinning:
+            itt = n_it // thinning
+            chains[itt] = xs
+            rejections[itt, :, 0] = ~accept
+            rejections[itt, :, 1] = n_tmp
+            lls[itt] = llx
+            # update the diagnostics and test for convergence
+            if online is not None and (itt + 1) % check_interval == 0:
+                for it in range(nwalkers):
+                    online.update(it, chains[ndiag:itt + 1, it],
+                                  rejections[ndiag:itt + 1, it])
+                ndiag = itt + 1
+                if converge_crit is not None and \
+                        online.converged(converge_crit):
+                    cprint(f'\tEnsemble converged at iteration '
+                           f'{n_it + 1}/{niter}', level='info')
+                    chains, rejections = chains[:ndiag], rejections[:ndiag]
+                    lls = lls[:ndiag]
+                    break
+    # push the remaining steps into the diagnostics
+    if online is not None:
+        for it in range(nwalkers):
+            online.update(it, chains[ndiag:, it], rejections[ndiag:, it])
+    # print timing
+    cprint(f'\tEnsemble of {nwalkers} walkers {niter} in '
+           f'{timemod.time() - start:.3f} s', level='warning')
+    # -------------------------------------------------------------------------
+    # update the walkers to their final state
+    for it, tfit in enumerate(tfits):
+        tfit.x0 = np.array(xs[it])
+        tfit.llx = llx[it]
+    # return the chains and rejections
+    return chains, rejections, lls
+
+
 def genchain_old(tfit: TransitFit, niter: int, beta: np.ndarray,
              mcmcfunc, loglikelihood,
              buffer: Optional = None, corbeta: float = 1.0,
@@ -2037,6 +2380,8 @@ class Sampler:
         self.reject = np.array([])
         self.lls = np.array([])
         self.acc_dict = dict()
+        # online convergence diagnostics (set up on the first loop)
+        self.diagnostics = None
         # added manually if required
         self.data = None
         self.results_table = Table()
@@ -2154,9 +2499,18 @@ class Sampler:
         # -----------------------------------------------------------------
         # print progress
         cprint(f'\tGetting chains of {self.nsteps} steps for {nwalkers} walkers', level='info')
+        # set up the online diagnostics (the burnin follows the chain length)
+        if self.diagnostics is None:
+            self.diagnostics = diagnostics.OnlineDiagnostics(
+                nwalkers, self.tfit.n_x, self.tfit.npt, burninf=burninf)
         # get the chains in a parallel way
-        self.wchains, self.wrejects, self.wlls = _multi_process_pool(self, in_sampler,
+        self.wchains, self.wrejects, self.wlls = _walker_chains(self, in_sampler,
                                                  nwalkers, gkwargs)
+        # update the online diagnostics with the new steps only
+        for nwalker in range(nwalkers):
+            nseen = self.diagnostics.nseen[nwalker]
+            self.diagnostics.update(nwalker, self.wchains[nwalker][nseen:],
+                                    self.wrejects[nwalker][nseen:])
 #         # push chains/rejects into Sampler
 #         self.wchains = wchains
 #         self.wrejects = wrejects
@@ -2180,21 +2534,20 @@ class Sampler:
 #         else:
 #             rejects = self.reject
 #             burnin_full = int(self.chain.shape[0] * burninf)
-        #DL: always use the merge chains
-        rejects = self.reject
-        burnin_full = int(self.chain.shape[0] * burninf)
-            
-        # calculate acceptance for chain1
-        self.acc_dict = calculate_acceptance_rates(rejects,burnin=burnin_full)
+        # acceptance from the online counters (all walkers, after burnin)
+        self.acc_dict = self.diagnostics.acceptance_rates()
         
         # -----------------------------------------------------------------
         # Calculate the Gelman-Rubin Convergence
         # -----------------------------------------------------------------
         # print progress
         cprint('\tCalculating Gelman-Rubin Convergence.', level='info')
-        # calculate the rc factor, npt is the number of total points
-        self.grtest = gelman_rubin_convergence(self.wchains, burnin=burnin,
-                                               npt=self.tfit.npt)
+        # calculate the rc factor from the running walker means and variances
+        self.grtest = self.diagnostics.gelman_rubin()
+        # print the autocorrelation time of the most recent steps
+        taus = self.diagnostics.autocorr_time()
+        cprint(f'\tMax autocorrelation time: {np.max(taus):.1f} steps '
+               f'({self.tfit.xnames[np.argmax(taus)]})', level='info')
 
         # print results
         cprint('\tParam \t\tvalue \tGRconv \tACrate:',level='info',timestamp=0)
@@ -2271,7 +2624,7 @@ class Sampler:
             self.wrejects[nwalker] = np.array([])
             self.wlls[nwalker] = np.array([])
         # get the chains in a parallel way
-        self.wchains, self.wrejects, self.wlls = _multi_process_pool(self, None,
+        self.wchains, self.wrejects, self.wlls = _walker_chains(self, None,
                                                  nwalkers, gkwargs)
 #         # push chains/rejects into Sampler
 #         self.wchains = wchains
@@ -2820,6 +3173,58 @@ def __assign_pvalue(key: str, pdict: ParamDict, n_phot: int, func_name: str):
 
 
 MultiReturn = Tuple[Dict[int, np.ndarray], Dict[int, np.ndarray]]
+# the description of a shared array {name: (shm name, shape, dtype)}
+SharedSpec = Dict[str, Tuple[str, tuple, str]]
+
+
+def _share_arrays(arrays: Dict[str, Any]
+                  ) -> Tuple[List[shared_memory.SharedMemory], SharedSpec]:
+    """
+    Copy arrays into shared memory blocks (once) so that processes can attach
+    them by name instead of receiving a pickled copy each
+
+    Entries that are None or cannot be converted into a numeric array (e.g.
+    trends not yet filled) are skipped
+
+    :param arrays: dictionary of arrays to share
+
+    :return: tuple, 1. the shared memory blocks (the caller must close and
+             unlink them), 2. the specification to pass to _attach_arrays
+    """
+    shms, specs = [], dict()
+    for key, value in arrays.items():
+        if value is None:
+            continue
+        value = np.asarray(value)
+        if value.dtype == object or value.nbytes == 0:
+            continue
+        shm = shared_memory.SharedMemory(create=True, size=value.nbytes)
+        shared = np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)
+        shared[:] = value
+        del shared
+        shms.append(shm)
+        specs[key] = (shm.name, value.shape, value.dtype.str)
+    return shms, specs
+
+
+def _attach_arrays(specs: SharedSpec
+                   ) -> Tuple[List[shared_memory.SharedMemory],
+                              Dict[str, np.ndarray]]:
+    """
+    Attach the arrays shared with _share_arrays (read only views)
+
+    :param specs: the specification returned by _share_arrays
+
+    :return: tuple, 1. the shared memory blocks (the caller must close them
+             once the arrays are no longer used), 2. dictionary of arrays
+    """
+    shms, arrays = [], dict()
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        arrays[key].flags.writeable = False
+        shms.append(shm)
+    return shms, arrays
 
 
 def _multi_process_pool_old(sampler: Sampler, in_sampler: Sampler, nwalkers: int,
@@ -2875,6 +3280,76 @@ def _multi_process_pool_old(sampler: Sampler, in_sampler: Sampler, nwalkers: int
     # return these
     return wchains, wrejects, wlls
 
+def _walker_chains(sampler: Sampler, in_sampler: Sampler, nwalkers: int,
+                   gkwargs: dict) -> MultiReturn:
+    """
+    Get the chains of all walkers, either in lockstep in this process
+    (ENSEMBLE = True) or with one process per walker
+
+    :param sampler: Sampler class
+    :param in_sampler: Sampler class, used for buffer and starting point
+                       if provided
+    :param nwalkers: int, the total number of walkers
+    :param gkwargs: dictionary, constant args to pass to the chain generator
+
+    :return: tuple, 1. dictionary the chains for each walker
+                    2. dictionary the rejects for each walker
+                    3. dictionary the loglikelihoods for each walker
+    """
+    if sampler.params['ENSEMBLE']:
+        return _ensemble_process(sampler, in_sampler, nwalkers, gkwargs)
+    else:
+        return _multi_process_pool(sampler, in_sampler, nwalkers, gkwargs)
+
+
+def _ensemble_process(sampler: Sampler, in_sampler: Sampler, nwalkers: int,
+                      gkwargs: dict) -> MultiReturn:
+    """
+    Run all walkers in lockstep in this process (no process per walker)
+
+    :param sampler: Sampler class
+    :param in_sampler: Sampler class, used for buffer and starting point
+                       if provided
+    :param nwalkers: int, the total number of walkers
+    :param gkwargs: dictionary, constant args to pass to genensemble
+
+    :return: tuple, 1. dictionary the chains for each walker
+                    2. dictionary the rejects for each walker
+                    3. dictionary the loglikelihoods for each walker
+    """
+    # the buffer is the merged walker chains from in_sampler
+    if in_sampler is not None:
+        buffer = in_sampler.chain
+    else:
+        buffer = None
+    # one tfit per walker (data are shared between the copies)
+    tfits = []
+    for nwalker in range(nwalkers):
+        htfit = sampler.tfit.copy()
+        # update the starting point of this walker
+        if in_sampler is not None:
+            update_x0_p0_from_chain(htfit, in_sampler.wchains[nwalker], -1)
+            htfit.x0 = np.array(htfit.x0)
+        tfits.append(htfit)
+    # get chains for all walkers at once (stopping early if the
+    #   Gelman-Rubin criteria is met)
+    chains, rejects, lls = genensemble(
+        tfits, buffer=buffer, online=sampler.diagnostics,
+        converge_crit=sampler.params['BUFFER_CONVERGE_CRIT'], **gkwargs)
+    # --------------------------------------------------------------------------
+    # push the chains of each walker into walker storage
+    wchains, wrejects, wlls = dict(), dict(), dict()
+    for nwalker in range(nwalkers):
+        wchains[nwalker] = merge_chains(sampler.wchains[nwalker],
+                                        chains[:, nwalker])
+        wrejects[nwalker] = merge_chains(sampler.wrejects[nwalker],
+                                         rejects[:, nwalker])
+        wlls[nwalker] = merge_chains(sampler.wlls[nwalker], lls[:, nwalker])
+    # --------------------------------------------------------------------------
+    # return these
+    return wchains, wrejects, wlls
+
+
 def _multi_process_pool(sampler: Sampler, in_sampler: Sampler, nwalkers: int,
                         gkwargs: dict) -> MultiReturn:
     """
@@ -2909,7 +3384,13 @@ def _multi_process_pool(sampler: Sampler, in_sampler: Sampler, nwalkers: int,
     #set it to None to reduce memory usage of pool processes
     if gkwargs['mcmcfunc'].__name__=='mhg_mcmc':
         buffer=None
-    
+    # --------------------------------------------------------------------------
+    # put the data and the buffer in shared memory once, the walker processes
+    #   attach them by name (only the small per walker state is pickled)
+    arrays = dict(buffer=buffer)
+    for attribute in SHARED_ATTRIBUTES:
+        arrays[attribute] = getattr(sampler.tfit, attribute)
+    shms, specs = _share_arrays(arrays)
     # list of params for each entry
     params_per_process = []
     # populate params for each sub group
@@ -2920,15 +3401,25 @@ def _multi_process_pool(sampler: Sampler, in_sampler: Sampler, nwalkers: int,
         #update the starting point of this walker
         if in_sampler is not None:
             update_x0_p0_from_chain(htfit, in_sampler.wchains[nwalker], -1)
+        # remove the shared arrays (re-attached in the walker process)
+        for attribute in SHARED_ATTRIBUTES:
+            if attribute in specs:
+                setattr(htfit, attribute, None)
 
-        args = (htfit, buffer, nwalker, gkwargs, 0)
+        args = (htfit, None, nwalker, gkwargs, 0, specs)
         params_per_process.append(args)
         
     # get the number of threads (N_WALKER_THREADS)
     n_walker_threads = sampler.params['N_WALKER_THREADS']
     # start parallel jobs
-    with get_context('fork').Pool(n_walker_threads, maxtasksperchild=1) as pool:
-        results = pool.starmap(_linear_process, params_per_process)
+    try:
+        with get_context('fork').Pool(n_walker_threads,
+                                      maxtasksperchild=1) as pool:
+            results = pool.starmap(_linear_process, params_per_process)
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
 #     with get_context('spawn').Pool(n_walker_threads, maxtasksperchild=1) as pool:
 #         results = pool.starmap(_linear_process, params_per_process)
     
@@ -2955,8 +3446,9 @@ def _multi_process_pool(sampler: Sampler, in_sampler: Sampler, nwalkers: int,
     return wchains, wrejects, wlls
 
 def _linear_process(htfit: TransitFit, buffer: np.ndarray,
-                    nwalker: int, gkwargs: dict,
-                    ngroup: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+                    nwalker: int, gkwargs: dict, ngroup: int,
+                    shared: Optional[SharedSpec] = None
+                    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     The linear process to run in parallel
 
@@ -2965,12 +3457,31 @@ def _linear_process(htfit: TransitFit, buffer: np.ndarray,
     :param nwalker: int, the walker number
     :param gkwargs: dictionary, constant args to pass to genchain
     :param ngroup: int, the group number
+    :param shared: the shared memory specification of the TransitFit data
+                   attributes (and of the buffer) to attach, from
+                   _share_arrays
 
     :return: tuple, 1. the chains, 2. the rejects, 3. the loglikelihoods
     """
-    # get chains and rejects for this walker
-    hchains, hrejects, hlls = genchain(htfit, buffer=buffer, nwalker=nwalker,
-                                 ngroup=ngroup, **gkwargs)
+    # attach the shared data and buffer
+    shms, arrays = _attach_arrays(shared or dict())
+    for attribute in SHARED_ATTRIBUTES:
+        if attribute in arrays:
+            setattr(htfit, attribute, arrays[attribute])
+    buffer = arrays.get('buffer', buffer)
+    try:
+        # get chains and rejects for this walker
+        hchains, hrejects, hlls = genchain(htfit, buffer=buffer,
+                                           nwalker=nwalker, ngroup=ngroup,
+                                           **gkwargs)
+    finally:
+        # release the views before closing the shared memory
+        for attribute in SHARED_ATTRIBUTES:
+            if attribute in arrays:
+                setattr(htfit, attribute, None)
+        del arrays, buffer
+        for shm in shms:
+            shm.close()
 
     # return the return_dict
     return hchains, hrejects, hlls
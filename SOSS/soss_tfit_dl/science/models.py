@@ -1,6 +1,8 @@
 import numpy as np
 
 TMODEL_FUNC = []
+# batched models: fill out[k] with the model of bandpass phot_its[k]
+TMODEL_BATCH_FUNC = []
 # model stellar parameters in correct order
 TPS_ORDERED = []
 # model star spot fit parameters (one per spot in this order)
@@ -12,6 +14,19 @@ TPH_ORDERED = []
 # model additionnal parameters
 TP_KWARGS = []
 
+
+def add_trends(tfit, phot_its, out):
+    """add the trends of bandpasses phot_its to the models out [len(phot_its), n_int]"""
+    if tfit.n_trends == 0:
+        return out
+    #stack the trends once, as an array [n_trends, n_phot, n_int]
+    if not isinstance(tfit.trends_vec, np.ndarray):
+        tfit.trends_vec = np.asarray(tfit.trends_vec)
+    #trends are always the last parameters
+    coeffs = tfit.p0[-tfit.n_trends:, phot_its]
+    out += np.einsum('nk,nki->ki', coeffs, tfit.trends_vec[:, phot_its])
+    return out
+
 #####JASON ROWE original model#####
 from soss_tfit.utils import tfit5
 
@@ -30,7 +45,18 @@ def tmodel_jr(tfit, phot_it):
       
     return model
 
+def tmodel_jr_batch(tfit, phot_its, out):
+    
+    #the fortran code computes one bandpass at a time, directly in out
+    for k, phot_it in enumerate(phot_its):
+        tfit5.transitmodel(tfit.n_planets, tfit.p0[:, phot_it], tfit.time[phot_it],
+                           tfit.itime[phot_it], tfit.tt_n, tfit.tt_tobs,
+                           tfit.tt_omc, out[k], tfit.tmodel_dtype, tfit.pkwargs['NINTG'])
+
+    return add_trends(tfit, phot_its, out)
+
 TMODEL_FUNC.append(tmodel_jr)
+TMODEL_BATCH_FUNC.append(tmodel_jr_batch)
 TPS_ORDERED.append(['RHO_STAR', 'LD1', 'LD2', 'LD3', 'LD4',
                     'DILUTION', None,'ZEROPOINT'])
 TPSP_ORDERED.append([])
@@ -74,7 +100,25 @@ def tmodel_jr_model_ld(tfit, phot_it):
       
     return model
 
+def tmodel_jr_model_ld_batch(tfit, phot_its, out):
+    
+    #build the proper p0 vectors, as needed by tfit5.transitmodel
+    p0=tfit.p0[:, phot_its].copy()
+    p0[1]=0. #must set LD1 to 0
+    p0[2]=0. #must set LD2 to 0
+    for k, phot_it in enumerate(phot_its):
+        #interpolate the q1 & q2 at desired Teff & logg
+        pt=(tfit.p0[1,phot_it],tfit.p0[2,phot_it]) #(teff,logg)
+        p0[3,k]=tfit.ld_func[phot_it][0](pt) #LD3 to q1
+        p0[4,k]=tfit.ld_func[phot_it][1](pt) #LD4 to q2
+        tfit5.transitmodel(tfit.n_planets, p0[:, k], tfit.time[phot_it],
+                           tfit.itime[phot_it], tfit.tt_n, tfit.tt_tobs,
+                           tfit.tt_omc, out[k], tfit.tmodel_dtype, tfit.pkwargs['NINTG'])
+
+    return add_trends(tfit, phot_its, out)
+
 TMODEL_FUNC.append(tmodel_jr_model_ld)
+TMODEL_BATCH_FUNC.append(tmodel_jr_model_ld_batch)
 TPS_ORDERED.append(['RHO_STAR', 'TEFF', 'LOGG', None, None, 'DILUTION', None, 'ZEROPOINT'])
 TPSP_ORDERED.append([])
 TPP_ORDERED.append(['T0', 'PERIOD', 'B', 'RPRS', 'SQRT_E_COSW',
@@ -130,7 +174,37 @@ def tmodel_spotrod(tfit,phot_it,n_r=1000):
         
     return model
     
+def spotrod_batch(tfit, phot_its, out, q1, q2, n_r=1000):
+    #the C code computes one bandpass at a time, directly in out
+    #out must be C contiguous (rows of a preallocated buffer)
+    n_s=tfit.n_spots #number of spots
+    i=3+4*np.arange(n_s)
+    for k, phot_it in enumerate(phot_its):
+        t= tfit.time[phot_it].copy() #must put a copy here! so would be better if it was a list of arrays
+        spotx=   tfit.p0[i,phot_it]
+        spoty=   tfit.p0[i+1,phot_it]
+        spotrad= tfit.p0[i+2,phot_it]
+        spotcont=tfit.p0[i+3,phot_it]
+        t0,period,b,rprs,sma,ecw,esw=tfit.p0[3+4*n_s:10+4*n_s,phot_it]
+        transitmodel_c(
+            c_void_p(t.ctypes.data),c_int(t.size), c_double(q1[k]), c_double(q2[k]), 
+            c_void_p(spotx.ctypes.data), c_void_p(spoty.ctypes.data),
+            c_void_p(spotrad.ctypes.data), c_void_p(spotcont.ctypes.data),
+            c_int(n_s), c_int(n_r),
+            c_double(t0),c_double(period), c_double(b), c_double(sma), c_double(rprs),
+            c_double(ecw), c_double(esw), c_void_p(out[k].ctypes.data)
+            )
+
+    #add the zeropoint
+    out+=tfit.p0[0,phot_its][:, None]
+
+    return add_trends(tfit, phot_its, out)
+
+def tmodel_spotrod_batch(tfit,phot_its,out,n_r=1000):
+    return spotrod_batch(tfit, phot_its, out, tfit.p0[1,phot_its], tfit.p0[2,phot_its], n_r=n_r)
+
 TMODEL_FUNC.append(tmodel_spotrod)
+TMODEL_BATCH_FUNC.append(tmodel_spotrod_batch)
 TPS_ORDERED.append(['ZEROPOINT','Q1', 'Q2'])
 TPSP_ORDERED.append(['SPOTX', 'SPOTY', 'SPOTR', 'SPOTC'])
 TPP_ORDERED.append(['T0', 'PERIOD', 'B', 'RPRS', 'SMA', 'SQRT_E_COSW','SQRT_E_SINW'])
@@ -181,7 +255,14 @@ def tmodel_spotrod2(tfit,phot_it,n_r=1000):
         
     return model
     
+def tmodel_spotrod2_batch(tfit,phot_its,out,n_r=1000):
+    #interpolate the q1 & q2 at desired Teff & logg
+    q1=[tfit.ld_func[phot_it][0](tfit.p0[1,phot_it],tfit.p0[2,phot_it]) for phot_it in phot_its]
+    q2=[tfit.ld_func[phot_it][1](tfit.p0[1,phot_it],tfit.p0[2,phot_it]) for phot_it in phot_its]
+    return spotrod_batch(tfit, phot_its, out, q1, q2, n_r=n_r)
+
 TMODEL_FUNC.append(tmodel_spotrod2)
+TMODEL_BATCH_FUNC.append(tmodel_spotrod2_batch)
 TPS_ORDERED.append(['ZEROPOINT','TEFF', 'LOGG'])
 TPSP_ORDERED.append(['SPOTX', 'SPOTY', 'SPOTR', 'SPOTC'])
 TPP_ORDERED.append(['T0', 'PERIOD', 'B', 'RPRS', 'SMA', 'SQRT_E_COSW','SQRT_E_SINW'])
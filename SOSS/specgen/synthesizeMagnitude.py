@@ -221,7 +221,7 @@ def expected_flux_calibration(filtername, magnitude, model_angstrom, model_flux,
 
     
 def measure_actual_flux(imagename, xbounds=[0,2048], ybounds=[0,256],
-                        noversample=1):
+                        noversample=1, timestep=0):
     '''
     Measures the integrated flux in a spectral order on actual
     images.
@@ -230,6 +230,10 @@ def measure_actual_flux(imagename, xbounds=[0,2048], ybounds=[0,256],
     :param xbounds: assumes native pixels boundaries
     :param ybounds: assumes native pixels boundaries
     :param noversample:
+    :param timestep: time step to measure if imagename is a (ntime, norder, dimy, dimx)
+                     simulation cube (see itsosspipeline.SimulationCubeWriter). Ignored
+                     for the items of an itsosspipeline.SimulationCubeList, which
+                     carry their own time step.
     :return:
     '''
 
@@ -238,7 +242,12 @@ def measure_actual_flux(imagename, xbounds=[0,2048], ybounds=[0,256],
     ybounds_os = np.array(ybounds, dtype=np.int)*noversample
 
     # Read the cube on disk assuming a (norder, dimy, dimx) shape
-    image = fits.getdata(imagename)
+    with fits.open(imagename, memmap=True) as hdulist:
+        image = hdulist[0].data
+        if image.ndim == 4:
+            # Time series cube, only read the requested time step
+            image = image[getattr(imagename, 'timestep', timestep)]
+        image = np.array(image, dtype=float)
     norder, dimy, dimx = np.shape(image)
     image_cropped = image[:, ybounds_os[0]:ybounds_os[1], xbounds_os[0]:xbounds_os[1]]
     print('shape of the image on which flux is measured:', np.shape(image_cropped))
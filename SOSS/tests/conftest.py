@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The SOSS modules import each other both as SOSS.<package> and as <package>.
+SOSS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+for path in (os.path.dirname(SOSS_DIR), SOSS_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from soss_tfit_dl.science import diagnostics
+
+NWALKERS, NSTEPS, NX, NPT = 4, 1000, 3, 500
+
+
+def _chains():
+    """Random walk chains with an offset per walker, so they are not converged."""
+
+    rng = np.random.default_rng(3)
+    chains = np.cumsum(rng.normal(0, 1, (NWALKERS, NSTEPS, NX)), axis=1)
+    chains += rng.normal(0, 5, (NWALKERS, 1, NX))
+    rejects = np.stack([rng.integers(0, 2, (NWALKERS, NSTEPS)),
+                        rng.integers(-1, NX, (NWALKERS, NSTEPS))], axis=2)
+
+    return chains, rejects
+
+
+@pytest.mark.parametrize('update', [1, 37, 100, 250])
+@pytest.mark.parametrize('burninf', [0.0, 0.2, 0.5])
+def test_online_gelman_rubin_matches_full(update, burninf):
+    mcmc = pytest.importorskip('soss_tfit.science.mcmc')
+    chains, rejects = _chains()
+    online = diagnostics.OnlineDiagnostics(NWALKERS, NX, NPT, burninf=burninf, batch=50)
+
+    # the burnin moves as the chains grow (several sampler loops)
+    for nsteps in (400, 700, NSTEPS):
+        for walker in range(NWALKERS):
+            for start in range(online.nseen[walker], nsteps, update):
+                stop = min(start + update, nsteps)
+                online.update(walker, chains[walker, start:stop], rejects[walker, start:stop])
+
+        burnin = online.burnin()
+        assert burnin == -(-int(nsteps * burninf) // 50) * 50
+        expected = mcmc.gelman_rubin_convergence(dict(enumerate(chains[:, :nsteps])), burnin, NPT)
+        np.testing.assert_allclose(online.gelman_rubin(), expected, rtol=1e-10)
+
+        acceptance = online.acceptance_rates()
+        for p_num in range(NX):
+            used = rejects[:, burnin:nsteps, 1] == p_num
+            nreject = np.sum(rejects[:, burnin:nsteps, 0][used])
+            assert acceptance[p_num] == pytest.approx((np.sum(used) - nreject) / (np.sum(used) + 1))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import warnings
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import spsolve
+
+from SOSS.dms import engine_utils
+from SOSS.dms import soss_extract_tso
+
+
+def _tikhonov_system():
+    """Linear system and Tikhonov matrix of a small single order extraction."""
+
+    scidata, scierr, _, wave_maps, spat_pros, throughputs, kernels = \
+        soss_extract_tso._synthetic_tso(1, nrows=64, ncols=512)
+    wave_grid = engine_utils.grid_from_map(wave_maps[0], spat_pros[0], n_os=2)
+    engine = soss_extract_tso._build_engine(wave_maps, spat_pros, throughputs, kernels,
+                                            wave_grid, [1], dict())
+
+    matrix, result = engine.build_sys(data=scidata[0], error=scierr[0])
+    i_grid = engine.get_i_grid(result)
+
+    return matrix, result, engine.get_tikho_matrix(), wave_grid, i_grid
+
+
+def _normal_system(matrix, result, t_mat, i_grid, factor):
+    """(A_T.A + factor^2 * gamma_T.gamma) and A_T.b, built independently of Tikhonov."""
+
+    a_mat = csr_matrix(matrix)[:, i_grid]
+    t_mat = csr_matrix(t_mat)[i_grid, :][:, i_grid]
+
+    return (a_mat.T.dot(a_mat) + factor**2 * t_mat.T.dot(t_mat)).tocsc(), a_mat.T.dot(result[i_grid])
+
+
+def test_tikhonov_factor_sweep(monkeypatch):
+    """A sweep of factors down to a singular system orders the factorization
+    once, and every solution solves the normal system without warnings."""
+
+    matrix, result, t_mat, wave_grid, i_grid = _tikhonov_system()
+    tikho = engine_utils.Tikhonov(matrix, result, t_mat=t_mat, grid=wave_grid,
+                                  index=i_grid, verbose=False)
+
+    orderings = []
+    original = engine_utils.splu
+
+    def splu(*args, permc_spec=None, **kwargs):
+        orderings.append(permc_spec)
+        return original(*args, permc_spec=permc_spec, **kwargs)
+
+    monkeypatch.setattr(engine_utils, 'splu', splu)
+
+    factors = np.logspace(-20, -10, 30)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        tests = tikho.test_factors(factors)
+
+    assert orderings == ['MMD_AT_PLUS_A'] + ['NATURAL'] * (len(factors) - 1)
+
+    for factor, sln in zip(factors, tests['solution']):
+        normal, rhs = _normal_system(matrix, result, t_mat, i_grid, factor)
+        assert np.linalg.norm(normal.dot(sln) - rhs) < 1e-12 * np.linalg.norm(rhs)
+
+
+def test_tikhonov_matches_spsolve():
+    """Where the regularised system is well conditioned, the solutions are
+    the same as spsolve (the solver used before the ordering was reused)."""
+
+    matrix, result, t_mat, wave_grid, i_grid = _tikhonov_system()
+    tikho = engine_utils.Tikhonov(matrix, result, t_mat=t_mat, grid=wave_grid,
+                                  index=i_grid, verbose=False)
+
+    for factor in np.logspace(-11, -8, 4):
+        normal, rhs = _normal_system(matrix, result, t_mat, i_grid, factor)
+        np.testing.assert_allclose(tikho.solve(factor), spsolve(normal, rhs), rtol=1e-6)
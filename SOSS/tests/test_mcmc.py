@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+
+mcmc = pytest.importorskip('soss_tfit.science.mcmc')
+
+PARAMS = {'NSTEPS': {'full': 50}, 'NSTEPS_INC': {'full': 10}, 'WALKERS': 1}
+
+
+class Killed(Exception):
+    pass
+
+
+def _tfit():
+    """A transit fit with two fitted bolometric parameters."""
+
+    tfit = mcmc.TransitFit()
+    tfit.n_phot, tfit.n_param = 1, 2
+    tfit.p0 = np.array([[0.5], [-0.5]])
+    tfit.fmask = np.array([True, True])
+    tfit.wmask = np.array([False, False])
+    tfit.pnames = np.array(['A', 'B'])
+    tfit.pbetas = np.array([0.1, 0.1])
+    tfit.prior = [dict(func=mcmc.tophat_prior, minimum=-5, maximum=5)] * 2
+    tfit.flux = tfit.fluxerr = tfit.time = tfit.itime = np.ones((1, 10))
+    tfit.get_fitted_params()
+    tfit.beta = np.array([0.3, 0.3])
+
+    return tfit
+
+
+def _loglikelihood(calls, kill_at=None):
+    """Gaussian loglikelihood counting its calls, raising at call kill_at."""
+
+    def loglikelihood(tfit):
+        calls.append(1)
+        if len(calls) == kill_at:
+            raise Killed
+        return -0.5 * np.sum(tfit.x0 ** 2)
+
+    return loglikelihood
+
+
+def _genchain(tfit, loglikelihood, checkpoint, run_id):
+    return mcmc.genchain(tfit, PARAMS['NSTEPS']['full'], tfit.beta, mcmc.mhg_mcmc, loglikelihood,
+                         checkpoint=checkpoint, checkpoint_interval=10, nloop=1, run_id=run_id)
+
+
+def test_resume_after_kill_in_first_loop(tmp_path):
+    checkpoint = str(tmp_path / 'walker0_checkpoint.npz')
+
+    # the uninterrupted chain
+    np.random.seed(1)
+    reference, _, _ = _genchain(_tfit(), _loglikelihood([]), None, None)
+
+    # the run killed in loop 1 (no sampler pickle yet), after the checkpoint of step 20
+    np.random.seed(1)
+    run_id = mcmc.sampler_run_id(PARAMS, _tfit(), 'full')
+    with pytest.raises(Killed):
+        _genchain(_tfit(), _loglikelihood([], kill_at=31), checkpoint, run_id)
+    assert os.path.exists(checkpoint)
+
+    # the same run started again gets the same run id and resumes at step 20
+    np.random.seed(2)
+    calls = []
+    tfit = _tfit()
+    chains, _, _ = _genchain(tfit, _loglikelihood(calls), checkpoint, mcmc.sampler_run_id(PARAMS, tfit, 'full'))
+    assert len(calls) == 30
+    np.testing.assert_array_equal(chains, reference)
+
+
+def test_other_run_does_not_resume(tmp_path):
+    checkpoint = str(tmp_path / 'walker0_checkpoint.npz')
+    with pytest.raises(Killed):
+        _genchain(_tfit(), _loglikelihood([], kill_at=31), checkpoint,
+                  mcmc.sampler_run_id(PARAMS, _tfit(), 'full'))
+
+    # other data: the checkpoint is stale
+    tfit = _tfit()
+    tfit.flux = 2 * tfit.flux
+    run_id = mcmc.sampler_run_id(PARAMS, tfit, 'full')
+    assert run_id != mcmc.sampler_run_id(PARAMS, _tfit(), 'full')
+    calls = []
+    _genchain(tfit, _loglikelihood(calls), checkpoint, run_id)
+    assert len(calls) == 51
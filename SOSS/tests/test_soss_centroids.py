@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from scipy.ndimage import shift
+
+from SOSS.dms import soss_centroids
+
+REF_FILES = os.path.join(os.path.dirname(__file__), '..', 'extract', 'Ref_files')
+
+
+def _cube(dtype):
+    """Order 1 trace profile shifted along the rows in each integration, with noise."""
+
+    profile = fits.getdata(os.path.join(REF_FILES, 'trace_profile_m1.fits'))[0, 0]
+    profile = np.nan_to_num(profile.astype('float64'))[:96]
+
+    yshifts = [0., 0.4, -0.7, 1.5, -2.2]
+    rng = np.random.default_rng(7)
+    cube = np.stack([1000 * shift(profile, [yshift, 0]) + 5 for yshift in yshifts])
+    cube += rng.normal(0, 1, cube.shape)
+
+    return cube.astype(dtype)
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+@pytest.mark.parametrize('per_integration_mask', [False, True])
+def test_cube_matches_get_centroids_com(dtype, per_integration_mask):
+    cube = _cube(dtype)
+
+    rng = np.random.default_rng(8)
+    if per_integration_mask:
+        mask = rng.random(cube.shape) < 0.01
+    else:
+        mask = rng.random(cube.shape[1:]) < 0.01
+
+    # 2 integrations per chunk, so the last chunk is partial.
+    xtrace, ytraces, params = soss_centroids.get_centroids_com_cube(cube, mask=mask, chunksize=2)
+
+    for i, image in enumerate(cube):
+        mask_i = mask[i] if per_integration_mask else mask
+        xtrace_i, ytrace_i, param_i = soss_centroids.get_centroids_com(image, mask=mask_i)
+
+        np.testing.assert_array_equal(xtrace, xtrace_i)
+        np.testing.assert_allclose(ytraces[i], ytrace_i, rtol=0, atol=1e-6)
+        np.testing.assert_allclose(params[i], param_i, rtol=1e-6)
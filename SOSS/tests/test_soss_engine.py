@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from SOSS.dms import engine_utils
+from SOSS.dms import soss_extract_tso
+
+NINTS = 4
+
+
+def _engine_and_data():
+    """Single order engine and a few integrations, with pixels masked in
+    all integrations, in a few (low-rank update) and in many of them."""
+
+    scidata, scierr, scimask, wave_maps, spat_pros, throughputs, kernels = \
+        soss_extract_tso._synthetic_tso(NINTS, nrows=64, ncols=512)
+    wave_grid = engine_utils.grid_from_map(wave_maps[0], spat_pros[0], n_os=2)
+    engine = soss_extract_tso._build_engine(wave_maps, spat_pros, throughputs, kernels,
+                                            wave_grid, [1], dict())
+
+    rng = np.random.default_rng(5)
+    scimask[:, 10, 50] = True
+    scimask[1, 30:33, 100] = True
+    scimask[2, rng.integers(0, 64, 20), rng.integers(0, 512, 20)] = True
+
+    # Errors of each integration, slightly different from the first one.
+    errors = scierr * rng.uniform(0.9, 1.1, scierr.shape)
+
+    return engine, scidata, scierr[0], errors, scimask
+
+
+@pytest.mark.parametrize('same_error', [True, False])
+@pytest.mark.parametrize('max_low_rank', [100, 0])
+def test_extract_batch_solves_extract_system(same_error, max_low_rank):
+    """Each batch spectrum solves the system `extract` builds for its
+    integration (the system without regularisation is singular, so the
+    solutions are compared through the residuals)."""
+
+    engine, scidata, error, errors, scimask = _engine_and_data()
+    if not same_error:
+        error = errors
+
+    spectra = engine.extract_batch(scidata, error=error, mask=scimask, max_low_rank=max_low_rank)
+
+    for i_int in range(NINTS):
+        error_i = error if same_error else error[i_int]
+        matrix, result = engine.build_sys(data=scidata[i_int], error=error_i, mask=scimask[i_int])
+        i_grid = engine.get_i_grid(result)
+
+        assert np.array_equal(np.isfinite(spectra[i_int]),
+                              np.isfinite(engine.extract(data=scidata[i_int], error=error_i,
+                                                         mask=scimask[i_int])))
+
+        residual = matrix[i_grid, :][:, i_grid].dot(spectra[i_int, i_grid]) - result[i_grid]
+        assert np.linalg.norm(residual) < 1e-12 * np.linalg.norm(result[i_grid])
+
+
+@pytest.mark.parametrize('same_error', [True, False])
+def test_extract_batch_matches_extract_tikhonov(same_error):
+    """With Tikhonov regularisation the spectra are the same as `extract`."""
+
+    engine, scidata, error, errors, scimask = _engine_and_data()
+    if not same_error:
+        error = errors
+
+    spectra = engine.extract_batch(scidata, error=error, mask=scimask, tikhonov=True, factor=1e-10)
+
+    for i_int in range(NINTS):
+        error_i = error if same_error else error[i_int]
+        spectrum = engine.extract(data=scidata[i_int], error=error_i, mask=scimask[i_int],
+                                  tikhonov=True, factor=1e-10)
+        np.testing.assert_allclose(spectra[i_int], spectrum, rtol=1e-8)
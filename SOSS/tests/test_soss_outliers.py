@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+soss_outliers = pytest.importorskip('SOSS.dms.soss_outliers')
+
+NINTS, NROWS, NCOLS = 11, 32, 128
+WINDOW = (1, 33)
+
+
+def _result():
+    """Noisy time series of a trace with injected cosmic rays and a few
+    pixels already flagged."""
+
+    rng = np.random.default_rng(4)
+    rows = np.arange(NROWS)[:, None]
+    trace = 1e4 * np.exp(-0.5 * ((rows - 16 - 0.02 * np.arange(NCOLS)) / 3.) ** 2)
+    flux = 1 + 0.01 * rng.normal(size=(NINTS, 1, 1))
+    data = flux * trace + rng.normal(0, 10, (NINTS, NROWS, NCOLS))
+
+    hits = (np.array([0, 1, 5, 9, 10]), rng.integers(0, NROWS, 5), rng.integers(20, 108, 5))
+    data[hits] += 1e4
+
+    dq = np.zeros(data.shape, dtype='uint32')
+    dq[3, 5, 40:45] = soss_outliers.pixel['DO_NOT_USE']
+
+    return SimpleNamespace(data=data, dq=dq), hits
+
+
+def _flag_per_integration(result, nn=2, n_sig=5):
+    """The integration by integration flagging (before the blocks), with
+    find_outliers on the median of the difference images."""
+
+    dq = result.dq.copy()
+    neighbours = soss_outliers.neighbour_indices(NINTS, nn)
+
+    for i in range(NINTS):
+        differenceImages = [result.data[i] - result.data[ii] for ii in neighbours[i]]
+        medianCombined = np.nanmedian(differenceImages, axis=0)
+        medianCombined[result.dq[i] != soss_outliers.pixel['GOOD']] = 0
+
+        outliers = soss_outliers.find_outliers(medianCombined, WINDOW, n_sig)
+        dq[i][outliers] = soss_outliers.pixel['OUTLIER']
+
+    return dq
+
+
+def test_neighbour_indices():
+    neighbours = soss_outliers.neighbour_indices(7, 2)
+
+    assert neighbours[0].tolist() == [1, 2, 3, 4]
+    assert neighbours[1].tolist() == [0, 2, 3, 4]
+    assert neighbours[3].tolist() == [1, 2, 4, 5]
+    assert neighbours[6].tolist() == [2, 3, 4, 5]
+
+
+@pytest.mark.parametrize('block_size, n_proc', [(4, 1), (NINTS, 1), (4, 2)])
+def test_block_matches_per_integration(block_size, n_proc):
+    result, hits = _result()
+    expected = _flag_per_integration(result)
+
+    soss_outliers.flag_outliers(result, window_size=WINDOW, block_size=block_size, n_proc=n_proc)
+
+    # find_outliers reads uninitialised padding within half a window of the
+    # edges (find_outliers_block reflects the images), compare inside.
+    inside = slice(WINDOW[1] // 2, NCOLS - WINDOW[1] // 2)
+    np.testing.assert_array_equal(result.dq[..., inside], expected[..., inside])
+
+    # the blocks do not change the flags anywhere
+    single, _ = _result()
+    soss_outliers.flag_outliers(single, window_size=WINDOW, block_size=1)
+    np.testing.assert_array_equal(result.dq, single.dq)
+
+    assert np.all(result.dq[hits] == soss_outliers.pixel['OUTLIER'])
+    assert np.all(result.dq[3, 5, 40:45] == soss_outliers.pixel['DO_NOT_USE'])
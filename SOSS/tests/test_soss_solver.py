@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+from astropy.io import fits
+from scipy.ndimage import shift
+
+from SOSS.dms import soss_solver
+from SOSS.dms.soss_centroids import get_soss_centroids
+
+REF_FILES = os.path.join(os.path.dirname(__file__), '..', 'extract', 'Ref_files')
+
+
+def _trace_profile():
+    """Order 1 trace profile, cropped to a SUBSTRIP96-like subarray since
+    there are no order 2 and 3 traces for get_soss_centroids to find."""
+
+    profile = fits.getdata(os.path.join(REF_FILES, 'trace_profile_m1.fits'))[0, 0]
+    profile = np.nan_to_num(profile.astype('float64'))[:96]
+
+    return profile
+
+
+def test_column_offsets():
+    """Known y-shifts of the trace profile are recovered in each column."""
+
+    profile = _trace_profile()
+    ypix = np.arange(profile.shape[0])[:, np.newaxis]
+    ypos = np.sum(profile * ypix, axis=0) / np.sum(profile, axis=0)
+
+    yshifts = np.array([0.5, -0.3, 0.2, 2.2, -4.4])
+    images = np.stack([shift(profile, [yshift, 0]) for yshift in yshifts])
+    images = 1000 * images + 5
+
+    cols = np.arange(200, 1800, 8)
+    offsets = soss_solver.column_offsets(images[:, :, cols], profile[:, cols], ypos[cols])
+
+    assert np.all(np.isfinite(offsets))
+    assert np.allclose(offsets, yshifts[:, np.newaxis], atol=0.02)
+
+
+def test_track_transform():
+    """Known rotations and shifts of the trace profile are recovered for each
+    integration."""
+
+    profile = _trace_profile()
+    centroids = get_soss_centroids(profile, subarray='SUBSTRIP96')
+    xref = centroids['order 1']['X centroid']
+    yref = centroids['order 1']['Y centroid']
+
+    # angle, x-shift and y-shift of each integration.
+    transforms = np.array([[0., 0., 0.],
+                           [0.1, 0.3, 0.5],
+                           [-0.1, -0.3, -0.5],
+                           [0.05, 0., -0.3],
+                           [-0.05, 0., 0.3],
+                           [0., 0.5, 0.2],
+                           [0., -0.5, -0.2]])
+
+    # The images are transformed as in apply_transform.
+    cube = np.stack([soss_solver.transform_image(-angle, xshift, yshift, profile)
+                     for angle, xshift, yshift in transforms])
+    rng = np.random.default_rng(0)
+    cube = 1000 * cube + 5 + rng.normal(0, 1, cube.shape)
+    mask = np.zeros(profile.shape, dtype=bool)
+
+    result = soss_solver.track_transform(cube, mask, xref, yref, 'SUBSTRIP96')
+    result_mp = soss_solver.track_transform(cube, mask, xref, yref, 'SUBSTRIP96', ncpu=2)
+
+    assert result.shape == (len(transforms), 3)
+    assert np.allclose(result, result_mp)
+    assert np.allclose(result[:, 0], transforms[:, 0], atol=0.02)
+    assert np.allclose(result[:, 2], transforms[:, 2], atol=0.05)
+
+    # The x-shift only enters through the slope of the trace, so it is poorly
+    # constrained by the y-positions of order 1 (as in solve_transform).
+    assert np.allclose(result[:, 1], transforms[:, 1], atol=1.5)
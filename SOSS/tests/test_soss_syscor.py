@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+from astropy.stats import SigmaClip
+
+from SOSS.dms import soss_syscor
+
+NINTS, NROWS, NCOLS = 3, 32, 64
+
+
+def _observation():
+    """Images with 1/f column offsets, outliers, masked pixels, a masked trace
+    and a fully masked column."""
+
+    rng = np.random.default_rng(6)
+    deepstack = rng.uniform(0, 100, (NROWS, NCOLS))
+    scidata = deepstack + rng.normal(0, 1, (NINTS, NROWS, NCOLS))
+    scidata += rng.normal(0, 5, (NINTS, 1, NCOLS))
+    scidata[rng.random(scidata.shape) < 0.02] += 50.
+
+    scimask = rng.random(scidata.shape) < 0.05
+    scimask[:, :, 7] = True
+    bkg_mask = np.zeros((NROWS, NCOLS), dtype=bool)
+    bkg_mask[12:20] = True
+
+    return scidata, scimask, deepstack, bkg_mask
+
+
+def _astropy_correction(scidata, scimask, deepstack, bkg_mask, zero_bias):
+    """The correction of each integration with astropy SigmaClip (the
+    implementation before the cube version)."""
+
+    mask = scimask | ~np.isfinite(deepstack) | bkg_mask
+    diffimage = np.ma.array(scidata - deepstack, mask=mask)
+
+    sigclip = SigmaClip(sigma=3, maxiters=None, cenfunc='mean')
+    diffimage_clipped = sigclip(diffimage, axis=0)
+
+    col_cor = diffimage_clipped.mean(axis=0).filled(np.nan)
+    npix_cor = (~diffimage_clipped.mask).sum(axis=0)
+    bias = np.nanmean(col_cor)
+    if zero_bias:
+        col_cor = col_cor - bias
+
+    return scidata - col_cor, col_cor, npix_cor, bias
+
+
+@pytest.mark.parametrize('maxiters', [1, 2, None])
+def test_sigma_clipped_column_mean(maxiters):
+    scidata, scimask, deepstack, bkg_mask = _observation()
+    mask = scimask | bkg_mask
+
+    col_mean, npix = soss_syscor.sigma_clipped_column_mean(scidata, mask, sigma=3, maxiters=maxiters)
+
+    sigclip = SigmaClip(sigma=3, maxiters=maxiters, cenfunc='mean')
+    for i in range(NINTS):
+        clipped = sigclip(np.ma.array(scidata[i], mask=mask[i]), axis=0)
+        np.testing.assert_allclose(col_mean[i], clipped.mean(axis=0).filled(np.nan), rtol=1e-12)
+        np.testing.assert_array_equal(npix[i], (~clipped.mask).sum(axis=0))
+
+
+@pytest.mark.parametrize('zero_bias', [False, True])
+def test_cube_matches_astropy(zero_bias):
+    scidata, scimask, deepstack, bkg_mask = _observation()
+
+    results = soss_syscor.soss_oneoverf_correction_cube(scidata, scimask, deepstack,
+                                                        bkg_mask=bkg_mask, zero_bias=zero_bias)
+
+    for i in range(NINTS):
+        expected = _astropy_correction(scidata[i], scimask[i], deepstack, bkg_mask, zero_bias)
+        single = soss_syscor.soss_oneoverf_correction(scidata[i], scimask[i], deepstack,
+                                                      bkg_mask=bkg_mask, zero_bias=zero_bias)
+
+        for result, single_result, expected_result in zip(results, single, expected):
+            np.testing.assert_allclose(result[i], expected_result, rtol=1e-12)
+            np.testing.assert_array_equal(single_result, result[i])
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+import pytest
+import scipy.signal
+
+spgen = pytest.importorskip('specgen.spgen')
+
+
+def _convolution_inputs(nkernel=12, image_shape=(60, 150), kernel_shape=(15, 11), seed=0):
+    """Random kernels, seeded trace image and column weights."""
+
+    rng = np.random.default_rng(seed)
+    kernels = rng.random((nkernel,) + kernel_shape)
+    image = rng.random(image_shape)
+
+    # Each kernel weights a band of columns, as convolve_1wv_weights does.
+    fac = np.zeros((nkernel, image_shape[1]))
+    edges = np.linspace(0, image_shape[1], nkernel + 1).astype(int)
+    for k in range(nkernel):
+        fac[k, edges[k]:edges[k + 1]] = rng.random(edges[k + 1] - edges[k])
+
+    return kernels, image, fac
+
+
+def _reference(kernels, image, fac):
+    """Sum over the kernels of the weighted full-image fftconvolve."""
+
+    return sum(scipy.signal.fftconvolve(image, kernel, mode='same') * weights
+               for kernel, weights in zip(kernels, fac))
+
+
+def test_psf_convolver_matches_fftconvolve():
+
+    kernels, image, fac = _convolution_inputs()
+    expected = _reference(kernels, image, fac)
+
+    convolver = spgen.PSFConvolver(kernels, image.shape, nbatch=4)
+    convolved = convolver.convolve(image, fac)
+
+    assert np.allclose(convolved, expected, rtol=0, atol=1e-9 * np.max(expected))
+
+
+def test_psf_convolver_bounded_cache():
+
+    kernels, image, fac = _convolution_inputs()
+    expected = spgen.PSFConvolver(kernels, image.shape).convolve(image, fac)
+
+    # Room for 3 kernel FFTs only.
+    convolver = spgen.PSFConvolver(kernels, image.shape, max_cache_bytes=1)
+    cache_bytes = 3 * convolver.kernels_ft_nbytes // len(kernels)
+    convolver = spgen.PSFConvolver(kernels, image.shape, nbatch=2, max_cache_bytes=cache_bytes)
+    convolved = convolver.convolve(image, fac)
+
+    assert convolver.kernels_ft is None
+    assert len(convolver._cache) <= 3
+    assert np.allclose(convolved, expected, rtol=0, atol=1e-12 * np.max(expected))
+
+
+def test_cached_kernels(tmp_path):
+
+    from astropy.io import fits
+
+    rng = np.random.default_rng(1)
+    fnames = []
+    for i in range(3):
+        fname = str(tmp_path / 'kernel_{}.fits'.format(i))
+        fits.writeto(fname, rng.random((9, 9)))
+        fnames.append(fname)
+    expected = spgen.read_normalized_kernels(fnames)
+
+    cachedir = str(tmp_path / 'cache')
+    for mmap in (False, True, False):
+        kernels, kernels_wv = spgen.cached_kernels(fnames, [1.0, 1.1, 1.2], 'test',
+                                                   cachedir=cachedir, mmap=mmap)
+        assert kernels.dtype == (np.float32 if mmap else np.float64)
+        assert np.allclose(kernels, expected, rtol=1e-6)
+        assert np.allclose(kernels_wv, [1.0, 1.1, 1.2])
+
+    # A cache entry without its manifest (interrupted write) is rebuilt.
+    manifest, = [f for f in os.listdir(cachedir) if f.endswith('.json')]
+    os.remove(os.path.join(cachedir, manifest))
+    kernels, _ = spgen.cached_kernels(fnames, [1.0, 1.1, 1.2], 'test', cachedir=cachedir)
+    assert np.allclose(kernels, expected, rtol=1e-6)
+    assert os.path.isfile(os.path.join(cachedir, manifest))
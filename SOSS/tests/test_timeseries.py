@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from detector import detector
+
+NINTEGS, NGROUPS, NCOLS, NROWS = 4, 3, 96, 2048
+
+
+def _noisefiles(path):
+    """Write small stand-ins of the default SUBSTRIP96 reference files."""
+
+    rng = np.random.default_rng(1)
+    fits.PrimaryHDU(rng.uniform(0.5, 1.5, (2048, 2048)).astype(np.float32)).writeto(
+        os.path.join(path, 'background_detectorfield_normalized.fits'))
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(rng.uniform(0.9, 1.1, (2048, 2048)).astype(np.float32))]).writeto(
+        os.path.join(path, 'jwst_niriss_flat_0190.fits'))
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(rng.uniform(0, 2, (NGROUPS + 1, NCOLS, NROWS)).astype(np.float32))]).writeto(
+        os.path.join(path, 'jwst_niriss_dark_0150.fits'))
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(rng.uniform(1e4, 2e4, (NCOLS, NROWS)).astype(np.float32))]).writeto(
+        os.path.join(path, 'jwst_niriss_superbias_0111.fits'))
+    coeffs = np.zeros((3, 2048, 2048), dtype=np.float32)
+    coeffs[1] = 1
+    coeffs[2] = 1e-6
+    fits.PrimaryHDU(coeffs).writeto(
+        os.path.join(path, 'jwst_niriss_linearity_0011_bounds_0_60000_npoints_100_deg_5.fits'))
+
+    return path + os.sep
+
+
+def _exposure(filename):
+    """Write a noiseless SUBSTRIP96 exposure with an extra extension."""
+
+    rng = np.random.default_rng(2)
+    primary = fits.PrimaryHDU()
+    primary.header['SUBARRAY'] = 'SUBSTRIP96'
+    primary.header['TGROUP'] = 5.491
+    ramp = np.cumsum(rng.uniform(0, 100, (NINTEGS, NGROUPS, NCOLS, NROWS)), axis=1)
+    extra = fits.ImageHDU(np.arange(10.), name='EXTRA')
+    fits.HDUList([primary, fits.ImageHDU(ramp, name='SCI'), extra]).writeto(filename)
+
+    return filename
+
+
+def test_chunked_matches_in_memory(tmp_path):
+    noisefiles = _noisefiles(str(tmp_path))
+    exposure = _exposure(str(tmp_path / 'exposure.fits'))
+
+    outputs = {}
+    runs = [('memory', None, 1), ('memory_ncpu', None, 2), ('chunked', 1, 1), ('chunked_ncpu', 1, 2)]
+    for name, memory_budget, ncpu in runs:
+        outputs[name] = str(tmp_path / (name + '.fits'))
+        detector.add_noise(exposure, noisefiles, outputfilename=outputs[name],
+                           memory_budget=memory_budget, seed=42, ncpu=ncpu)
+
+    with fits.open(outputs['memory']) as reference:
+        for name in ('memory_ncpu', 'chunked', 'chunked_ncpu'):
+            with fits.open(outputs[name]) as hdulist:
+                assert [hdu.name for hdu in hdulist] == [hdu.name for hdu in reference]
+                np.testing.assert_array_equal(hdulist[1].data, reference[1].data)
+                np.testing.assert_array_equal(hdulist['EXTRA'].data, reference['EXTRA'].data)
+
+
+
+def test_pink_noise_batched_matches_single():
+    timeseries = detector.timeseries
+    ramps = np.zeros((5, NGROUPS, NCOLS, NROWS))
+
+    # 5 integrations in batches of 2, so the last batch is partial
+    batched = ramps.copy()
+    timeseries.PinkNoiseGenerator('SUBSTRIP96', NGROUPS, batch=2).add_to(batched, 7, integ_offset=3)
+
+    for i in range(5):
+        rng = timeseries.integration_rng(7, 'oneoverf', 3 + i)
+        single = timeseries.add_1overf_ramp(ramps[i].copy(), rng, 'SUBSTRIP96', c_pink=9.6, alpha=-1)
+        np.testing.assert_allclose(batched[i], single, rtol=0, atol=1e-4)
+        assert np.std(single) > 1